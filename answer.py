@@ -1,12 +1,24 @@
 import argparse
 import os
 import time
-import PyPDF2
-from fillpdf import fillpdfs
 
 from openai import AzureOpenAI
 from dotenv import load_dotenv
-import re
+
+from answer_state import DEFAULT_OVERLAP, AnswerState, get_file_hash
+from answers import (NOT_AVAILABLE, AnswerLine, StreamingAnswerParser, answer_text, find_unanswered, format_answer_lines,
+                     load_answers, merge_answers, parse_answer_line, parse_answer_lines, save_answers)
+from cache import DEFAULT_CACHE_PATH, ResponseCache
+from emr_extract import pre_extract
+from form_schema import load_form_schema
+from metrics import get_recorder
+from pdf_filler import fill_pdf
+from prompts import PromptBuilder, PromptTooLong, count_tokens, get_max_prompt_tokens, split_to_tokens
+from retrieval import DEFAULT_THRESHOLD, DEFAULT_TOP_K, AzureEmbedder, HashingEmbedder, Retriever
+from vision import OpenAIRequestLibrary, add_call_limit_arguments, apply_call_limits
+
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+TEXT_MODEL = 'AZURE_OPENAI_GPT_TURBO_DEPLOYMENT'  # The variable naming the text model
 
 def read_file(file_path):
     """Utility function to read file content."""
@@ -21,14 +33,49 @@ def write_file(file_path, content):
 
 
 
-def get_unanswered_questions(client, model, answered_text):
+def build_request(client, model, messages, temperature, cache=None, response_format=None, label='chat',
+                  max_prompt_tokens=None):
+    """
+    Returns an OpenAIRequestLibrary request holding the chat messages, which
+    refuses to send more than max_prompt_tokens (by default the budget of the
+    text model, see prompts.get_max_prompt_tokens). Without a deployment the
+    request would go to the vision model's, so a missing one is an error.
+    """
+    model = model or os.getenv(TEXT_MODEL)
+    if not model:
+        raise ValueError(f"Set {TEXT_MODEL} to the deployment of the text model")
+    request = OpenAIRequestLibrary(
+        temperature=temperature, max_tokens=None, cache=cache, client=client, deployment=model, label=label,
+        max_prompt_tokens=max_prompt_tokens or get_max_prompt_tokens(TEXT_MODEL)
+    )
+    for message in messages:
+        request.add_plain_message(message["role"], message["content"])
+    if response_format is not None:
+        request.set_response_format(response_format)
+    return request
+
+
+def chat(client, model, messages, temperature, cache=None, label='chat', max_prompt_tokens=None):
+    """Sends a chat request, serving it from the response cache when possible."""
+    return build_request(client, model, messages, temperature, cache=cache, label=label,
+                         max_prompt_tokens=max_prompt_tokens).send()
+
+
+def get_unanswered_questions(client, model, answered_text, cache=None, max_prompt_tokens=None):
     """Uses GPT to identify unanswered questions from the initial responses."""
-    prompt = f"Given the answered text, extract all questions that remain unanswered or answered as N/A,preserving the original format of each question.:\n\n{answered_text}"
-    response = client.chat.completions.create(
-        model=model,
-        messages=[{"role": "system", "content": "You are a helpful assistant."},
-                  {"role": "user", "content": prompt}],
-        temperature=0
+    max_prompt_tokens = max_prompt_tokens or get_max_prompt_tokens(TEXT_MODEL)
+    prompt = PromptBuilder(system="You are a helpful assistant.")
+    prompt.add_prefix("Given the answered text, extract all questions that remain unanswered or answered as N/A,"
+                      "preserving the original format of each question.:")
+    prompt.add_content(answered_text).fit(max_prompt_tokens)
+    response = chat(
+        client,
+        model,
+        prompt.messages(),
+        temperature=0,
+        cache=cache,
+        label='unanswered_questions',
+        max_prompt_tokens=max_prompt_tokens,
     )
 
     print(response.choices[0].message.content)
@@ -39,7 +86,7 @@ def get_unanswered_questions(client, model, answered_text):
 
 
 
-def update_answered_questions(client, model, original_path, new_answers_text):
+def update_answered_questions(client, model, original_content, new_answers_text, cache=None, max_prompt_tokens=None):
     """
     Updates the original answered questions file with newly generated answers,
     effectively replacing questions that were previously unanswered.
@@ -47,26 +94,23 @@ def update_answered_questions(client, model, original_path, new_answers_text):
 
     """
 
-    # Example logic for updating the original content with new answers
-    # This part needs to be customized based on how your questions and answers are structured
-    original_content = read_file(original_path)
-
-    prompt = (
-        "Here are the existing answers to some questions:\n\n"
-        f"{original_content}\n\n"
-        "And here are new answers generated based on a recent conversation:\n\n"
-        f"{new_answers_text}\n\n"
-        "Please update the existing answers with the new information, replacing any unanswered "
-        "questions with their new answers and leaving already answered questions as they are."
+    # The original content holds the answer lines, see answers.format_answer_lines
+    prompt = PromptBuilder(system="You are a helpful assistant capable of merging document contents intelligently.")
+    prompt.add_prefix(
+        "Please update the existing answers below with the new answers generated based on a recent conversation, "
+        "replacing any unanswered questions with their new answers and leaving already answered questions as they are."
         "Keep the answer format as this example: \"Last name first in full>> Employee's Name (Last name first, in full): Smith, Jane\""
     )
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant capable of merging document contents intelligently."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.4
+    prompt.add_content(original_content, heading="Existing answers")
+    prompt.add_content(new_answers_text, heading="New answers")
+    response = chat(
+        client,
+        model,
+        prompt.messages(),
+        temperature=0.4,
+        cache=cache,
+        label='merge_answers',
+        max_prompt_tokens=max_prompt_tokens,
     )
 
     updated_content = response.choices[0].message.content
@@ -74,36 +118,224 @@ def update_answered_questions(client, model, original_path, new_answers_text):
 
     return updated_content
 
-def generate_answers_from_conversation(client, model, conversation_text, unanswered_questions):
+def answer_unanswered_questions(client, model, conversation_text, unanswered, cache=None, retriever=None,
+                                patient_id='default', max_prompt_tokens=None):
+    """
+    Answers only the given unanswered questions from the conversation in a single
+    call, and returns a dictionary of field names to answers. The model replies
+    with a JSON object keyed by field name, which is parsed and validated against
+    the question names while it streams in, so no free-text merging is needed.
+    When a Retriever is given and the conversation is longer than its threshold,
+    only the passages retrieved for the questions are sent. The instructions and
+    questions start the prompt and the conversation ends it; a conversation that
+    does not fit in max_prompt_tokens (by default the text model's budget)
+    beside them is split into parts, each answering the questions still
+    unanswered.
+    """
+    if not unanswered:
+        return {}
+    max_prompt_tokens = max_prompt_tokens or get_max_prompt_tokens(TEXT_MODEL)
+
+    if retriever is not None and retriever.should_retrieve(conversation_text):
+        queries = [f"{entry.name}: {entry.question}" for entry in unanswered]
+        conversation_text = retriever.get_contexts(conversation_text, [queries], owner=patient_id)[0]
+
+    questions = "\n".join(f"{entry.name}>> {entry.question}" for entry in unanswered)
+    prompt = PromptBuilder(system="You are a helpful assistant capable of understanding detailed medical conversations "
+                                  "and providing specific answers based on the context. You reply in JSON.")
+    prompt.add_prefix(
+        "Use the below conversation to answer the form questions. There are three types of questions:"
+        "1. Free field questions: These should be directly answered in the text."
+        "2. Checkbox questions: For checkbox questions, answer the question by showing the correct option(s). For single checkbox question, show me 'Yes' or 'No'"
+        "3. Multiple choice questions: For these, write out the selected answers."
+        "Each question is given as \"Field Name>> Question text\". "
+        "Reply with a JSON object that maps every Field Name to its answer as a string. "
+        "If the information needed to answer a question is not provided, use \"N/A\"."
+    )
+    prompt.add_prefix(f"Questions:\n{questions}")
+
+    budget = prompt.content_budget(max_prompt_tokens)
+    if budget <= 0:
+        raise PromptTooLong(f"{len(unanswered)} questions exceed {max_prompt_tokens} tokens")
+    if count_tokens(conversation_text) > budget:
+        parts = split_to_tokens(conversation_text, budget)
+        print(f"Answering from the conversation in {len(parts)} parts of {budget} tokens")
+        answers = {}
+        for part in parts:
+            remaining = [entry for entry in unanswered if NOT_AVAILABLE in answers.get(entry.name, NOT_AVAILABLE)]
+            if not remaining:
+                break
+            part_answers = answer_unanswered_questions(client, model, part, remaining, cache=cache,
+                                                       max_prompt_tokens=max_prompt_tokens)
+            for name, answer in part_answers.items():
+                if NOT_AVAILABLE in answers.get(name, NOT_AVAILABLE):
+                    answers[name] = answer
+        return answers
+
+    prompt.add_content(conversation_text, heading="Conversation")
+    request = build_request(
+        client,
+        model,
+        prompt.messages(),
+        temperature=0.4,
+        cache=cache,
+        response_format={"type": "json_object"},
+        label='conversation_answers',
+        max_prompt_tokens=max_prompt_tokens,
+    )
+    parser = StreamingAnswerParser(entry.name for entry in unanswered)
+    for text in request.stream():
+        parser.feed(text)
+    if parser.rejected:
+        print(f"Ignored answers for unknown fields: {list(parser.rejected)}")
+    return {name: answer_text(value) for name, value in parser.answers.items()}
+
+
+def complete_answers(client, model, answers, conversation_text, cache=None, retriever=None, patient_id='default',
+                     local_extraction=True, max_prompt_tokens=None):
+    """
+    Answers the still unanswered questions from the conversation in a single call
+    and returns the answers with the new ones merged in. With local_extraction,
+    the questions the conversation answers in a predictable format, such as
+    "Fax: 555-0100", are answered locally and left out of the call.
+    """
+    unanswered = find_unanswered(answers)
+    extracted = {}
+    if local_extraction:
+        extracted = pre_extract({entry.name: entry.question for entry in unanswered}, conversation_text,
+                                source='conversation')
+        unanswered = [entry for entry in unanswered if entry.name not in extracted]
+    generated_answers = answer_unanswered_questions(client, model, conversation_text, unanswered, cache=cache,
+                                                    retriever=retriever, patient_id=patient_id,
+                                                    max_prompt_tokens=max_prompt_tokens)
+    merged = merge_answers(answers, generated_answers)
+    for name, extraction in extracted.items():
+        merged[name] = AnswerLine(name, merged[name].question, extraction.value, source=extraction.describe())
+    return merged
+
+
+def fill_answers(pdf_path, answers, output_pdf_path, base_pdf_path=None):
+    """
+    Validates the answers against the fields of the pdf (parsed once per template)
+    and fills all of them in a single pass. The answers are written into a copy of
+    base_pdf_path, such as an already filled copy of the form, when it is given.
+    Returns the FillReport.
+    """
+    schema = load_form_schema(pdf_path)
+    temp_dict = {name: entry.answer for name, entry in answers.items()}
+    return fill_pdf(schema, base_pdf_path or pdf_path, output_pdf_path, temp_dict)
+
+
+def update_answers(client, model, state, conversation_text, cache=None, retriever=None, patient_id='default',
+                   local_extraction=True, overlap=DEFAULT_OVERLAP, max_prompt_tokens=None):
+    """
+    Answers the still unanswered questions of the AnswerState from only the part
+    of the conversation added since its last update (with `overlap` characters
+    before it as context), and records where each new answer came from. Returns
+    the names of the newly answered fields.
+    """
+    offset, delta = state.get_delta(conversation_text, overlap)
+    unanswered = {entry.name: entry for entry in find_unanswered(state.answers)}
+    changed = []
+    if delta and unanswered:
+        updated = complete_answers(client, model, unanswered, delta, cache=cache, retriever=retriever,
+                                   patient_id=patient_id, local_extraction=local_extraction,
+                                   max_prompt_tokens=max_prompt_tokens)
+        for name, entry in updated.items():
+            if entry.is_answered():
+                state.answers[name] = entry
+                state.spans[name] = [offset, len(conversation_text)]
+                changed.append(name)
+    state.advance(conversation_text)
+    return changed
+
+
+def fill_changed_answers(pdf_path, state, output_pdf_path):
+    """
+    Writes only the answers of the AnswerState that changed since its last fill
+    into the filled PDF, or fills every answer into a copy of the form when that
+    PDF is missing or was replaced. Returns the FillReport, or None when nothing
+    changed.
+    """
+    base_pdf_path = output_pdf_path
+    if state.output_hash is None or get_file_hash(output_pdf_path) != state.output_hash:
+        state.filled = {}
+        base_pdf_path = pdf_path
+    changed = state.get_unfilled()
+    if not changed and base_pdf_path == output_pdf_path:
+        return None
+
+    # Write next to the output and swap it in, since the output may be the input
+    temporary_path = f"{output_pdf_path}.tmp"
+    report = fill_answers(pdf_path, changed, temporary_path, base_pdf_path=base_pdf_path)
+    os.replace(temporary_path, output_pdf_path)
+    report.output_path = output_pdf_path
+    state.filled.update({name: entry.answer for name, entry in changed.items()})
+    state.output_hash = get_file_hash(output_pdf_path)
+    return report
+
+
+def create_client(http_client=None):
+    """Creates the Azure OpenAI client for the text model, optionally on a shared HTTP client."""
+    return AzureOpenAI(
+        azure_endpoint=os.getenv('GPT_TEXT_ENDPOINT'),
+        api_key=os.getenv('GPT_TEXT_API_KEY'),
+        max_retries=0,  # Retries are handled by OpenAIRequestLibrary
+        http_client=http_client,
+    )
+
+
+def generate_answers_from_conversation(client, model, conversation_text, unanswered_questions, cache=None,
+                                       local_extraction=True, max_prompt_tokens=None):
     """
     Generates answers for the unanswered questions based on the conversation provided.
     Reads the conversation and unanswered questions from their respective files, then
     generates answers using GPT and saves them to a specified file.
 
     """
-    # Load the conversation text
+    # Answer the questions the conversation states in a predictable format locally
+    questions = {}
+    for line in unanswered_questions.splitlines():
+        entry = parse_answer_line(line)
+        if entry is not None and entry.name:
+            questions[entry.name] = entry.question
+    extracted = pre_extract(questions, conversation_text, source='conversation') if local_extraction else {}
+    local_lines = [str(AnswerLine(name, questions[name], e.value)) for name, e in extracted.items()]
+    unanswered_questions = "\n".join(
+        line for line in unanswered_questions.splitlines()
+        if (entry := parse_answer_line(line)) is None or entry.name not in extracted
+    )
+    if extracted:
+        print(f"Answered {len(extracted)} questions locally: {', '.join(extracted)}")
+    if not unanswered_questions.strip():
+        return "\n".join(local_lines)
 
     # Generate the prompt for GPT based on the conversation and unanswered questions
-    prompt = (
-        f"Use the below information to fill in the form. There are three types of questions:"
-        f"1. Free field questions: These should be directly answered in the text."
-        f"2. Checkbox questions: For checkbox questions, answer the question by showing the correct option(s). For single checkbox question, show me 'Yes' or 'No'"
-        f"3. Multiple choice questions: For these, write out the selected answers."
-        f"If the information needed to answer a question is not provided, respond with \"N/A\" and ensure all original questions are included in your response."
-        f"Based on the above instructions and the following conversation, please answer the unanswered questions:\n\n"
-        f"Keep the answer format as this example: \"Last name first in full>> Employee's Name (Last name first, in full): Smith, Jane\""
-        f"Conversation:\n{conversation_text}\n\n"
-        f"Unanswered Questions:\n{unanswered_questions}"
+    prompt = PromptBuilder(system="You are a helpful assistant capable of understanding detailed medical conversations "
+                                  "and providing specific answers based on the context.")
+    prompt.add_prefix(
+        "Use the below information to fill in the form. There are three types of questions:"
+        "1. Free field questions: These should be directly answered in the text."
+        "2. Checkbox questions: For checkbox questions, answer the question by showing the correct option(s). For single checkbox question, show me 'Yes' or 'No'"
+        "3. Multiple choice questions: For these, write out the selected answers."
+        "If the information needed to answer a question is not provided, respond with \"N/A\" and ensure all original questions are included in your response."
+        "Based on the above instructions and the following conversation, please answer the unanswered questions:\n\n"
+        "Keep the answer format as this example: \"Last name first in full>> Employee's Name (Last name first, in full): Smith, Jane\""
     )
-    
+    prompt.add_prefix(f"Unanswered Questions:\n{unanswered_questions}")
+    # An oversized conversation keeps its latest turns
+    max_prompt_tokens = max_prompt_tokens or get_max_prompt_tokens(TEXT_MODEL)
+    prompt.add_content(conversation_text, heading="Conversation", keep='end').fit(max_prompt_tokens)
+
     # Use GPT to generate answers
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant capable of understanding detailed medical conversations and providing specific answers based on the context."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.4  # Adjust temperature if necessary to balance creativity and relevance
+    response = chat(
+        client,
+        model,
+        prompt.messages(),
+        temperature=0.4,  # Adjust temperature if necessary to balance creativity and relevance
+        cache=cache,
+        label='conversation_answers',
+        max_prompt_tokens=max_prompt_tokens,
     )
     
     # Extract the GPT-generated answers
@@ -118,7 +350,7 @@ def generate_answers_from_conversation(client, model, conversation_text, unanswe
 
     print(f"Answers generated")
 
-    return answered_text
+    return "\n".join([answered_text] + local_lines)
 
 
 
@@ -126,96 +358,147 @@ def main():
     """Main function to orchestrate the processing of answers based on conversations."""
     parser = argparse.ArgumentParser(description="Generate and integrate answers based on previous responses and conversations.")
     parser.add_argument('pdf_path', help='Path to the original pdf')
-    parser.add_argument('output_txt_path', help='Path to the file containing initial responses (output.txt)')
+    parser.add_argument('output_txt_path', help='Path to the file containing initial responses (output.json or output.txt)')
     parser.add_argument('conversation_txt_path', help='Path to the conversation text file (conversation.txt)')
-    parser.add_argument('final_output_path', help='Path to save the final integrated answers')
+    parser.add_argument('final_output_path', help='Path to save the final integrated answers (JSON if it ends with .json)')
+    parser.add_argument('--mode', choices=['single', 'three-step', 'incremental'], default='single',
+                        help='single: one structured call for the unanswered questions only; '
+                             'three-step: the original extract/generate/merge GPT calls; '
+                             'incremental: like single, but only from the conversation added since the last '
+                             'run, patching only the changed fields of the output pdf')
+    parser.add_argument('--state-path', default=None,
+                        help='Path to the answer state kept between incremental runs '
+                             '(default: the final output path with a .state.json extension)')
+    parser.add_argument('--output-pdf', default='answered.pdf', help='Path to save the filled pdf')
+    parser.add_argument('--metrics-output', default=None,
+                        help='Path to save per-call and per-stage metrics (OpenMetrics text if it ends with .prom, otherwise JSON)')
+    parser.add_argument('--cache-path', default=DEFAULT_CACHE_PATH, help='Path to the response cache database')
+    parser.add_argument('--no-cache', action='store_true', help='Always send requests to the API instead of using the cache')
+    parser.add_argument('--no-local-extraction', action='store_true',
+                        help='Send every unanswered question to GPT instead of first answering the ones the '
+                             'conversation states in a predictable format')
+    parser.add_argument('--embedder', choices=['azure', 'hashing'], default='azure',
+                        help='The embedding backend used to retrieve conversation passages')
+    parser.add_argument('--retrieval-top-k', type=int, default=DEFAULT_TOP_K,
+                        help='The number of conversation passages retrieved per question')
+    parser.add_argument('--retrieval-threshold', type=int, default=DEFAULT_THRESHOLD,
+                        help='Conversations longer than this many characters are answered from retrieved passages')
+    add_call_limit_arguments(parser)
+    parser.add_argument('--max-prompt-tokens', type=int, default=None,
+                        help='The most prompt tokens sent to the text model (default: '
+                             'AZURE_OPENAI_GPT_TURBO_MAX_PROMPT_TOKENS, else a 16k context budget)')
     args = parser.parse_args()
 
-    EMBEDDING_MODEL = 'text-embedding-ada-002'
-
     load_dotenv(override=True)
 
+    # Bound how long each model call may take. A single claim makes too few
+    # calls to learn the latencies hedging needs, see batch.py and service.py
+    apply_call_limits(args)
 
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv('GPT_TEXT_ENDPOINT'),
-        api_key=os.getenv('GPT_TEXT_API_KEY'),
-    )
-
-    model = os.getenv('AZURE_OPENAI_GPT_TURBO_DEPLOYMENT')
-
-    input_pdf_path = args.pdf_path
+    client = create_client()
+    cache = None if args.no_cache else ResponseCache(args.cache_path)
 
-    # Step 1: Extract unanswered questions from the initial responses
-    start_time = time.time()
-    answered_text = read_file(args.output_txt_path)
-    unanswered_questions = get_unanswered_questions(client, model, answered_text)
-    step1_time = time.time() - start_time
-    print(f"Time taken for extracting unanswered questions: {step1_time:.2f} seconds")
+    model = os.getenv(TEXT_MODEL)
+    max_prompt_tokens = args.max_prompt_tokens or get_max_prompt_tokens(TEXT_MODEL)
 
+    if args.embedder == 'hashing':
+        embedder = HashingEmbedder()
+    else:
+        embedder = AzureEmbedder(client, deployment=os.getenv('AZURE_OPENAI_EMBEDDING_DEPLOYMENT', EMBEDDING_MODEL))
+    retriever = Retriever(embedder, top_k=args.retrieval_top_k, threshold=args.retrieval_threshold)
 
-    # Step 2: Generate answers using the detailed conversation
-    start_time = time.time()
-    conversation_text = read_file(args.conversation_txt_path)
-    generated_answers = generate_answers_from_conversation(client, model,conversation_text, unanswered_questions)
-    print(generated_answers)
-    step2_time = time.time() - start_time
-    print(f"Time taken for generating answers: {step2_time:.2f} seconds")
-
-    # Step 3: Update answers and make final output
-    start_time = time.time()
-    new_answers = update_answered_questions(client, model, args.output_txt_path, generated_answers)
-    write_file(args.final_output_path, new_answers)
-    step3_time = time.time() - start_time
-    print(f"Time taken for updating answers: {step3_time:.2f} seconds")
-
+    input_pdf_path = args.pdf_path
+    state = None
+    state_path = args.state_path or f"{os.path.splitext(args.final_output_path)[0]}.state.json"
+
+    if args.mode == 'incremental':
+        # Answer the still unanswered questions from only the new part of the
+        # conversation, continuing from the state of the previous run
+        start_time = time.time()
+        state = AnswerState.load(state_path)
+        if state is not None and not state.is_for_answers(args.output_txt_path):
+            # The EMR answers were regenerated, so the conversation is answered anew
+            print(f"{args.output_txt_path} changed since the last run, starting over")
+            state = None
+        if state is None or not state.is_for_form(input_pdf_path):
+            state = AnswerState.start(input_pdf_path, load_answers(args.output_txt_path), args.output_txt_path)
+        conversation_text = read_file(args.conversation_txt_path)
+        new_characters = len(conversation_text) - state.conversation_offset
+        patient_id = os.path.splitext(os.path.basename(args.conversation_txt_path))[0]
+        changed = update_answers(client, model, state, conversation_text, cache=cache, retriever=retriever,
+                                 patient_id=patient_id, local_extraction=not args.no_local_extraction,
+                                 max_prompt_tokens=max_prompt_tokens)
+        answers = state.answers
+        save_answers(args.final_output_path, answers)
+        print(f"Answered {len(changed)} more questions from {max(0, new_characters)} new characters "
+              f"in {time.time() - start_time:.2f} seconds")
+    elif args.mode == 'single':
+        # Find the unanswered questions locally, answer only those in one call,
+        # then merge the answers locally
+        start_time = time.time()
+        answers = load_answers(args.output_txt_path)
+        conversation_text = read_file(args.conversation_txt_path)
+        patient_id = os.path.splitext(os.path.basename(args.conversation_txt_path))[0]
+        answers = complete_answers(client, model, answers, conversation_text, cache=cache, retriever=retriever,
+                                   patient_id=patient_id, local_extraction=not args.no_local_extraction,
+                                   max_prompt_tokens=max_prompt_tokens)
+        save_answers(args.final_output_path, answers)
+        print(f"Time taken for answering the unanswered questions: {time.time() - start_time:.2f} seconds")
+    else:
+        # Step 1: Extract unanswered questions from the initial responses
+        start_time = time.time()
+        original_answers = load_answers(args.output_txt_path)
+        answered_text = format_answer_lines(original_answers)
+        unanswered_questions = get_unanswered_questions(client, model, answered_text, cache=cache,
+                                                        max_prompt_tokens=max_prompt_tokens)
+        step1_time = time.time() - start_time
+        print(f"Time taken for extracting unanswered questions: {step1_time:.2f} seconds")
+
+        # Step 2: Generate answers using the detailed conversation
+        start_time = time.time()
+        conversation_text = read_file(args.conversation_txt_path)
+        generated_answers = generate_answers_from_conversation(client, model,conversation_text, unanswered_questions, cache=cache,
+                                                               local_extraction=not args.no_local_extraction,
+                                                               max_prompt_tokens=max_prompt_tokens)
+        print(generated_answers)
+        step2_time = time.time() - start_time
+        print(f"Time taken for generating answers: {step2_time:.2f} seconds")
+
+        # Step 3: Update answers and make final output
+        start_time = time.time()
+        new_answers = update_answered_questions(client, model, answered_text, generated_answers, cache=cache,
+                                                max_prompt_tokens=max_prompt_tokens)
+        # Recover the field answers from the merged text, e.g. from
+        # "- Last name first in full>> Employee's Name (Last name first, in full): Smith, Jane"
+        # Questions may hold colons, so each line is split after its known question
+        answers = parse_answer_lines(new_answers, {name: entry.question for name, entry in original_answers.items()})
+        save_answers(args.final_output_path, answers)
+        step3_time = time.time() - start_time
+        print(f"Time taken for updating answers: {step3_time:.2f} seconds")
 
     print(f"Final answers have been saved to {args.final_output_path}")
-
-    output_pdf_path = 'answered.pdf'
-    data_dict = {}
-    temp_dict = {}
-
-    # Open the file in read mode
-    with open(args.final_output_path, 'r') as file:
-        while True:
-            line = file.readline()
-            if not line:
-                break
-            line = re.sub(r'^[^a-zA-Z]+', '', line)
-            # to avoid the situation(incorrect format output from GPT): 
-            # "- Last name first in full>> Employee's Name (Last name first, in full): Smith, Jane",
-            # " // Last name first in full>> Employee's Name (Last name first, in full): Smith, Jane"
-            part_name = line.strip().split('>>')[0]
-            #get the question field name.
-            part_answer = line.strip().split(':')[-1].lstrip()
-            #get the question answer
-            temp_dict[part_name] = part_answer
-
-    #open the original pdf
-    with open(input_pdf_path, 'rb') as file:
-        reader = PyPDF2.PdfReader(file)
-        fields = reader.get_fields()
-        
-        
-        for field_name, field_info in fields.items():
-            field_type = field_info.get('/FT')
-            if field_name in temp_dict:
-                if field_type == '/Tx':  # Text field
-                    data_dict[field_name] = temp_dict[field_name]
-                elif field_type == '/Btn':  # Checkbox or radio button field
-                    #]options = get_field_options(reader, field_info)
-                    #if options is not None and temp_dict[field_name] in options:
-                    data_dict[field_name] = temp_dict[field_name]
-
- #parse the diction & fill the questions one by one to avoid errors
-    for key, value in data_dict.items():
-        if "N/A" not in value:
-            try:
-                fillpdfs.write_fillable_pdf(input_pdf_path, output_pdf_path, {key: value})
-                input_pdf_path = output_pdf_path
-            except Exception as e:
-                #print(f"Error filling field {key}: {str(e)}")
-                continue
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}")
+
+    if state is not None:
+        report = fill_changed_answers(input_pdf_path, state, args.output_pdf)
+        state.save(state_path)
+    else:
+        report = fill_answers(input_pdf_path, answers, args.output_pdf)
+    if report is None:
+        print(f"No answers changed, {args.output_pdf} is up to date")
+    else:
+        for field_name, reason in report.invalid.items():
+            print(f"Invalid answer for field {field_name}: {reason}")
+        if report.unknown:
+            print(f"Ignored {len(report.unknown)} lines that do not name a form field")
+        print(f"Filled {len(report.filled)} fields into {report.output_path} "
+              f"({len(report.skipped)} left blank, {len(report.invalid)} invalid)")
+
+    # Report where the time, tokens and bytes of this run went
+    print(get_recorder().summary_table())
+    if args.metrics_output:
+        get_recorder().save(args.metrics_output)
 
 
 if __name__ == '__main__':
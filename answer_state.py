@@ -0,0 +1,141 @@
+from dataclasses import dataclass, field
+
+import hashlib
+import json
+import logging
+import os
+
+from answers import AnswerLine, answers_to_dict, answer_text
+from files import write_atomic
+from form_schema import get_pdf_hash
+
+STATE_VERSION = 2  # Bump to discard states written by older code
+DEFAULT_OVERLAP = 1000  # Characters before the new text sent along as context
+
+
+def get_text_hash(text):
+    """Returns the content hash of a text."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def get_file_hash(path):
+    """Returns the content hash of a file, or None if it does not exist."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as file:
+        return get_pdf_hash(file.read())
+
+
+@dataclass
+class AnswerState:
+    """The answers, conversation offset and filled fields of one claim."""
+
+    form_hash: str  # The hash of the PDF form the answers belong to
+    answers: dict  # AnswerLines by field name
+    conversation_offset: int = 0  # Characters of the conversation answered from
+    conversation_hash: str = ''  # The hash of those characters
+    # Field name -> [start, end] of the conversation text its answer came from
+    spans: dict = field(default_factory=dict)
+    filled: dict = field(default_factory=dict)  # Field name -> answer in the PDF
+    output_hash: str | None = None  # The hash of the last filled PDF written
+    answers_hash: str | None = None  # The hash of the EMR answers file started from
+
+    @classmethod
+    def start(cls, form_path, answers, answers_path=None):
+        """Returns the state of a claim whose answers come from the EMR only."""
+        with open(form_path, 'rb') as file:
+            form_hash = get_pdf_hash(file.read())
+        answers_hash = get_file_hash(answers_path) if answers_path else None
+        return cls(form_hash, dict(answers), answers_hash=answers_hash)
+
+    def is_for_form(self, form_path):
+        """Returns whether the state belongs to the PDF form."""
+        return get_file_hash(form_path) == self.form_hash
+
+    def is_for_answers(self, answers_path):
+        """Returns whether the state started from the EMR answers file as it is now."""
+        return get_file_hash(answers_path) == self.answers_hash
+
+    def get_delta(self, conversation_text, overlap=DEFAULT_OVERLAP):
+        """Returns the (offset, text) of the conversation not yet answered from."""
+        offset = self.conversation_offset
+        if (
+            offset
+            and get_text_hash(conversation_text[:offset]) != self.conversation_hash
+        ):
+            logging.warning('The conversation was rewritten, answering from all of it')
+            offset = 0
+        if not conversation_text[offset:].strip():
+            return offset, ''
+
+        start = max(0, offset - overlap)
+        if start > 0:
+            line_start = conversation_text.find('\n', start, offset)
+            start = line_start + 1 if line_start != -1 else offset
+        return offset, conversation_text[start:]
+
+    def advance(self, conversation_text):
+        """Marks the whole conversation as answered from."""
+        self.conversation_offset = len(conversation_text)
+        self.conversation_hash = get_text_hash(conversation_text)
+
+    def get_unfilled(self):
+        """Returns the AnswerLines that differ from what the PDF holds."""
+        return {
+            name: entry
+            for name, entry in self.answers.items()
+            if self.filled.get(name) != entry.answer
+        }
+
+    def to_dict(self):
+        """Returns a JSON-serializable representation of the state."""
+        return {
+            'version': STATE_VERSION,
+            'form_hash': self.form_hash,
+            'answers': answers_to_dict(self.answers),
+            'conversation_offset': self.conversation_offset,
+            'conversation_hash': self.conversation_hash,
+            'spans': self.spans,
+            'filled': self.filled,
+            'output_hash': self.output_hash,
+            'answers_hash': self.answers_hash,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Returns the state of a representation made by to_dict()."""
+        answers = {
+            name: AnswerLine(
+                name,
+                entry.get('question', ''),
+                answer_text(entry.get('answer')),
+                entry.get('source'),
+            )
+            for name, entry in data['answers'].items()
+        }
+        return cls(
+            data['form_hash'],
+            answers,
+            data['conversation_offset'],
+            data['conversation_hash'],
+            data['spans'],
+            data['filled'],
+            data['output_hash'],
+            data['answers_hash'],
+        )
+
+    def save(self, path):
+        """Saves the state to a JSON file, atomically."""
+        data = json.dumps(self.to_dict(), indent=2, ensure_ascii=False)
+        write_atomic(path, data.encode('utf-8'))
+
+    @classmethod
+    def load(cls, path):
+        """Returns the state saved at the path, or None if it is missing or stale."""
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        if data.get('version') != STATE_VERSION:
+            return None
+        return cls.from_dict(data)
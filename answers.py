@@ -0,0 +1,269 @@
+from dataclasses import dataclass
+
+import json
+import re
+
+NOT_AVAILABLE = 'N/A'  # The answer given to questions that cannot be answered
+
+
+@dataclass
+class AnswerLine:
+    """A "Field Name>> Question text: answer" line of the answer files."""
+
+    name: str  # The PDF field name
+    question: str  # The question text, including any option list
+    answer: str
+    source: str | None = None  # Where a locally extracted answer was read from
+
+    def is_answered(self):
+        """Returns whether the line carries a real answer."""
+        return bool(self.answer.strip()) and NOT_AVAILABLE not in self.answer
+
+    def __str__(self):
+        return f'{self.name}>> {self.question}: {self.answer}'
+
+
+def _split_known_question(rest, questions):
+    """Returns the (question, answer) of rest after the longest known question."""
+    for question in sorted(filter(None, questions), key=len, reverse=True):
+        after = rest.strip()
+        if after.startswith(question.strip()):
+            after = after[len(question.strip()) :].lstrip()
+            if after.startswith(':'):
+                return question.strip(), after[1:]
+    return None
+
+
+def parse_answer_line(line, questions=None):
+    """
+    Returns the AnswerLine of a "Field Name>> Question text: answer" line, or
+    None when the line does not name a field. Questions and answers may both
+    hold colons, so the question is matched against the known question texts
+    by field name first, the longest one that the line starts with; otherwise
+    the answer follows the last colon that is followed by a space, which keeps
+    times such as "10:30 AM" whole:
+
+    >>> parse_answer_line('Time>> Appointment time: 10:30 AM')
+    AnswerLine(name='Time', question='Appointment time', answer='10:30 AM', source=None)
+    >>> parse_answer_line('Note>> Begun: (Day Month Year): Note: see 2', {'Note': 'Begun: (Day Month Year)'})
+    AnswerLine(name='Note', question='Begun: (Day Month Year)', answer='Note: see 2', source=None)
+    """
+    # Drop list markers the model sometimes prepends, such as "- " or "// "
+    line = re.sub(r'^[^a-zA-Z]+', '', line).strip()
+    if '>>' not in line:
+        return None
+
+    name, rest = line.split('>>', 1)
+    name = name.strip()
+    rest = rest.replace('\\:', ':')  # Unescape lines written by older versions
+    split = None
+    if questions:
+        split = _split_known_question(rest, [questions.get(name)]) or (
+            _split_known_question(rest, questions.values())
+        )
+    if split is None:
+        parts = re.split(r':(?=\s|$)', rest)
+        if len(parts) == 1:
+            parts = rest.rsplit(':', 1)
+        if len(parts) == 1:  # No answer separator at all
+            split = rest, ''
+        else:
+            split = ':'.join(parts[:-1]), parts[-1]
+    question, answer = split
+    return AnswerLine(name, question.strip(), answer.strip())
+
+
+def parse_question_line(line):
+    """
+    Returns the (field name, question text) of a "Field Name>> Question text"
+    line extracted from the form, or None when the line does not name a field.
+    """
+    line = re.sub(r'^[^a-zA-Z]+', '', line).strip()
+    if '>>' not in line:
+        return None
+    name, question = line.split('>>', 1)
+    return name.strip(), question.strip()
+
+
+def parse_answer_lines(text, questions=None):
+    """
+    Returns the AnswerLines of the text by field name, in order, splitting
+    each line after its known question text if `questions` maps names to them.
+    """
+    answers = {}
+    for line in text.splitlines():
+        entry = parse_answer_line(line, questions)
+        if entry is not None and entry.name:
+            answers[entry.name] = entry
+    return answers
+
+
+def format_answer_lines(answers):
+    """Returns the text of the AnswerLines, one per line."""
+    return '\n'.join(str(entry) for entry in answers.values())
+
+
+def find_unanswered(answers):
+    """Returns the AnswerLines that are still unanswered."""
+    return [entry for entry in answers.values() if not entry.is_answered()]
+
+
+def merge_answers(answers, new_answers):
+    """
+    Returns a copy of the AnswerLines with the new answers, a dictionary of
+    field names to answer text, filled into the questions still unanswered.
+    Questions that already have an answer are left as they are.
+    """
+    merged = {}
+    for name, entry in answers.items():
+        new_answer = str(new_answers.get(name, '')).strip()
+        if not entry.is_answered() and new_answer and NOT_AVAILABLE not in new_answer:
+            entry = AnswerLine(entry.name, entry.question, new_answer)
+        merged[name] = entry
+    return merged
+
+
+def answer_text(value):
+    """Returns the answer text of a JSON answer value."""
+    if value is None:
+        return NOT_AVAILABLE
+    if isinstance(value, list):  # Several checked options
+        return ', '.join(str(v) for v in value)
+    return str(value).strip()
+
+
+def answers_to_dict(answers):
+    """Returns the AnswerLines as a JSON-serializable dict keyed by field name."""
+    data = {}
+    for name, entry in answers.items():
+        data[name] = {'question': entry.question, 'answer': entry.answer}
+        if entry.source:
+            data[name]['source'] = entry.source
+    return data
+
+
+def save_answers(path, answers):
+    """
+    Saves the AnswerLines to a file: as a JSON object keyed by field name if
+    the path ends with .json, otherwise as "Name>> Question: answer" lines.
+    Only the JSON format keeps the source of locally extracted answers.
+    """
+    with open(path, 'w', encoding='utf-8') as file:
+        if path.endswith('.json'):
+            json.dump(answers_to_dict(answers), file, indent=2, ensure_ascii=False)
+        else:
+            file.write(format_answer_lines(answers))
+
+
+def load_answers(path, questions=None):
+    """
+    Returns the AnswerLines saved by save_answers(), in either format, with
+    text lines split after their known `questions` texts by field name.
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        text = file.read()
+    if not text.lstrip().startswith('{'):
+        return parse_answer_lines(text, questions)
+    return {
+        name: AnswerLine(
+            name,
+            entry.get('question', ''),
+            answer_text(entry.get('answer')),
+            entry.get('source'),
+        )
+        for name, entry in json.loads(text).items()
+    }
+
+
+class StreamingAnswerParser:
+    """
+    Incrementally parses a JSON object of field names to answers while the
+    model response streams in. Each entry is validated against the expected
+    field names as soon as its value is complete; entries for other names
+    are set aside in `rejected`. Surrounding prose or code fences are skipped.
+    """
+
+    def __init__(self, field_names=None):
+        self._field_names = set(field_names) if field_names is not None else None
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._position = None  # Where parsing resumes, None before the '{'
+        self._done = False  # Whether the closing '}' has been seen
+        self.answers = {}  # Accepted answers by field name, in arrival order
+        self.rejected = {}  # Answers for names that are not expected fields
+
+    def feed(self, text):
+        """Adds streamed text and returns the (name, answer) entries it completed."""
+        self._buffer += text
+        accepted = []
+        while not self._done:
+            entry = self._next_entry()
+            if entry is None:
+                break
+            name, value = entry
+            # Accept a wrapper object such as {"answers": {...}} as well
+            if isinstance(value, dict) and not self._is_expected(name):
+                items = value.items()
+            else:
+                items = [(name, value)]
+            for name, value in items:
+                if self._is_expected(name):
+                    self.answers[name] = value
+                    accepted.append((name, value))
+                else:
+                    self.rejected[name] = value
+        return accepted
+
+    def is_complete(self):
+        """Returns whether the whole JSON object has been parsed."""
+        return self._done
+
+    def _is_expected(self, name):
+        """Returns whether the name is one of the expected field names."""
+        return self._field_names is None or name in self._field_names
+
+    def _skip_whitespace(self, position, extra=''):
+        """Returns the first position from which the buffer is not blank."""
+        while position < len(self._buffer) and (
+            self._buffer[position].isspace() or self._buffer[position] in extra
+        ):
+            position += 1
+        return position
+
+    def _next_entry(self):
+        """Returns the next complete entry, or None if more text is needed."""
+        if self._position is None:
+            start = self._buffer.find('{')
+            if start == -1:
+                return None
+            self._position = start + 1
+
+        position = self._skip_whitespace(self._position, extra=',')
+        if position >= len(self._buffer):
+            return None
+        if self._buffer[position] == '}':
+            self._done = True
+            return None
+        if self._buffer[position] != '"':
+            self._done = True  # Not an object of answers, stop parsing
+            return None
+
+        try:
+            name, position = self._decoder.raw_decode(self._buffer, position)
+            position = self._skip_whitespace(position)
+            if position >= len(self._buffer):
+                return None
+            if self._buffer[position] != ':':
+                self._done = True
+                return None
+            position = self._skip_whitespace(position + 1)
+            value, end = self._decoder.raw_decode(self._buffer, position)
+        except json.JSONDecodeError:
+            return None  # The key or value is still incomplete
+
+        # A number or literal at the end of the buffer may still grow
+        if not isinstance(value, (str, list, dict)):
+            if self._skip_whitespace(end) >= len(self._buffer):
+                return None
+        self._position = end
+        return name, value
@@ -0,0 +1,108 @@
+from openai import APIConnectionError, APIStatusError
+
+import logging
+import random
+import threading
+import time
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}  # Retried in addition to any 5xx status
+DEFAULT_TIMEOUT = 120.0  # Seconds one attempt of a request may take
+DEFAULT_DEADLINE = 300.0  # Seconds a call may take, retries and hedges included
+DEFAULT_MAX_RETRIES = 5  # Retries for 429 and 5xx responses
+
+_call_limits = {'timeout': DEFAULT_TIMEOUT, 'deadline': DEFAULT_DEADLINE}
+_call_limits_lock = threading.Lock()
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a call has not completed within its deadline."""
+
+
+class RequestCancelled(Exception):
+    """Raised when a request is given up before it is sent, e.g. a lost hedge."""
+
+
+def set_call_limits(timeout=None, deadline=None):
+    """Sets the default per-attempt timeout and per-call deadline in seconds."""
+    with _call_limits_lock:
+        _call_limits['timeout'] = timeout or DEFAULT_TIMEOUT
+        _call_limits['deadline'] = deadline or DEFAULT_DEADLINE
+
+
+def get_call_limits():
+    """Returns the default (timeout, deadline) in seconds."""
+    with _call_limits_lock:
+        return _call_limits['timeout'], _call_limits['deadline']
+
+
+def send_with_retries(
+    create,
+    deadline_at,
+    counts,
+    timeout=None,
+    max_retries=DEFAULT_MAX_RETRIES,
+    rate_limiter=None,
+    cancel=None,
+):
+    """
+    Returns create(timeout=...), retrying rate-limited (429) and server-side
+    (5xx) failures with jittered exponential backoff, and counts the retries
+    in counts['retries'] and the requests sent in counts['requests']. Each
+    attempt is given the timeout, and no attempt or retry delay reaches past
+    deadline_at (a time.monotonic() value). Once the `cancel` event is set no
+    further request is sent and RequestCancelled is raised.
+    """
+    timeout = timeout or get_call_limits()[0]
+    while True:
+        _check_cancelled(cancel)
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+            _check_cancelled(cancel)
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded('The request ran past its deadline')
+        counts['requests'] = counts.get('requests', 0) + 1
+        try:
+            return create(timeout=min(timeout, remaining))
+        except (APIConnectionError, APIStatusError) as e:
+            if counts['retries'] >= max_retries or not _is_retryable(e):
+                raise
+            delay = _backoff_delay(counts['retries'], e)
+            if time.monotonic() + delay >= deadline_at:
+                raise DeadlineExceeded(
+                    f'The request failed ({e}) with no time left to retry'
+                ) from e
+            logging.debug(f'Request failed ({e}), retrying in {delay:.2f}s')
+            if cancel is None:
+                time.sleep(delay)
+            elif cancel.wait(delay):  # Woken early when cancelled
+                raise RequestCancelled('The request was cancelled') from e
+            counts['retries'] += 1
+
+
+def _check_cancelled(cancel):
+    """Raises RequestCancelled if the cancel event is set."""
+    if cancel is not None and cancel.is_set():
+        raise RequestCancelled('The request was cancelled')
+
+
+def _is_retryable(error):
+    """Returns whether a failed request is worth retrying."""
+    if isinstance(error, APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return True  # Connection errors and timeouts
+
+
+def _backoff_delay(attempt, error, base=1.0, cap=60.0):
+    """
+    Returns the delay before the next retry using "full jitter" exponential
+    backoff, never shorter than the server's Retry-After hint.
+    """
+    delay = random.uniform(0, min(cap, base * 2**attempt))
+    response = getattr(error, 'response', None)
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get('retry-after', 0)))
+        except ValueError:
+            pass  # Retry-After may also be an HTTP date, which we ignore
+    return delay
@@ -0,0 +1,266 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from answers import save_answers
+from cache import DEFAULT_CACHE_PATH, ResponseCache
+from metrics import get_recorder
+from render_store import DEFAULT_RENDER_DIRECTORY, RenderStore
+from service import FormFiller
+from vision import DEFAULT_CONCURRENCY, add_call_limit_arguments, apply_call_limits
+
+DEFAULT_WORKERS = 4  # The default number of claims processed at once
+MANIFEST_COLUMNS = ('form', 'emr', 'conversation', 'output')
+
+
+def parse_arguments():
+    """
+    Returns an argparse Namespace object that contains the parsing result of
+    the command-line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description='Fills a batch of forms from their EMRs and conversations.'
+    )
+    parser.add_argument(
+        'manifest',
+        help='A CSV or JSONL file of jobs with form, emr, conversation and '
+        'output (the filled PDF path) columns, and optional id and patient '
+        'columns. Retrieval indexes are kept per patient, by default the EMR '
+        'file name.',
+    )
+    parser.add_argument(
+        '-r',
+        '--results',
+        default='results.jsonl',
+        help='The JSONL file the status of each job is appended to. Jobs that '
+        'already succeeded in it are skipped, so a restarted run resumes.',
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help='The number of jobs processed at once.',
+    )
+    parser.add_argument(
+        '-c',
+        '--concurrency',
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help='The maximum number of page requests in flight per job.',
+    )
+    parser.add_argument(
+        '--requests-per-minute',
+        type=float,
+        default=None,
+        help='The vision request budget per minute shared by all jobs.',
+    )
+    add_call_limit_arguments(parser, hedging=True)
+    parser.add_argument(
+        '--cache-path',
+        default=DEFAULT_CACHE_PATH,
+        help='The path to the response cache database.',
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Always sends requests to the API instead of using the cache.',
+    )
+    parser.add_argument(
+        '--render-store-path',
+        default=DEFAULT_RENDER_DIRECTORY,
+        help='The directory of the rendered and encoded form pages shared '
+        'between workers and runs.',
+    )
+    parser.add_argument(
+        '--no-render-store',
+        action='store_true',
+        help='Renders the form pages in memory instead.',
+    )
+    parser.add_argument(
+        '--metrics-output',
+        default=None,
+        help='Saves per-call and per-stage metrics of the whole batch to this '
+        'file (OpenMetrics text if it ends with .prom, otherwise JSON).',
+    )
+    parser.add_argument(
+        '-v', '--verbose', action='store_true', help='Prints debugging output.'
+    )
+    return parser.parse_args()
+
+
+def get_job_id(job):
+    """Returns the id of a job, derived from its paths unless given."""
+    if job.get('id'):
+        return str(job['id'])
+    key = '\0'.join(job[column] for column in MANIFEST_COLUMNS)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+def get_file_stem(path):
+    """Returns the file name of a path without its directory and extension."""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def read_manifest(path):
+    """Returns the jobs of a CSV or JSONL manifest file."""
+    with open(path, 'r', encoding='utf-8', newline='') as file:
+        if path.endswith('.jsonl'):
+            jobs = [json.loads(line) for line in file if line.strip()]
+        else:
+            jobs = list(csv.DictReader(file))
+
+    for number, job in enumerate(jobs, start=1):
+        missing = [column for column in MANIFEST_COLUMNS if not job.get(column)]
+        if missing:
+            raise ValueError(f'Job {number} in {path} is missing {missing}')
+        job['id'] = get_job_id(job)
+    return jobs
+
+
+def read_completed_jobs(path):
+    """Returns the ids of the jobs that already succeeded in a results file."""
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # A line cut short by an interrupted run
+            if result.get('status') == 'ok':
+                completed.add(result['id'])
+    return completed
+
+
+class BatchRunner:
+    """
+    Runs claims through a FormFiller on a thread pool. All workers share its
+    Azure OpenAI clients and connection pool, the response cache, the request
+    budget, the parsed and rendered form templates and the render store.
+    """
+
+    def __init__(
+        self,
+        results_path,
+        workers=DEFAULT_WORKERS,
+        concurrency=DEFAULT_CONCURRENCY,
+        requests_per_minute=None,
+        cache=None,
+        render_store=None,
+    ):
+        self._results_path = results_path
+        self._workers = workers
+        self._results_lock = threading.Lock()
+        # The connection pool is sized for every request in flight
+        self._filler = FormFiller(
+            cache=cache,
+            concurrency=concurrency,
+            requests_per_minute=requests_per_minute,
+            max_connections=workers * max(1, concurrency),
+            render_store=render_store,
+        )
+
+    def run(self, jobs):
+        """Runs the jobs not yet completed and returns the number that failed."""
+        completed = read_completed_jobs(self._results_path)
+        pending = [job for job in jobs if job['id'] not in completed]
+        logging.info(
+            f'{len(pending)} jobs to run, {len(jobs) - len(pending)} already done'
+        )
+
+        failures = 0
+        with ThreadPoolExecutor(max_workers=max(1, self._workers)) as executor:
+            futures = [executor.submit(self._run_job, job) for job in pending]
+            for future in as_completed(futures):
+                failures += future.result()['status'] != 'ok'
+        return failures
+
+    def _run_job(self, job):
+        """Processes one claim and records its status in the results file."""
+        start_time = time.time()
+        result = {'id': job['id'], 'output': job['output']}
+        try:
+            with open(job['emr'], 'r') as file:
+                emr_database = file.read()
+            with open(job['conversation'], 'r', encoding='utf-8') as file:
+                conversation_text = file.read()
+
+            filled = self._filler.fill(
+                job['form'],
+                emr_database,
+                conversation_text,
+                output=job['output'],
+                patient_id=job.get('patient') or get_file_stem(job['emr']),
+            )
+            save_answers(f'{os.path.splitext(job["output"])[0]}.json', filled.answers)
+            report = filled.report
+
+            result['status'] = 'ok'
+            result['filled'] = len(report.filled)
+            result['invalid'] = report.invalid
+        except Exception as e:
+            logging.exception(f'Job {job["id"]} failed')
+            result['status'] = 'error'
+            result['error'] = f'{type(e).__name__}: {e}'
+
+        result['seconds'] = round(time.time() - start_time, 3)
+        result['finished_at'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self._record(result)
+        return result
+
+    def _record(self, result):
+        """Appends a job result to the results file."""
+        with self._results_lock:
+            with open(self._results_path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(result) + '\n')
+                file.flush()
+
+
+def main():
+    """
+    The entry point of the script.
+    """
+    args = parse_arguments()
+    logging.basicConfig(
+        format='[%(filename)s:%(lineno)d:%(funcName)s()] %(message)s',
+        level=logging.DEBUG if args.verbose else logging.INFO,
+    )
+
+    # The latencies of every job in the batch set the hedge threshold
+    apply_call_limits(args)
+
+    cache = None if args.no_cache else ResponseCache(args.cache_path)
+    render_store = None if args.no_render_store else RenderStore(args.render_store_path)
+    runner = BatchRunner(
+        args.results,
+        workers=args.workers,
+        concurrency=args.concurrency,
+        requests_per_minute=args.requests_per_minute,
+        cache=cache,
+        render_store=render_store,
+    )
+    failures = runner.run(read_manifest(args.manifest))
+
+    if cache is not None:
+        logging.info(f'Response cache: {cache.stats()}')
+    logging.info(f'Batch metrics:\n{get_recorder().summary_table()}')
+    if args.metrics_output:
+        get_recorder().save(args.metrics_output)
+    if failures:
+        logging.error(f'{failures} jobs failed, see {args.results}')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    #   Example usage:
+    #       python batch.py claims.csv -r results.jsonl -w 8
+    main()
@@ -0,0 +1,130 @@
+import argparse
+import logging
+import time
+
+from cache import ResponseCache
+from form_schema import load_form_schema
+from image_encoding import ImageOptimizer
+from vision import PDFEncoder, init, parse_pdf
+
+# The encoder settings compared by the benchmark, from the plain full-size
+# JPEG down to the most aggressive payload reduction
+SETTINGS = {
+    'baseline': {},
+    'long-edge-1600': {'max_long_edge': 1600},
+    'gray-1600': {'max_long_edge': 1600, 'grayscale': True},
+    'gray-1024-cropped': {
+        'max_long_edge': 1024,
+        'grayscale': True,
+        'crop_margins': True,
+    },
+    'gray-1024-150kb': {
+        'max_long_edge': 1024,
+        'grayscale': True,
+        'crop_margins': True,
+        'max_bytes': 150 * 1024,
+        'prefer_png_for_line_art': True,
+    },
+    'gray-768-tokens': {
+        'grayscale': True,
+        'crop_margins': True,
+        'max_image_tokens': 600,
+        'prefer_png_for_line_art': True,
+    },
+}
+
+
+def parse_arguments():
+    """Returns the parsed command-line arguments of the benchmark."""
+    parser = argparse.ArgumentParser(
+        description='Compares extraction accuracy against vision payload size.'
+    )
+    parser.add_argument(
+        '-i',
+        '--input-form',
+        default='input/form/disability.pdf',
+        help='The path to the PDF form to extract.',
+    )
+    parser.add_argument(
+        '-s',
+        '--settings',
+        nargs='+',
+        choices=list(SETTINGS),
+        default=list(SETTINGS),
+        help='The encoder settings to compare.',
+    )
+    parser.add_argument(
+        '--cache-path',
+        default=None,
+        help='Reuses responses from this cache instead of always calling the API.',
+    )
+    return parser.parse_args()
+
+
+def get_extracted_names(parse_result):
+    """Returns the set of field names matched by the extracted questions."""
+    names = set()
+    for page in parse_result:
+        for line in page.splitlines():
+            if '>>' in line:
+                names.add(line.split('>>')[0].strip(' -*"\''))
+    return names
+
+
+def run(file_path, name, optimizer_options, cache=None):
+    """Returns the payload and accuracy figures of one encoder setting."""
+    optimizer = ImageOptimizer(**optimizer_options)
+
+    # Measure the payload locally, page by page
+    pdf = PDFEncoder(file_path, optimizer=optimizer)
+    for page_number in range(pdf.get_page_count()):
+        pdf.get_encoded_image(page_number)
+    stats = pdf.get_encoding_stats().values()
+
+    start_time = time.time()
+    # Every page goes to the vision model, which is what is being measured
+    parse_result = parse_pdf(
+        file_path, cache=cache, optimizer=optimizer, text_layer=False
+    )
+    elapsed = time.time() - start_time
+
+    expected = set(load_form_schema(file_path).field_names())
+    extracted = get_extracted_names(parse_result)
+    matched = expected & extracted
+    return {
+        'setting': name,
+        'bytes': sum(s['bytes'] for s in stats),
+        'tokens': sum(s['estimated_tokens'] for s in stats),
+        'recall': len(matched) / len(expected) if expected else 0.0,
+        'precision': len(matched) / len(extracted) if extracted else 0.0,
+        'seconds': elapsed,
+    }
+
+
+def main():
+    """
+    Extracts the form once per encoder setting and prints the payload size
+    next to how many of the form's field names the extraction recovered.
+    """
+    args = parse_arguments()
+    logging.basicConfig(level=logging.WARNING)
+    init()
+
+    cache = ResponseCache(args.cache_path) if args.cache_path else None
+
+    print(
+        f'{"setting":<20} {"bytes":>10} {"tokens":>8} '
+        f'{"recall":>7} {"precision":>9} {"seconds":>8}'
+    )
+    for name in args.settings:
+        row = run(args.input_form, name, SETTINGS[name], cache=cache)
+        print(
+            f'{row["setting"]:<20} {row["bytes"]:>10} {row["tokens"]:>8} '
+            f'{row["recall"]:>7.2%} {row["precision"]:>9.2%} {row["seconds"]:>8.1f}'
+        )
+
+
+if __name__ == '__main__':
+    #   Example usage:
+    #       python -m benchmarks.encoding -i input/form/disability.pdf
+    main()
@@ -0,0 +1,405 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+
+import argparse
+import base64
+import io
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+
+from cache import DEFAULT_CACHE_PATH, ResponseCache
+from image_encoding import estimate_image_tokens
+from retrieval import HashingEmbedder
+
+DEFAULT_PORT = 8765
+EMBEDDING_DIMENSIONS = 1536  # The size of text-embedding-ada-002 vectors
+CHARS_PER_TOKEN = 4  # A rough token estimate for English text
+
+
+class LatencyModel:
+    """
+    A log-normal latency distribution for a model call: time to first token
+    around `median` seconds, then `per_token` seconds per completion token.
+    """
+
+    def __init__(self, median=0.8, sigma=0.4, per_token=0.01, seed=None):
+        self.median = median
+        self.sigma = sigma  # The spread of the log-normal distribution
+        self.per_token = per_token
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def time_to_first_token(self):
+        """Returns a random time to first token in seconds."""
+        if self.median <= 0:
+            return 0.0
+        with self._lock:
+            return self._random.lognormvariate(math.log(self.median), self.sigma)
+
+    def chance(self, probability):
+        """Returns True with the given probability."""
+        with self._lock:
+            return self._random.random() < probability
+
+
+def estimate_text_tokens(text):
+    """Returns the estimated number of tokens of a text."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def estimate_prompt_tokens(messages):
+    """Returns the estimated prompt tokens of messages, images included."""
+    tokens = 0
+    for message in messages:
+        content = message.get('content') or ''
+        if isinstance(content, str):
+            tokens += estimate_text_tokens(content)
+            continue
+        for part in content:
+            if part.get('type') == 'text':
+                tokens += estimate_text_tokens(part['text'])
+            elif part.get('type') == 'image_url':
+                url = part['image_url']['url']
+                data = base64.b64decode(url.split(',', 1)[-1])
+                try:
+                    with Image.open(io.BytesIO(data)) as image:
+                        tokens += estimate_image_tokens(*image.size)
+                except OSError:
+                    tokens += estimate_image_tokens(1700, 2200)  # A letter page
+    return tokens
+
+
+def synthesize_content(request_body):
+    """
+    Returns a stand-in response for a request that was never recorded: JSON
+    requests get every "Name>> Question" field of the prompt answered with
+    N/A, other requests get the question lines of the prompt back.
+    """
+    texts = []
+    for message in request_body.get('messages', []):
+        content = message.get('content') or ''
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(part['text'] for part in content if part.get('type') == 'text')
+    # Field lines, not instructions such as 'given as "Field Name>> Question"'
+    lines = re.findall(r'^[ \t-]*([^\n>"]{1,80}?)>>[^\n]*$', '\n'.join(texts), re.M)
+    if (request_body.get('response_format') or {}).get('type') == 'json_object':
+        return json.dumps({'answers': {name.strip(): 'N/A' for name in lines}})
+    return '\n'.join(f'{name.strip()}>> N/A' for name in lines)
+
+
+class MockAzureOpenAI:
+    """
+    The state of a stand-in Azure OpenAI endpoint: recorded responses are
+    replayed from a ResponseCache by the same key the clients cache them
+    under, with simulated latency, injected 429 responses and estimated
+    token counts. Requests and bytes received are counted for benchmarks.
+    """
+
+    def __init__(
+        self,
+        cache=None,
+        latency=None,
+        error_rate=0.0,
+        retry_after=1.0,
+        embedding_dimensions=EMBEDDING_DIMENSIONS,
+    ):
+        self.cache = cache  # A ResponseCache of recorded responses, or None
+        self.latency = latency or LatencyModel()
+        self.error_rate = error_rate  # The share of requests answered with 429
+        self.retry_after = retry_after  # The Retry-After of injected 429s
+        self._embedder = HashingEmbedder(embedding_dimensions)
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Resets the request counters."""
+        with self._lock:
+            self._stats = {
+                'requests': 0,
+                'replayed': 0,
+                'synthesized': 0,
+                'rate_limited': 0,
+                'embeddings': 0,
+                'bytes_received': 0,
+                'bytes_sent': 0,
+                'prompt_tokens': 0,
+                'completion_tokens': 0,
+            }
+
+    def stats(self):
+        """Returns a copy of the request counters."""
+        with self._lock:
+            return dict(self._stats)
+
+    def count(self, **increments):
+        """Adds the increments to the request counters."""
+        with self._lock:
+            for name, value in increments.items():
+                self._stats[name] += value
+
+    def get_content(self, request_body):
+        """Returns the recorded response text of a chat request, or a stand-in."""
+        if self.cache is not None:
+            # The clients cache a request before `stream` is added to it
+            recorded_body = {k: v for k, v in request_body.items() if k != 'stream'}
+            cached = self.cache.get(ResponseCache.make_key(recorded_body))
+            if cached is not None:
+                self.count(replayed=1)
+                return cached['choices'][0]['message']['content'] or ''
+        self.count(synthesized=1)
+        return synthesize_content(request_body)
+
+    def embed(self, texts):
+        """Returns deterministic embeddings of the texts."""
+        self.count(embeddings=1)
+        return self._embedder.embed(texts).tolist()
+
+
+class MockAzureOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Serves the chat completions (streamed or not) and embeddings routes of
+    the Azure OpenAI API from the server's MockAzureOpenAI.
+    """
+
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real endpoint
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send_json(200, self.server.mock.stats())
+        else:
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+
+    def do_POST(self):
+        mock = self.server.mock
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        mock.count(requests=1, bytes_received=len(body))
+        request_body = json.loads(body)
+        path = self.path.split('?', 1)[0]
+
+        if mock.error_rate and mock.latency.chance(mock.error_rate):
+            mock.count(rate_limited=1)
+            error = {'error': {'code': '429', 'message': 'Rate limit is exceeded.'}}
+            self._send_json(429, error, {'Retry-After': str(mock.retry_after)})
+        elif path.endswith('/embeddings'):
+            self._send_embeddings(request_body)
+        elif path.endswith('/chat/completions'):
+            self._send_completion(request_body)
+        else:
+            self._send_json(404, {'error': {'message': f'Unknown path {path}'}})
+
+    def _send_embeddings(self, request_body):
+        """Responds to an embeddings request."""
+        texts = request_body['input']
+        texts = [texts] if isinstance(texts, str) else texts
+        tokens = sum(estimate_text_tokens(text) for text in texts)
+        self.server.mock.count(prompt_tokens=tokens)
+        self._send_json(
+            200,
+            {
+                'object': 'list',
+                'model': request_body.get('model'),
+                'data': [
+                    {'object': 'embedding', 'index': i, 'embedding': vector}
+                    for i, vector in enumerate(self.server.mock.embed(texts))
+                ],
+                'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+            },
+        )
+
+    def _send_completion(self, request_body):
+        """Responds to a chat completions request after the simulated latency."""
+        mock = self.server.mock
+        content = mock.get_content(request_body)
+        prompt_tokens = estimate_prompt_tokens(request_body.get('messages', []))
+        completion_tokens = estimate_text_tokens(content)
+        mock.count(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        }
+        response_id = f'mock-{time.time_ns()}'
+        created = int(time.time())
+        model = request_body.get('model')
+
+        time.sleep(mock.latency.time_to_first_token())
+        if not request_body.get('stream'):
+            time.sleep(mock.latency.per_token * completion_tokens)
+            self._send_json(
+                200,
+                {
+                    'id': response_id,
+                    'object': 'chat.completion',
+                    'created': created,
+                    'model': model,
+                    'choices': [
+                        {
+                            'index': 0,
+                            'finish_reason': 'stop',
+                            'message': {'role': 'assistant', 'content': content},
+                        }
+                    ],
+                    'usage': usage,
+                },
+            )
+            return
+
+        # Server-sent events, a few tokens per chunk
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        chunk_chars = 4 * CHARS_PER_TOKEN
+        pieces = [
+            content[i : i + chunk_chars] for i in range(0, len(content), chunk_chars)
+        ]
+        for index, piece in enumerate(pieces + [None]):
+            delta = {'content': piece} if piece is not None else {}
+            if index == 0:
+                delta['role'] = 'assistant'
+            chunk = {
+                'id': response_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': model,
+                'choices': [
+                    {
+                        'index': 0,
+                        'delta': delta,
+                        'finish_reason': None if piece is not None else 'stop',
+                    }
+                ],
+            }
+            self._write_chunk(f'data: {json.dumps(chunk)}\n\n')
+            if piece is not None:
+                time.sleep(mock.latency.per_token * estimate_text_tokens(piece))
+        self._write_chunk('data: [DONE]\n\n')
+        self._write_chunk('')
+
+    def _write_chunk(self, text):
+        """Writes one chunk of a chunked response; an empty one ends it."""
+        data = text.encode('utf-8')
+        self.wfile.write(f'{len(data):X}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+        self.server.mock.count(bytes_sent=len(data))
+
+    def _send_json(self, status, data, headers=None):
+        """Sends a JSON response."""
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.mock.count(bytes_sent=len(body))
+
+    def log_message(self, format, *args):
+        logging.debug(f'{self.address_string()} {format % args}')
+
+
+def start_server(mock, host='127.0.0.1', port=0):
+    """
+    Serves the MockAzureOpenAI on a background thread and returns the
+    server. Its endpoint is f'http://{host}:{server.server_port}'.
+    """
+    server = ThreadingHTTPServer((host, port), MockAzureOpenAIHandler)
+    server.daemon_threads = True
+    server.mock = mock
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_arguments():
+    """Returns the parsed command-line arguments of the mock server."""
+    parser = argparse.ArgumentParser(
+        description='Serves recorded Azure OpenAI responses with simulated '
+        'latency and rate limiting.'
+    )
+    parser.add_argument('--host', default='127.0.0.1', help='The address to bind.')
+    parser.add_argument(
+        '--port', type=int, default=DEFAULT_PORT, help='The port to listen on.'
+    )
+    parser.add_argument(
+        '--cache-path',
+        default=DEFAULT_CACHE_PATH,
+        help='The response cache whose recorded responses are replayed.',
+    )
+    parser.add_argument(
+        '--latency-median',
+        type=float,
+        default=0.8,
+        help='The median time to first token in seconds.',
+    )
+    parser.add_argument(
+        '--latency-sigma',
+        type=float,
+        default=0.4,
+        help='The spread of the log-normal time to first token.',
+    )
+    parser.add_argument(
+        '--per-token',
+        type=float,
+        default=0.01,
+        help='The seconds taken per completion token.',
+    )
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0.0,
+        help='The share of requests answered with 429 Too Many Requests.',
+    )
+    parser.add_argument(
+        '--retry-after',
+        type=float,
+        default=1.0,
+        help='The Retry-After seconds of injected 429 responses.',
+    )
+    parser.add_argument('--seed', type=int, default=None, help='The random seed.')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true', help='Prints debugging output.'
+    )
+    return parser.parse_args()
+
+
+def main():
+    """
+    Serves the mock endpoint until interrupted. Point the clients at it with
+    AZURE_OPENAI_ENDPOINT (and GPT_TEXT_ENDPOINT) set to its address.
+    """
+    args = parse_arguments()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    mock = MockAzureOpenAI(
+        cache=ResponseCache(args.cache_path),
+        latency=LatencyModel(
+            args.latency_median, args.latency_sigma, args.per_token, args.seed
+        ),
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), MockAzureOpenAIHandler)
+    server.mock = mock
+    logging.info(f'Serving on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info(f'Requests: {mock.stats()}')
+
+
+if __name__ == '__main__':
+    #   Example usage:
+    #       python -m benchmarks.mock_server --port 8765 --error-rate 0.05
+    main()
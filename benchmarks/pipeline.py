@@ -0,0 +1,322 @@
+from concurrent.futures import ThreadPoolExecutor
+from openai import AzureOpenAI
+from pdfrw import PdfArray, PdfDict, PdfReader, PdfString, PdfWriter
+
+import argparse
+import io
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from answer import complete_answers, fill_answers
+from benchmarks.mock_server import LatencyModel, MockAzureOpenAI, start_server
+from cache import DEFAULT_CACHE_PATH, ResponseCache
+from metrics import get_recorder, percentile
+from retrieval import AzureEmbedder, Retriever
+from vision import OpenAIRequestLibrary, init, parse_and_predict
+
+API_VERSION = '2024-02-01'
+
+
+def parse_arguments():
+    """Returns the parsed command-line arguments of the benchmark."""
+    parser = argparse.ArgumentParser(
+        description='Runs the whole pipeline against a mock Azure OpenAI '
+        'endpoint at varying page counts and concurrency.'
+    )
+    parser.add_argument(
+        '-i',
+        '--input-form',
+        default='input/form/disability.pdf',
+        help='The PDF form the benchmark forms are built from.',
+    )
+    parser.add_argument(
+        '-e', '--emr', default='input/emr/sample_emr.txt', help='The EMR file.'
+    )
+    parser.add_argument(
+        '--conversation',
+        default='input/emr/conversation.txt',
+        help='The conversation file.',
+    )
+    parser.add_argument(
+        '-p',
+        '--pages',
+        type=int,
+        nargs='+',
+        default=[3, 6, 12],
+        help='The page counts to benchmark. Longer forms repeat the pages of '
+        'the input form with renamed fields.',
+    )
+    parser.add_argument(
+        '-c',
+        '--concurrency',
+        type=int,
+        nargs='+',
+        default=[1, 4, 8],
+        help='The page request concurrencies to benchmark.',
+    )
+    parser.add_argument(
+        '-n', '--claims', type=int, default=5, help='The claims run per setting.'
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=1,
+        help='The number of claims run at once.',
+    )
+    parser.add_argument(
+        '--no-text-layer',
+        action='store_true',
+        help='Sends every page to the vision model.',
+    )
+    parser.add_argument(
+        '--replay-cache',
+        default=DEFAULT_CACHE_PATH,
+        help='The response cache whose recorded responses the mock replays. '
+        'Requests that were never recorded get stand-in responses.',
+    )
+    parser.add_argument(
+        '--latency-median',
+        type=float,
+        default=0.8,
+        help='The median time to first token of the mock in seconds.',
+    )
+    parser.add_argument(
+        '--latency-sigma',
+        type=float,
+        default=0.4,
+        help='The spread of the log-normal time to first token.',
+    )
+    parser.add_argument(
+        '--per-token',
+        type=float,
+        default=0.01,
+        help='The seconds the mock takes per completion token.',
+    )
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0.0,
+        help='The share of requests the mock answers with 429.',
+    )
+    parser.add_argument('--seed', type=int, default=0, help='The random seed.')
+    parser.add_argument(
+        '-o', '--output', default=None, help='Saves the results to this JSON file.'
+    )
+    return parser.parse_args()
+
+
+def _get_top_field(annotation):
+    """Returns the top-level field dictionary of a widget annotation."""
+    field_object = annotation if annotation.T is not None else annotation.Parent
+    while field_object.Parent is not None:
+        field_object = field_object.Parent
+    return field_object
+
+
+def build_form(template_path, page_count, output_path):
+    """
+    Writes a form of page_count pages to output_path, repeating the pages of
+    the template. The fields of the second and later copies are renamed,
+    e.g. "Date (2)", so that every field name stays unique.
+    """
+    pages = []
+    fields = {}  # Top-level field dictionaries by object id, in page order
+    acro_form = None
+    copy = 0
+    while len(pages) < page_count:
+        template = PdfReader(template_path)  # Fresh objects for every copy
+        acro_form = acro_form or template.Root.AcroForm
+        copy += 1
+        for page in template.pages[: page_count - len(pages)]:
+            for annotation in page.Annots or []:
+                if annotation.Subtype != '/Widget':
+                    continue
+                field_object = _get_top_field(annotation)
+                if id(field_object) in fields:
+                    continue
+                if copy > 1:
+                    name = field_object.T.to_unicode()
+                    field_object.T = PdfString.encode(f'{name} ({copy})')
+                fields[id(field_object)] = field_object
+            pages.append(page)
+
+    writer = PdfWriter(output_path)
+    writer.addpages(pages)
+    if acro_form is not None:
+        writer.trailer.Root.AcroForm = PdfDict(acro_form)
+        writer.trailer.Root.AcroForm.Fields = PdfArray(list(fields.values()))
+    writer.write()
+
+
+def get_peak_rss():
+    """Returns the peak resident set size of the process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # KiB on Linux
+
+
+def run_claim(form_path, emr_text, conversation_text, text_client, options):
+    """Runs one claim through the vision, answer and fill steps in memory."""
+    start_time = time.perf_counter()
+    _, answers = parse_and_predict(
+        form_path,
+        emr_text,
+        retriever=options['retriever'],
+        concurrency=options['concurrency'],
+        text_layer=options['text_layer'],
+    )
+    answers = complete_answers(
+        text_client,
+        options['text_model'],
+        answers,
+        conversation_text,
+        retriever=options['retriever'],
+    )
+    fill_answers(form_path, answers, io.BytesIO())
+    return time.perf_counter() - start_time
+
+
+def run(
+    form_path, page_count, emr_text, conversation_text, mock, clients, args, concurrency
+):
+    """Returns the throughput, latency, memory and payload figures of a setting."""
+    text_client, retriever = clients
+    options = {
+        'concurrency': concurrency,
+        'text_layer': not args.no_text_layer,
+        'retriever': retriever,
+        'text_model': os.getenv('AZURE_OPENAI_GPT_TURBO_DEPLOYMENT'),
+    }
+    mock.reset_stats()
+    get_recorder().reset()
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = [
+            executor.submit(
+                run_claim, form_path, emr_text, conversation_text, text_client, options
+            )
+            for _ in range(args.claims)
+        ]
+        latencies = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start_time
+
+    stats = mock.stats()
+    summary = get_recorder().summary()['calls']
+    calls = summary.values()
+    embedding = summary.get('embedding', {})
+    return {
+        'pages': page_count,
+        'concurrency': concurrency,
+        'claims': args.claims,
+        'claims_per_minute': 60 * args.claims / elapsed,
+        'pages_per_second': page_count * args.claims / elapsed,
+        'p50_seconds': percentile(latencies, 0.50),
+        'p95_seconds': percentile(latencies, 0.95),
+        'p99_seconds': percentile(latencies, 0.99),
+        'peak_rss_bytes': get_peak_rss(),
+        'bytes_sent': stats['bytes_received'],
+        'requests': stats['requests'],
+        'rate_limited': stats['rate_limited'],
+        'retries': sum(row['retries'] for row in calls),
+        'prompt_tokens': stats['prompt_tokens'],
+        'completion_tokens': stats['completion_tokens'],
+        'embedding_calls': embedding.get('count', 0),
+        'embedding_seconds': embedding.get('total_seconds', 0.0),
+    }
+
+
+def main():
+    """
+    Starts the mock endpoint, points the API clients at it and runs every
+    combination of page count and concurrency, printing one row per setting.
+    The peak RSS is that of the whole run so far, so settings are best
+    ordered from the lightest to the heaviest.
+    """
+    args = parse_arguments()
+    logging.basicConfig(level=logging.WARNING)
+    init()
+    os.environ.setdefault('AZURE_OPENAI_GPT4_DEPLOYMENT', 'gpt-4-vision')
+    os.environ.setdefault('AZURE_OPENAI_GPT_TURBO_DEPLOYMENT', 'gpt-35-turbo')
+
+    replay_cache = None
+    if args.replay_cache and os.path.exists(args.replay_cache):
+        replay_cache = ResponseCache(args.replay_cache)
+    mock = MockAzureOpenAI(
+        cache=replay_cache,
+        latency=LatencyModel(
+            args.latency_median, args.latency_sigma, args.per_token, args.seed
+        ),
+        error_rate=args.error_rate,
+    )
+    server = start_server(mock)
+    endpoint = f'http://127.0.0.1:{server.server_port}'
+
+    client = AzureOpenAI(
+        azure_endpoint=endpoint,
+        api_key='mock',
+        api_version=API_VERSION,
+        max_retries=0,  # Retries are handled by OpenAIRequestLibrary
+    )
+    OpenAIRequestLibrary.set_openai_client(client)
+
+    with open(args.emr, 'r') as file:
+        emr_text = file.read()
+    with open(args.conversation, 'r', encoding='utf-8') as file:
+        conversation_text = file.read()
+
+    print(
+        f'{"pages":>5} {"conc":>4} {"claims/min":>10} {"pages/s":>8} '
+        f'{"p50 s":>7} {"p95 s":>7} {"p99 s":>7} {"peak RSS MB":>11} '
+        f'{"bytes sent":>11} {"429s":>5} {"retries":>7}'
+    )
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for page_count in args.pages:
+            form_path = os.path.join(directory, f'form-{page_count}.pdf')
+            build_form(args.input_form, page_count, form_path)
+            for concurrency in args.concurrency:
+                # Each setting embeds the records itself, as a cold run would
+                index_directory = os.path.join(
+                    directory, f'embeddings-{page_count}-{concurrency}'
+                )
+                clients = (
+                    client,
+                    Retriever(AzureEmbedder(client), directory=index_directory),
+                )
+                row = run(
+                    form_path,
+                    page_count,
+                    emr_text,
+                    conversation_text,
+                    mock,
+                    clients,
+                    args,
+                    concurrency,
+                )
+                results.append(row)
+                print(
+                    f'{row["pages"]:>5} {row["concurrency"]:>4} '
+                    f'{row["claims_per_minute"]:>10.1f} '
+                    f'{row["pages_per_second"]:>8.2f} {row["p50_seconds"]:>7.2f} '
+                    f'{row["p95_seconds"]:>7.2f} {row["p99_seconds"]:>7.2f} '
+                    f'{row["peak_rss_bytes"] / 2**20:>11.1f} '
+                    f'{row["bytes_sent"]:>11} {row["rate_limited"]:>5} '
+                    f'{row["retries"]:>7}'
+                )
+
+    server.shutdown()
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    #   Example usage:
+    #       python -m benchmarks.pipeline -p 3 6 12 -c 1 4 8 --error-rate 0.05
+    main()
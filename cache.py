@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_VERSION = 1  # Bump to invalidate every entry written by older code
+DEFAULT_CACHE_PATH = '.cache/responses.sqlite3'
+
+
+class ResponseCache:
+    """
+    A content-addressed cache for OpenAI API responses, stored in SQLite.
+
+    Entries are keyed by a hash of the complete request body, so the page image
+    bytes, the prompt text, the deployment and the sampling parameters are all
+    part of the key. Values are stored as compact JSON. The least recently used
+    entries are evicted once the cache grows beyond `max_entries` or
+    `max_bytes`, and entries older than `ttl` seconds are never served.
+    """
+
+    def __init__(
+        self,
+        path=DEFAULT_CACHE_PATH,
+        max_entries=10000,
+        max_bytes=256 * 1024 * 1024,
+        ttl=None,
+    ):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._path = path  # The path to the SQLite database
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl  # Maximum age of an entry in seconds, None to keep forever
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()  # The connection is shared between threads
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+            'created REAL NOT NULL, accessed REAL NOT NULL)'
+        )
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)'
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(request_body):
+        """Returns the cache key of a request body."""
+        payload = json.dumps(
+            {'version': CACHE_VERSION, 'request': request_body},
+            sort_keys=True,
+            separators=(',', ':'),
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached value for the key, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value, created FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is not None and self._ttl is not None and now - row[1] > self._ttl:
+                self._connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._connection.commit()
+                row = None
+            if row is None:
+                self._misses += 1
+                return None
+
+            self._connection.execute(
+                'UPDATE responses SET accessed = ? WHERE key = ?', (now, key)
+            )
+            self._connection.commit()
+            self._hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """Stores a JSON-serializable value under the key."""
+        now = time.time()
+        data = json.dumps(value, separators=(',', ':'))
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                (key, data, len(data), now, now),
+            )
+            self._evict(now)
+            self._connection.commit()
+
+    def stats(self):
+        """Returns the hit/miss counters and the current size of the cache."""
+        with self._lock:
+            entries, size = self._connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+            ).fetchone()
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'entries': entries,
+            'bytes': size,
+        }
+
+    def clear(self):
+        """Removes every entry from the cache."""
+        with self._lock:
+            self._connection.execute('DELETE FROM responses')
+            self._connection.commit()
+
+    def close(self):
+        """Closes the underlying database connection."""
+        with self._lock:
+            self._connection.close()
+
+    def _evict(self, now):
+        """Drops expired entries, then the least recently used ones over budget."""
+        if self._ttl is not None:
+            self._connection.execute(
+                'DELETE FROM responses WHERE created < ?', (now - self._ttl,)
+            )
+
+        entries, size = self._connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()
+        if entries <= self._max_entries and size <= self._max_bytes:
+            return
+
+        rows = self._connection.execute(
+            'SELECT key, size FROM responses ORDER BY accessed'
+        ).fetchall()
+        evicted = []
+        for key, entry_size in rows:
+            if entries <= self._max_entries and size <= self._max_bytes:
+                break
+            evicted.append((key,))
+            entries -= 1
+            size -= entry_size
+        self._connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
@@ -0,0 +1,203 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+import logging
+import re
+
+from metrics import get_recorder
+
+DATE = r'\d{1,2}[/-]\d{1,2}[/-]\d{2,4}|\d{4}-\d{2}-\d{2}|[A-Z][a-z]+ \d{1,2}, \d{4}'
+# The date formats records are written in, month first as in the sample EMR
+RECORD_DATE_FORMATS = ('%m/%d/%Y', '%m-%d-%Y', '%m/%d/%y', '%Y-%m-%d', '%B %d, %Y')
+DAY_MONTH_YEAR = '%d/%m/%Y'  # For fields captioned "(Day Month Year)"
+EMAIL = r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+'
+# Labels that name different things in different sections of a record
+AMBIGUOUS_LABELS = {'date', 'name', 'address', 'phone', 'other', 'comments', 'note'}
+
+
+@dataclass
+class Extraction:
+    """An answer read from a record without a model, with where it came from."""
+
+    name: str  # The PDF field name
+    value: str
+    source: str  # The record the value was read from, e.g. 'emr'
+    rule: str  # The rule that matched
+    evidence: str  # The record line the value was read from
+    line: int  # 1-indexed
+
+    def describe(self):
+        """Returns the provenance of the value as one line of text."""
+        return f'{self.source} line {self.line} ({self.rule}): {self.evidence}'
+
+
+@dataclass
+class FieldRule:
+    """A rule answering matching fields from "Label: value" or text_pattern lines."""
+
+    name: str
+    field_pattern: str
+    label_pattern: str | None = None
+    text_pattern: str | None = None
+    value_pattern: str | None = None  # The value must match to be trusted
+    is_date: bool = False  # The value is reformatted to the field's date format
+
+
+RULES = [
+    FieldRule(
+        'patient_name',
+        r'\b(employee|patient)s? name\b|\blast name first\b',
+        label_pattern=r'^(patient |employee |full )?name$|^patient$',
+        value_pattern=r"^(Mrs?\.? |Ms\.? )?[A-Z][A-Za-z'’-]+( [A-Z][A-Za-z'’.-]*){1,3}$",
+    ),
+    FieldRule(
+        'date_of_birth',
+        r'\bdate of birth\b|\bdob\b|\bbirth ?date\b',
+        label_pattern=r'^(dob|date of birth|birth ?date)$',
+        value_pattern=rf'^({DATE})$',
+        is_date=True,
+    ),
+    FieldRule(
+        'date_of_service',
+        r'\bdate of (most recent )?exam(ination)?\b|\bdate of service\b|\bvisit date\b',
+        label_pattern=r'^(date of service|visit date|encounter date)$',
+        value_pattern=rf'^({DATE})$',
+        is_date=True,
+    ),
+    FieldRule(
+        'date_of_surgery',
+        r'\bdate of surgery\b',
+        text_pattern=rf'\bsurgery (?:is )?(?:scheduled )?(?:for|on) ({DATE})',
+        is_date=True,
+    ),
+    FieldRule(
+        'employer',
+        r'\bemployer\b',
+        label_pattern=r'^(employer|employer name|company)$',
+        value_pattern=r'^[\w&.,\' -]{2,80}$',
+    ),
+    FieldRule(
+        'diagnosis',
+        r'\bdiagnos[ie]s\b|\bicd\b|\bnature of the illness\b',
+        label_pattern=r'^(diagnos[ie]s|dx|icd ?10|icd ?10 codes?|diagnosis codes?)$',
+    ),
+    FieldRule(
+        'physician_name',
+        r'\bphysicians? name\b',
+        label_pattern=r'^(attending )?physicians?( name)?$',
+        value_pattern=r"^(Dr\.? )?[A-Z][A-Za-z'’-]+( [A-Z][A-Za-z'’.-]*){1,3}$",
+    ),
+    FieldRule(
+        'email_address',
+        r'\be ?mail address\b',
+        text_pattern=rf'({EMAIL})',
+    ),
+]
+
+
+def normalize_label(text):
+    """Returns the text lowercased, without parentheses and punctuation."""
+    text = re.sub(r'\([^)]*\)', ' ', text.lower())
+    text = re.sub(r"['’]", '', text)
+    return re.sub(r'[^a-z0-9]+', ' ', text).strip()
+
+
+def get_labelled_values(text):
+    """Returns the (normalized label, value, line, line number) of "Label: value" lines."""
+    values = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        match = re.match(r'^\s*([A-Za-z][\w \'’()/.#-]{0,40}?)\s*:\s*(\S.*?)\s*$', line)
+        if match and not match.group(2).startswith('"'):  # Not a quoted utterance
+            values.append(
+                (normalize_label(match.group(1)), match.group(2), line, number)
+            )
+    return values
+
+
+def _find_candidates(rule, text, labelled_values):
+    """Returns the (value, line, line number) candidates of a rule in the text."""
+    candidates = []
+    if rule.label_pattern:
+        for label, value, line, number in labelled_values:
+            if re.search(rule.label_pattern, label):
+                candidates.append((value, line, number))
+    if rule.text_pattern:
+        for number, line in enumerate(text.splitlines(), start=1):
+            for match in re.finditer(rule.text_pattern, line, re.IGNORECASE):
+                candidates.append((match.group(1), line, number))
+    if rule.value_pattern:
+        candidates = [c for c in candidates if re.search(rule.value_pattern, c[0])]
+    return candidates
+
+
+def parse_record_date(value):
+    """Returns the date of a value in one of RECORD_DATE_FORMATS, or None."""
+    for date_format in RECORD_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    return None
+
+
+def format_value(rule, field_text, value):
+    """Returns the value in the form the field asks for, or None if it cannot be."""
+    value = value.rstrip('.').strip()
+    if rule.is_date and 'day month year' in field_text:
+        date = parse_record_date(value)
+        return date.strftime(DAY_MONTH_YEAR) if date else None
+    if rule.name == 'patient_name' and 'last name first' in field_text:
+        parts = value.split()
+        if len(parts) >= 2 and ',' not in value:
+            return f'{parts[-1]}, {" ".join(parts[:-1])}'
+    return value
+
+
+def pre_extract(questions, text, source='emr'):
+    """Returns the Extractions of the questions the record answers unambiguously."""
+    with get_recorder().stage('pre_extract'):
+        labelled_values = get_labelled_values(text)
+        exact_labels = {}
+        for label, value, line, number in labelled_values:
+            if label not in AMBIGUOUS_LABELS:
+                exact_labels.setdefault(label, []).append((value, line, number))
+
+        extractions = {}
+        for name, question in questions.items():
+            if re.search(r'\| (Checkbox|Choice) options', question):
+                continue
+            # Parenthesized hints such as "(Last name first, in full)" count too
+            field_text = normalize_label(f'{name} {question}'.replace('(', ' '))
+
+            for rule in RULES:
+                if not re.search(rule.field_pattern, field_text):
+                    continue
+                candidates = _find_candidates(rule, text, labelled_values)
+                if candidates:
+                    break
+            else:
+                # A label that is exactly the field name, e.g. "Fax: 555-0100"
+                rule = FieldRule('exact_label', '')
+                candidates = exact_labels.get(normalize_label(name), [])
+
+            values = {format_value(rule, field_text, c[0]) for c in candidates}
+            if None in values or len(values) != 1:
+                if len(values) > 1:
+                    logging.debug(f'Conflicting values for {name}: {values}')
+                continue
+            _, line, number = candidates[0]
+            extractions[name] = Extraction(
+                name,
+                values.pop(),
+                source,
+                rule.name,
+                line.strip(),
+                number,
+            )
+
+    for extraction in extractions.values():
+        logging.debug(
+            f'Pre-extracted {extraction.name}: {extraction.value} '
+            f'from {extraction.describe()}'
+        )
+    return extractions
@@ -0,0 +1,24 @@
+import os
+import threading
+
+
+def write_atomic(path, data):
+    """
+    Writes the bytes to the path through a temporary file, so that other
+    threads and processes never read it half-written. The temporary file is
+    removed if the write fails.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temporary_path, 'wb') as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass  # Never created, or already replaced
+        raise
@@ -0,0 +1,277 @@
+from dataclasses import asdict, dataclass, field
+
+import hashlib
+import io
+import json
+import os
+import threading
+
+import PyPDF2
+
+from files import write_atomic
+from metrics import get_recorder
+
+SCHEMA_VERSION = 5  # Bump when the schema layout or extraction logic changes
+DEFAULT_SCHEMA_DIRECTORY = '.cache/form_schemas'
+
+
+@dataclass
+class FormWidget:
+    """A widget annotation of a form field. The page number is 0-indexed."""
+
+    page: int | None
+    rect: list[float] | None  # [x1, y1, x2, y2] in PDF user space
+    option: str | None = None  # The on-state of a checkbox or radio widget
+
+
+@dataclass
+class FormField:
+    """A fillable field of a PDF form."""
+
+    name: str
+    field_type: str | None  # '/Tx', '/Btn', '/Ch' or '/Sig'
+    options: list[str] = field(default_factory=list)
+    tooltip: str | None = None  # The /TU alternate field name
+    widgets: list[FormWidget] = field(default_factory=list)
+
+    @property
+    def page(self):
+        """Returns the page of the first widget of the field."""
+        return self.widgets[0].page if self.widgets else None
+
+    @property
+    def rect(self):
+        """Returns the rectangle of the first widget of the field."""
+        return self.widgets[0].rect if self.widgets else None
+
+
+@dataclass
+class FormSchema:
+    """The fields of a PDF form, extracted in a single pass over the file."""
+
+    pdf_hash: str
+    page_count: int
+    fields: list[FormField]
+    # The questions of each page built from the text layer, see text_layer.py
+    page_questions: list[dict] | None = None
+
+    def __post_init__(self):
+        self._fields_by_name = {f.name: f for f in self.fields}
+
+    def get_field(self, name):
+        """Returns the field with the name, or None."""
+        return self._fields_by_name.get(name)
+
+    def field_names(self):
+        """Returns the names of all fields in document order."""
+        return [f.name for f in self.fields]
+
+    def option_names(self):
+        """Returns the distinct options of all fields in document order."""
+        return list(dict.fromkeys(o for f in self.fields for o in f.options))
+
+    def fields_on_page(self, page_number):
+        """Returns the fields that have a widget on the page."""
+        return [f for f in self.fields if any(w.page == page_number for w in f.widgets)]
+
+    def fields_near_page(self, page_number, margin=0):
+        """
+        Returns the fields that have a widget within `margin` pages of the
+        page, and the fields whose page is unknown, in document order.
+        """
+        return [
+            f
+            for f in self.fields
+            if any(
+                w.page is None or abs(w.page - page_number) <= margin for w in f.widgets
+            )
+            or not f.widgets
+        ]
+
+    def to_dict(self):
+        """Returns a JSON-serializable representation of the schema."""
+        return {
+            'version': SCHEMA_VERSION,
+            'pdf_hash': self.pdf_hash,
+            'page_count': self.page_count,
+            'fields': [asdict(f) for f in self.fields],
+            'page_questions': self.page_questions,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Returns the schema of a representation made by to_dict()."""
+        fields = []
+        for field_data in data['fields']:
+            widgets = [FormWidget(**w) for w in field_data.pop('widgets')]
+            fields.append(FormField(widgets=widgets, **field_data))
+        return cls(
+            data['pdf_hash'], data['page_count'], fields, data.get('page_questions')
+        )
+
+
+def get_pdf_hash(data):
+    """Returns the content hash of the PDF bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_field_options(reader, field_info):
+    """
+    Returns the on-state names of a checkbox or radio field, or None. A field
+    without /Kids is its own widget. Push buttons such as Print and Clear
+    have a single appearance stream rather than named states, so they give
+    None.
+    """
+    options = []
+    kids = field_info.get('/Kids') or [field_info]
+    for kid in kids:
+        kid_object = reader.get_object(kid) if kid is not field_info else kid
+        if kid_object:
+            ap = kid_object.get('/AP')
+            if ap:
+                if isinstance(ap, PyPDF2.generic.IndirectObject):
+                    ap = reader.get_object(ap)
+                # A push button's normal appearance is a stream, not states
+                normal = ap.get('/N')
+                normal = normal.get_object() if normal is not None else None
+                if normal is not None and not isinstance(
+                    normal, PyPDF2.generic.StreamObject
+                ):
+                    key = [k for k in list(normal.keys()) if k != '/Off']
+                    # Strip the leading slash before appending
+                    options.extend(k.strip('/') for k in key)
+    return options if options else None
+
+
+def _get_rect(annotation):
+    """Returns the widget rectangle as a list of floats, or None."""
+    rect = annotation.get('/Rect')
+    return [float(v) for v in rect] if rect is not None else None
+
+
+def _get_choice_options(field_object):
+    """Returns the export values of a list or combo box field."""
+    options = []
+    for option in field_object.get('/Opt') or []:
+        option = option.get_object()
+        # An option is either a string or an [export value, display text] pair
+        options.append(str(option[0] if isinstance(option, list) else option))
+    return options
+
+
+def build_form_schema(data):
+    """Returns the FormSchema of the PDF bytes, parsed in a single pass."""
+    reader = PyPDF2.PdfReader(io.BytesIO(data))
+
+    # Map every widget annotation to the page it is placed on
+    widget_pages = {}
+    page_numbers = {}  # Page numbers by page object number, for /P entries
+    for page_number, page in enumerate(reader.pages):
+        if page.indirect_reference is not None:
+            page_numbers[page.indirect_reference.idnum] = page_number
+        annotations = page.get('/Annots')
+        for annotation in annotations.get_object() if annotations else []:
+            if isinstance(annotation, PyPDF2.generic.IndirectObject):
+                widget_pages[annotation.idnum] = page_number
+
+    fields = []
+
+    def walk(references, parent_name, parent_type):
+        for reference in references:
+            field_object = reference.get_object()
+            name = field_object.get('/T')
+            full_name = '.'.join(n for n in (parent_name, name) if n)
+            field_type = field_object.get('/FT', parent_type)
+            kids = field_object.get('/Kids') or []
+
+            # Kids with their own name are child fields, otherwise widgets
+            if any('/T' in kid.get_object() for kid in kids):
+                walk(kids, full_name, field_type)
+                continue
+
+            widgets = []
+            for widget_reference in kids or [reference]:
+                on_states = None
+                if field_type == '/Btn':  # Checkbox or radio button widget
+                    on_states = get_field_options(reader, {'/Kids': [widget_reference]})
+                page_number = widget_pages.get(getattr(widget_reference, 'idnum', None))
+                if page_number is None:
+                    # Not in any page's /Annots, but it may name its page
+                    page_reference = widget_reference.get_object().get('/P')
+                    page_number = page_numbers.get(
+                        getattr(page_reference, 'idnum', None)
+                    )
+                widgets.append(
+                    FormWidget(
+                        page=page_number,
+                        rect=_get_rect(widget_reference.get_object()),
+                        option=on_states[0] if on_states else None,
+                    )
+                )
+
+            if field_type == '/Btn':
+                options = list(dict.fromkeys(w.option for w in widgets if w.option))
+            elif field_type == '/Ch':
+                options = _get_choice_options(field_object)
+            else:
+                options = []
+            tooltip = field_object.get('/TU')
+            fields.append(
+                FormField(
+                    name=full_name,
+                    field_type=field_type,
+                    options=options,
+                    tooltip=str(tooltip) if tooltip is not None else None,
+                    widgets=widgets,
+                )
+            )
+
+    acro_form = reader.trailer['/Root'].get('/AcroForm')
+    if acro_form is not None:
+        walk(acro_form.get_object().get('/Fields') or [], '', None)
+
+    return FormSchema(get_pdf_hash(data), len(reader.pages), fields)
+
+
+_loaded_schemas = {}  # Schemas already loaded by this process, by PDF hash
+_loaded_schemas_lock = threading.Lock()
+
+
+def load_form_schema(file_path, directory=DEFAULT_SCHEMA_DIRECTORY):
+    """
+    Returns the FormSchema of a PDF file. Schemas are stored in the directory
+    under the hash of the PDF, so a template seen before is not parsed again.
+    """
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    pdf_hash = get_pdf_hash(data)
+
+    with _loaded_schemas_lock:
+        if pdf_hash in _loaded_schemas:
+            return _loaded_schemas[pdf_hash]
+
+    schema = None
+    schema_path = os.path.join(directory, f'{pdf_hash}.json') if directory else None
+    if schema_path and os.path.exists(schema_path):
+        with open(schema_path, 'r', encoding='utf-8') as file:
+            stored = json.load(file)
+        if stored.get('version') == SCHEMA_VERSION:
+            schema = FormSchema.from_dict(stored)
+
+    if schema is None:
+        with get_recorder().stage('form_schema'):
+            schema = build_form_schema(data)
+        save_form_schema(schema, directory)
+
+    with _loaded_schemas_lock:
+        _loaded_schemas[pdf_hash] = schema
+    return schema
+
+
+def save_form_schema(schema, directory=DEFAULT_SCHEMA_DIRECTORY):
+    """Stores the schema in the directory under the hash of its PDF."""
+    if directory:
+        write_atomic(
+            os.path.join(directory, f'{schema.pdf_hash}.json'),
+            json.dumps(schema.to_dict()).encode('utf-8'),
+        )
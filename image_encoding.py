@@ -0,0 +1,187 @@
+from dataclasses import dataclass
+
+from PIL import Image, ImageChops, ImageOps
+
+import hashlib
+import io
+import json
+import math
+
+# Vision token accounting for "high" detail images: the image is scaled to fit
+# 2048x2048, then its short side to 768, and billed per 512px tile
+BASE_IMAGE_TOKENS = 85
+TOKENS_PER_TILE = 170
+LINE_ART_THRESHOLD = 0.97  # Share of near-black/near-white pixels for line art
+
+
+@dataclass
+class EncodedImage:
+    """An encoded page image and its payload statistics."""
+
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    quality: int | None  # The JPEG quality, None for PNG
+    estimated_tokens: int
+
+    @property
+    def size(self):
+        """Returns the number of bytes of the encoded image."""
+        return len(self.data)
+
+
+def estimate_image_tokens(width, height, detail='high'):
+    """Returns the estimated number of vision tokens billed for an image."""
+    if detail == 'low':
+        return BASE_IMAGE_TOKENS
+
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return BASE_IMAGE_TOKENS + TOKENS_PER_TILE * tiles
+
+
+def is_line_art(image):
+    """Returns whether an image is almost entirely black and white."""
+    histogram = image.convert('L').histogram()
+    extremes = sum(histogram[:32]) + sum(histogram[224:])
+    return extremes / sum(histogram) >= LINE_ART_THRESHOLD
+
+
+def crop_blank_margins(image, padding=16, threshold=16):
+    """Returns the image cropped to its non-blank content plus some padding."""
+    background = Image.new(image.mode, image.size, 'white')
+    difference = ImageChops.difference(image, background).convert('L')
+    bbox = difference.point(lambda p: 255 if p > threshold else 0).getbbox()
+    if bbox is None:
+        return image  # The page is blank
+
+    left, top, right, bottom = bbox
+    return image.crop(
+        (
+            max(0, left - padding),
+            max(0, top - padding),
+            min(image.width, right + padding),
+            min(image.height, bottom + padding),
+        )
+    )
+
+
+class ImageOptimizer:
+    """
+    Encodes page images for vision requests at the smallest payload that
+    keeps them legible.
+
+    The pipeline optionally crops blank margins, converts to grayscale and
+    downsamples to `max_long_edge` pixels (and further, if needed, to fit
+    `max_image_tokens`). Line-art pages are encoded as PNG when that is
+    smaller; other pages use the highest JPEG quality between `min_quality`
+    and `quality` that fits `max_bytes`. The defaults reproduce a plain
+    full-resolution JPEG.
+    """
+
+    def __init__(
+        self,
+        max_long_edge=None,
+        grayscale=False,
+        crop_margins=False,
+        quality=75,
+        min_quality=30,
+        max_bytes=None,
+        max_image_tokens=None,
+        prefer_png_for_line_art=False,
+    ):
+        self._max_long_edge = max_long_edge
+        self._grayscale = grayscale
+        self._crop_margins = crop_margins
+        self._quality = quality  # The JPEG quality used when within budget
+        self._min_quality = min_quality  # The lowest JPEG quality tried
+        self._max_bytes = max_bytes  # The byte budget of one encoded page
+        self._max_image_tokens = max_image_tokens  # The token budget of one page
+        self._prefer_png_for_line_art = prefer_png_for_line_art
+
+    def get_key(self):
+        """Returns a short key of the settings, which determine the encoding."""
+        settings = json.dumps(vars(self), sort_keys=True)
+        return hashlib.sha256(settings.encode('utf-8')).hexdigest()[:12]
+
+    def encode(self, image):
+        """Returns the EncodedImage of a PIL image."""
+        # Judge line art before downsampling, which blurs edges into grays
+        line_art = self._prefer_png_for_line_art and is_line_art(image)
+        image = self._prepare(image)
+        tokens = estimate_image_tokens(image.width, image.height)
+
+        jpeg, quality = self._encode_jpeg(image)
+        if line_art:
+            png = self._encode_png(image)
+            if len(png) <= len(jpeg):
+                return EncodedImage(
+                    png, 'image/png', image.width, image.height, None, tokens
+                )
+        return EncodedImage(
+            jpeg, 'image/jpeg', image.width, image.height, quality, tokens
+        )
+
+    def _prepare(self, image):
+        """Crops, converts and downsamples the image before encoding."""
+        image = image.convert('L') if self._grayscale else image.convert('RGB')
+        if self._crop_margins:
+            image = crop_blank_margins(image)
+
+        if self._max_long_edge and max(image.size) > self._max_long_edge:
+            scale = self._max_long_edge / max(image.size)
+            image = self._resize(image, scale)
+
+        if self._max_image_tokens:
+            while (
+                estimate_image_tokens(image.width, image.height)
+                > self._max_image_tokens
+                and min(image.size) > 64
+            ):
+                image = self._resize(image, 0.85)
+        return image
+
+    @staticmethod
+    def _resize(image, scale):
+        """Returns the image resized by the scale factor."""
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        return image.resize(size, Image.LANCZOS)
+
+    def _encode_jpeg(self, image):
+        """Returns the JPEG bytes and quality that best fit the byte budget."""
+        data = self._save(image, 'JPEG', quality=self._quality, optimize=True)
+        if self._max_bytes is None or len(data) <= self._max_bytes:
+            return data, self._quality
+
+        # Binary search for the highest quality that fits the budget
+        best = None
+        low, high = self._min_quality, self._quality - 1
+        while low <= high:
+            quality = (low + high) // 2
+            candidate = self._save(image, 'JPEG', quality=quality, optimize=True)
+            if len(candidate) <= self._max_bytes:
+                best = candidate, quality
+                low = quality + 1
+            else:
+                high = quality - 1
+
+        if best is None:  # Even the lowest quality is over budget
+            quality = self._min_quality
+            best = self._save(image, 'JPEG', quality=quality, optimize=True), quality
+        return best
+
+    def _encode_png(self, image):
+        """Returns the PNG bytes of the image, reduced to a few gray levels."""
+        palette_image = ImageOps.grayscale(image).quantize(colors=4)
+        return self._save(palette_image, 'PNG', optimize=True)
+
+    @staticmethod
+    def _save(image, image_format, **params):
+        """Returns the bytes of the image saved in the given format."""
+        buffer = io.BytesIO()
+        image.save(buffer, image_format, **params)
+        return buffer.getvalue()
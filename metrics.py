@@ -0,0 +1,391 @@
+from collections import deque
+from contextlib import contextmanager
+
+import json
+import math
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets, 25% apart
+LATENCY_BUCKETS = tuple(round(0.05 * 1.25**i, 3) for i in range(43))
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of the values, or None if empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+def _add_totals(totals, **values):
+    """Adds the values to the running totals of the same names."""
+    for key, value in values.items():
+        totals[key] = totals.get(key, 0) + value
+
+
+def _summarize(values):
+    """Returns the count, total and latency percentiles of the durations."""
+    return {
+        'count': len(values),
+        'total_seconds': sum(values),
+        'p50_seconds': percentile(values, 0.50),
+        'p95_seconds': percentile(values, 0.95),
+        'max_seconds': max(values) if values else None,
+    }
+
+
+class LatencyHistogram:
+    """
+    Counts call latencies in LATENCY_BUCKETS, so that percentiles of every
+    call so far can be estimated in constant memory.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # The last is unbounded
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        """Adds one latency to the histogram."""
+        index = next(
+            (i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound),
+            len(LATENCY_BUCKETS),
+        )
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding the nearest-rank
+        percentile, at most the largest latency seen, or None if empty.
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = max(1, math.ceil(fraction * self.count))
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    break
+            if index < len(LATENCY_BUCKETS):
+                return min(LATENCY_BUCKETS[index], self.max)
+            return self.max
+
+
+class MetricsRecorder:
+    """
+    Collects per-call and per-stage measurements of a run.
+
+    Every model call records its wall time, time to first token, prompt and
+    completion tokens, the prompt tokens estimated locally before it was sent,
+    request payload bytes, whether it was served from the cache, how many
+    retries it needed and whether it was hedged. Successful calls are also
+    counted in a LatencyHistogram per label, which adaptive policies such as
+    request hedging read. Local stages such as rasterization,
+    encoding and the PDF fill are timed with stage(). The measurements can be
+    saved as JSON or in the OpenMetrics text format, and summarized as a table.
+
+    A long-running server keeps only the `max_records` latest calls and
+    stages, so memory and the cost of a summary stay bounded; the summary
+    then covers those, while the latency histograms and the running totals
+    exported as OpenMetrics counters cover every call.
+    """
+
+    def __init__(self, max_records=None):
+        self._calls = deque(maxlen=max_records)  # One dictionary per model call
+        self._stages = deque(maxlen=max_records)  # One dictionary per timed stage
+        self._histograms = {}  # LatencyHistograms of successful calls by label
+        self._call_totals = {}  # Running totals of every call by label
+        self._stage_totals = {}  # Running totals of every stage by name
+        self._lock = threading.Lock()  # Calls are recorded from many threads
+
+    def record_call(
+        self,
+        label,
+        model=None,
+        wall_time=0.0,
+        time_to_first_token=None,
+        prompt_tokens=None,
+        estimated_prompt_tokens=None,
+        completion_tokens=None,
+        payload_bytes=0,
+        cache_hit=False,
+        retries=0,
+        status='ok',
+        hedged=False,
+    ):
+        """Records the measurements of one model call."""
+        call = {
+            'label': label,
+            'model': model,
+            'wall_time': wall_time,
+            'time_to_first_token': time_to_first_token,
+            'prompt_tokens': prompt_tokens,
+            'estimated_prompt_tokens': estimated_prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'payload_bytes': payload_bytes,
+            'cache_hit': cache_hit,
+            'retries': retries,
+            'status': status,
+            'hedged': hedged,
+        }
+        with self._lock:
+            self._calls.append(call)
+            _add_totals(
+                self._call_totals.setdefault(label, {}),
+                count=1,
+                total_seconds=wall_time,
+                prompt_tokens=prompt_tokens or 0,
+                estimated_prompt_tokens=estimated_prompt_tokens or 0,
+                completion_tokens=completion_tokens or 0,
+                payload_bytes=payload_bytes,
+                cache_hits=int(cache_hit),
+                retries=retries,
+                hedges=int(hedged),
+            )
+        if status == 'ok' and not cache_hit:
+            self.get_histogram(label).record(wall_time)
+
+    def get_histogram(self, label):
+        """Returns the LatencyHistogram of the successful calls with the label."""
+        with self._lock:
+            if label not in self._histograms:
+                self._histograms[label] = LatencyHistogram()
+            return self._histograms[label]
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block as one occurrence of the named stage."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            with self._lock:
+                self._stages.append({'stage': name, 'seconds': elapsed})
+                _add_totals(
+                    self._stage_totals.setdefault(name, {}),
+                    count=1,
+                    total_seconds=elapsed,
+                )
+
+    def set_max_records(self, max_records):
+        """
+        Keeps only the max_records latest calls and stages from now on, or
+        every one when max_records is None.
+        """
+        with self._lock:
+            self._calls = deque(self._calls, maxlen=max_records)
+            self._stages = deque(self._stages, maxlen=max_records)
+
+    def reset(self):
+        """Discards everything recorded so far."""
+        with self._lock:
+            self._calls.clear()
+            self._stages.clear()
+            self._histograms.clear()
+            self._call_totals.clear()
+            self._stage_totals.clear()
+
+    def summary(self):
+        """Returns the aggregated measurements by call label and by stage."""
+        with self._lock:
+            calls = list(self._calls)
+            stages = list(self._stages)
+
+        call_summary = {}
+        for label in dict.fromkeys(call['label'] for call in calls):
+            group = [call for call in calls if call['label'] == label]
+            row = _summarize([call['wall_time'] for call in group])
+            first_tokens = [
+                call['time_to_first_token']
+                for call in group
+                if call['time_to_first_token'] is not None
+            ]
+            row.update(
+                {
+                    'p50_time_to_first_token': percentile(first_tokens, 0.50),
+                    'prompt_tokens': sum(c['prompt_tokens'] or 0 for c in group),
+                    'estimated_prompt_tokens': sum(
+                        c.get('estimated_prompt_tokens') or 0 for c in group
+                    ),
+                    'completion_tokens': sum(
+                        c['completion_tokens'] or 0 for c in group
+                    ),
+                    'payload_bytes': sum(c['payload_bytes'] for c in group),
+                    'cache_hits': sum(c['cache_hit'] for c in group),
+                    'retries': sum(c['retries'] for c in group),
+                    'errors': sum(c['status'] != 'ok' for c in group),
+                    'hedges': sum(c.get('hedged', False) for c in group),
+                }
+            )
+            call_summary[label] = row
+
+        stage_summary = {}
+        for name in dict.fromkeys(stage['stage'] for stage in stages):
+            stage_summary[name] = _summarize(
+                [stage['seconds'] for stage in stages if stage['stage'] == name]
+            )
+        return {'calls': call_summary, 'stages': stage_summary}
+
+    def to_dict(self):
+        """Returns every measurement and the summary as a JSON-serializable dict."""
+        with self._lock:
+            calls = list(self._calls)
+            stages = list(self._stages)
+        return {'summary': self.summary(), 'calls': calls, 'stages': stages}
+
+    def to_openmetrics(self):
+        """
+        Returns the totals of every call and stage so far in the OpenMetrics
+        text exposition format, as counters that never decrease.
+        """
+        with self._lock:
+            calls = {label: dict(row) for label, row in self._call_totals.items()}
+            stages = {name: dict(row) for name, row in self._stage_totals.items()}
+        lines = []
+
+        def family(name, metric_type, help_text, samples):
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.append(f'# HELP {name} {help_text}')
+            suffix = '_total' if metric_type == 'counter' else ''
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f'{name}{suffix}{{{label_text}}} {value}')
+
+        family(
+            'form_model_calls',
+            'counter',
+            'Model calls by label.',
+            [({'label': label}, row['count']) for label, row in calls.items()],
+        )
+        family(
+            'form_model_call_seconds',
+            'counter',
+            'Total wall time of model calls.',
+            [({'label': label}, row['total_seconds']) for label, row in calls.items()],
+        )
+        for kind in ('prompt', 'completion'):
+            family(
+                f'form_model_{kind}_tokens',
+                'counter',
+                f'{kind.capitalize()} tokens reported by the API, or counted '
+                'locally for streamed calls.',
+                [
+                    ({'label': label}, row[f'{kind}_tokens'])
+                    for label, row in calls.items()
+                ],
+            )
+        family(
+            'form_model_estimated_prompt_tokens',
+            'counter',
+            'Prompt tokens counted locally before sending.',
+            [
+                ({'label': label}, row['estimated_prompt_tokens'])
+                for label, row in calls.items()
+            ],
+        )
+        family(
+            'form_model_payload_bytes',
+            'counter',
+            'Request payload bytes sent to the API.',
+            [({'label': label}, row['payload_bytes']) for label, row in calls.items()],
+        )
+        family(
+            'form_model_cache_hits',
+            'counter',
+            'Model calls served from the response cache.',
+            [({'label': label}, row['cache_hits']) for label, row in calls.items()],
+        )
+        family(
+            'form_model_retries',
+            'counter',
+            'Retries of failed model calls.',
+            [({'label': label}, row['retries']) for label, row in calls.items()],
+        )
+        family(
+            'form_model_hedges',
+            'counter',
+            'Model calls that sent a duplicate request to cut tail latency.',
+            [({'label': label}, row['hedges']) for label, row in calls.items()],
+        )
+
+        with self._lock:
+            histograms = dict(self._histograms)
+        name = 'form_model_call_latency_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        lines.append(f'# HELP {name} Wall time of successful model calls.')
+        for label, histogram in histograms.items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'{name}_bucket{{label="{label}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{name}_count{{label="{label}"}} {histogram.count}')
+            lines.append(f'{name}_sum{{label="{label}"}} {histogram.total}')
+
+        family(
+            'form_stage_seconds',
+            'counter',
+            'Total wall time of local pipeline stages.',
+            [({'stage': name}, row['total_seconds']) for name, row in stages.items()],
+        )
+        family(
+            'form_stage_runs',
+            'counter',
+            'Occurrences of local pipeline stages.',
+            [({'stage': name}, row['count']) for name, row in stages.items()],
+        )
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path):
+        """
+        Saves the measurements to a file, in the OpenMetrics text format if the
+        path ends with .prom, otherwise as JSON.
+        """
+        with open(path, 'w', encoding='utf-8') as file:
+            if path.endswith('.prom'):
+                file.write(self.to_openmetrics())
+            else:
+                json.dump(self.to_dict(), file, indent=2)
+
+    def summary_table(self):
+        """Returns the summary as a plain-text table."""
+        summary = self.summary()
+        rows = [
+            f'{"call / stage":<28} {"count":>6} {"total s":>9} {"p50 s":>8} '
+            f'{"p95 s":>8} {"tokens in":>10} {"tokens out":>10} {"bytes":>11} '
+            f'{"hits":>5} {"retries":>7} {"hedges":>6}'
+        ]
+        for label, row in summary['calls'].items():
+            rows.append(
+                f'{label:<28} {row["count"]:>6} {row["total_seconds"]:>9.2f} '
+                f'{row["p50_seconds"]:>8.2f} {row["p95_seconds"]:>8.2f} '
+                f'{row["prompt_tokens"]:>10} {row["completion_tokens"]:>10} '
+                f'{row["payload_bytes"]:>11} {row["cache_hits"]:>5} '
+                f'{row["retries"]:>7} {row["hedges"]:>6}'
+            )
+        for name, row in summary['stages'].items():
+            rows.append(
+                f'{name:<28} {row["count"]:>6} {row["total_seconds"]:>9.2f} '
+                f'{row["p50_seconds"]:>8.2f} {row["p95_seconds"]:>8.2f}'
+            )
+        return '\n'.join(rows)
+
+
+_recorder = MetricsRecorder()  # The recorder shared by the whole process
+
+
+def get_recorder():
+    """Returns the process-wide MetricsRecorder."""
+    return _recorder
@@ -0,0 +1,123 @@
+from dataclasses import dataclass, field
+
+from pdfrw import PdfDict, PdfName, PdfObject, PdfReader, PdfString, PdfWriter
+
+from metrics import get_recorder
+
+NO_ANSWER_VALUES = {'', 'n/a', 'na', 'none', 'unknown'}
+CHECKED_VALUES = {'yes', 'y', 'true', 'checked', 'x', 'on'}
+UNCHECKED_VALUES = {'no', 'n', 'false', 'unchecked', 'off'}
+
+
+@dataclass
+class FillReport:
+    """The outcome of filling answers into a PDF form, field by field."""
+
+    output_path: str
+    filled: dict = field(default_factory=dict)  # Field name -> value written
+    skipped: dict = field(default_factory=dict)  # Field name -> reason
+    invalid: dict = field(default_factory=dict)  # Field name -> reason
+    unknown: list = field(default_factory=list)  # Names that are not fields
+
+
+def normalize_value(form_field, value):
+    """
+    Returns the value to write into the field, or raises ValueError when the
+    value is not allowed for it. Returns None for a value that leaves the
+    field blank, such as an unanswered question or an unchecked box.
+    """
+    value = str(value).strip()
+    if value.lower() in NO_ANSWER_VALUES or 'N/A' in value:
+        return None
+
+    if form_field.field_type == '/Tx':  # Text field
+        return value
+
+    if form_field.field_type in ('/Btn', '/Ch'):  # Buttons and choice fields
+        options = {option.lower(): option for option in form_field.options}
+        if value.lower() in options:
+            return options[value.lower()]
+        if form_field.field_type == '/Btn':
+            if value.lower() in UNCHECKED_VALUES:
+                return None
+            if value.lower() in CHECKED_VALUES and len(form_field.options) == 1:
+                return form_field.options[0]  # A single checkbox
+        raise ValueError(f'{value!r} is not one of {form_field.options}')
+
+    raise ValueError(f'Unsupported field type {form_field.field_type}')
+
+
+def _get_field_name(field_object):
+    """Returns the fully qualified name of a field dictionary."""
+    names = []
+    while field_object is not None:
+        if field_object.T is not None:
+            names.append(field_object.T.to_unicode())
+        field_object = field_object.Parent
+    return '.'.join(reversed(names))
+
+
+def _get_field_object(annotation):
+    """Returns the field dictionary a widget annotation belongs to."""
+    return annotation if annotation.T is not None else annotation.Parent
+
+
+def write_values(input_path, output_path, values):
+    """
+    Writes text, checkbox, radio and choice values into the PDF form in one
+    in-memory pass over its widget annotations. The values must already be
+    valid for their fields; see normalize_value().
+    """
+    template = PdfReader(input_path)
+    for page in template.pages:
+        for annotation in page.Annots or []:
+            if annotation.Subtype != '/Widget':
+                continue
+            field_object = _get_field_object(annotation)
+            name = _get_field_name(field_object)
+            if name not in values:
+                continue
+
+            value = values[name]
+            field_type = field_object.inheritable.FT
+            if field_type == '/Btn':
+                # Turn on the widget whose on-state is the value, if any
+                on_states = annotation.AP.N.keys() if annotation.AP else []
+                state = PdfName(value) if f'/{value}' in on_states else PdfName('Off')
+                annotation.AS = state
+                field_object.V = PdfName(value)
+            else:
+                field_object.V = PdfString.encode(value)
+                annotation.AP = None  # Let the viewer regenerate the appearance
+
+    if template.Root.AcroForm:
+        template.Root.AcroForm.update(PdfDict(NeedAppearances=PdfObject('true')))
+    PdfWriter().write(output_path, template)
+
+
+def fill_pdf(schema, input_path, output_path, answers):
+    """
+    Fills the answers, a dictionary of field names to values, into the PDF
+    form in a single read and write. Every value is validated against the
+    field's type and options first; fields that fail are reported in the
+    returned FillReport instead of being written.
+    """
+    report = FillReport(output_path)
+    for name, value in answers.items():
+        form_field = schema.get_field(name)
+        if form_field is None:
+            report.unknown.append(name)
+            continue
+        try:
+            normalized = normalize_value(form_field, value)
+        except ValueError as e:
+            report.invalid[name] = str(e)
+            continue
+        if normalized is None:
+            report.skipped[name] = f'No value to write for {value!r}'
+        else:
+            report.filled[name] = normalized
+
+    with get_recorder().stage('pdf_fill'):
+        write_values(input_path, output_path, report.filled)
+    return report
@@ -0,0 +1,250 @@
+import logging
+import math
+import os
+import threading
+
+CHARS_PER_TOKEN = 4  # The estimate used when the tokenizer is unavailable
+DEFAULT_ENCODING = 'cl100k_base'  # The tokenizer of the GPT-4 models
+MESSAGE_OVERHEAD_TOKENS = 4  # Tokens each chat message adds around its content
+DEFAULT_MODEL = 'AZURE_OPENAI_GPT4_DEPLOYMENT'  # The variable naming the vision model
+# Prompt tokens a request may hold by the variable naming its deployment,
+# leaving room in the context for the reply
+MAX_PROMPT_TOKENS = {
+    'AZURE_OPENAI_GPT4_DEPLOYMENT': 120000,  # A 128k context
+    'AZURE_OPENAI_GPT_TURBO_DEPLOYMENT': 12000,  # A 16k context; 3000 fits a 4k one
+}
+DEFAULT_MAX_PROMPT_TOKENS = MAX_PROMPT_TOKENS[DEFAULT_MODEL]
+
+_encoding = None  # The tiktoken encoding, False when it cannot be loaded
+_encoding_lock = threading.Lock()
+_max_prompt_tokens = {}  # Budgets set by set_max_prompt_tokens(), by variable
+
+
+class PromptTooLong(ValueError):
+    """Raised when a prompt does not fit its token budget."""
+
+
+def set_max_prompt_tokens(model, max_tokens):
+    """
+    Sets the prompt token budget of the deployment named by the environment
+    variable `model`, e.g. from a --max-prompt-tokens flag. None restores
+    the configured budget.
+    """
+    if max_tokens is None:
+        _max_prompt_tokens.pop(model, None)
+    else:
+        _max_prompt_tokens[model] = max_tokens
+
+
+def get_max_prompt_tokens(model=DEFAULT_MODEL):
+    """
+    Returns the prompt token budget of the deployment named by the environment
+    variable `model`: the one set by set_max_prompt_tokens(), else the
+    variable with _DEPLOYMENT replaced by _MAX_PROMPT_TOKENS (e.g.
+    AZURE_OPENAI_GPT_TURBO_MAX_PROMPT_TOKENS), else MAX_PROMPT_TOKENS.
+    """
+    if model in _max_prompt_tokens:
+        return _max_prompt_tokens[model]
+    value = os.getenv(model.removesuffix('_DEPLOYMENT') + '_MAX_PROMPT_TOKENS')
+    if value:
+        return int(value)
+    return MAX_PROMPT_TOKENS.get(model, DEFAULT_MAX_PROMPT_TOKENS)
+
+
+def get_encoding():
+    """
+    Returns the tiktoken encoding used to count tokens, or None when tiktoken
+    or its encoding files are unavailable, in which case tokens are estimated
+    from the number of characters.
+    """
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+
+                _encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+            except Exception as e:  # Not installed, or no network to fetch it
+                logging.warning(f'Estimating tokens from characters ({e})')
+                _encoding = False
+        return _encoding or None
+
+
+def count_tokens(text):
+    """Returns the number of tokens of a text."""
+    encoding = get_encoding()
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages):
+    """
+    Returns the text tokens of chat messages, counting the text parts of
+    messages with images but not the images themselves.
+    """
+    tokens = 0
+    for message in messages:
+        content = message.get('content') or ''
+        if isinstance(content, str):
+            tokens += count_tokens(content)
+        else:
+            tokens += sum(
+                count_tokens(part['text'])
+                for part in content
+                if part.get('type') == 'text'
+            )
+        tokens += MESSAGE_OVERHEAD_TOKENS
+    return tokens
+
+
+def _cut_line(line, max_tokens):
+    """Returns the longest start of a line that fits in max_tokens tokens."""
+    piece = line[: max_tokens * CHARS_PER_TOKEN]
+    while piece and count_tokens(piece) > max_tokens:
+        piece = piece[: len(piece) * 9 // 10]
+    return piece
+
+
+def split_to_tokens(text, max_tokens):
+    """
+    Splits the text into chunks of whole lines of at most max_tokens tokens
+    each. Lines longer than that are cut into pieces.
+    """
+    if max_tokens <= 0:
+        raise ValueError('max_tokens must be positive')
+    chunks = []
+    lines = []
+    tokens = 0
+    for line in text.splitlines(keepends=True):
+        line_tokens = count_tokens(line)
+        while line_tokens > max_tokens:
+            piece = _cut_line(line, max_tokens) or line[:1]
+            if lines:
+                chunks.append(''.join(lines))
+                lines, tokens = [], 0
+            chunks.append(piece)
+            line = line[len(piece) :]
+            line_tokens = count_tokens(line)
+        if lines and tokens + line_tokens > max_tokens:
+            chunks.append(''.join(lines))
+            lines, tokens = [], 0
+        if line:
+            lines.append(line)
+            tokens += line_tokens
+    if lines:
+        chunks.append(''.join(lines))
+    return chunks
+
+
+def trim_to_tokens(text, max_tokens, keep='start'):
+    """
+    Returns the whole lines of the text that fit in max_tokens tokens, taken
+    from its start, or from its end when keep is 'end' (e.g. the latest turns
+    of a conversation).
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ''
+    if keep != 'end':
+        return split_to_tokens(text, max_tokens)[0]
+
+    kept = []
+    tokens = 0
+    for line in reversed(text.splitlines(keepends=True)):
+        line_tokens = count_tokens(line)
+        if tokens + line_tokens > max_tokens:
+            break
+        kept.append(line)
+        tokens += line_tokens
+    if not kept:  # The last line alone is too long, so keep its end
+        return split_to_tokens(text, max_tokens)[-1]
+    return ''.join(reversed(kept))
+
+
+class PromptBuilder:
+    """
+    Builds a chat prompt from a stable prefix and per-claim content.
+
+    The prefix holds what is the same for every claim of a form template: the
+    instructions and the field lists. The content holds what varies, such as
+    the EMR or the conversation, and always comes after the prefix, so that
+    repeated requests share their leading tokens and the provider's prompt
+    cache can match them. Tokens are counted locally, and fit() trims the
+    content to a budget before anything is sent.
+    """
+
+    def __init__(self, system=None):
+        self._system = system  # The system message, part of the prefix
+        self._prefix = []  # The texts of the stable prefix
+        self._content = []  # [heading, text, keep] of the per-claim content
+
+    def add_prefix(self, text):
+        """Appends instructions or field lists to the stable prefix."""
+        self._prefix.append(text)
+        return self
+
+    def add_content(self, text, heading=None, keep='start'):
+        """
+        Appends per-claim content under an optional heading. When the prompt
+        is fitted to a budget, the content is trimmed from its end, or from
+        its start when keep is 'end'.
+        """
+        self._content.append([heading, text, keep])
+        return self
+
+    @property
+    def prefix(self):
+        """Returns the text of the stable prefix of the user message."""
+        return '\n\n'.join(self._prefix)
+
+    def build(self):
+        """Returns the text of the user message."""
+        sections = list(self._prefix)
+        for heading, text, _ in self._content:
+            sections.append(f'{heading}:\n"""\n{text}\n"""' if heading else text)
+        return '\n\n'.join(sections)
+
+    def messages(self):
+        """Returns the chat messages of the prompt."""
+        messages = []
+        if self._system:
+            messages.append({'role': 'system', 'content': self._system})
+        messages.append({'role': 'user', 'content': self.build()})
+        return messages
+
+    def count_tokens(self):
+        """Returns the estimated text tokens of the prompt."""
+        return count_message_tokens(self.messages())
+
+    def fit(self, max_tokens=DEFAULT_MAX_PROMPT_TOKENS):
+        """
+        Trims the content, longest first, until the prompt fits in max_tokens.
+        Raises PromptTooLong when even the prefix alone does not fit.
+        """
+        excess = self.count_tokens() - max_tokens
+        while excess > 0:
+            sizes = [count_tokens(text) for _, text, _ in self._content]
+            if not sizes or max(sizes) == 0:
+                raise PromptTooLong(
+                    f'The prompt prefix alone exceeds {max_tokens} tokens'
+                )
+            index = sizes.index(max(sizes))
+            heading, text, keep = self._content[index]
+            trimmed = trim_to_tokens(text, max(0, sizes[index] - excess), keep)
+            logging.warning(
+                f'Trimmed {heading or "the prompt content"} from '
+                f'{sizes[index]} to {count_tokens(trimmed)} tokens to fit '
+                f'{max_tokens} prompt tokens'
+            )
+            self._content[index][1] = trimmed
+            excess = self.count_tokens() - max_tokens
+        return self
+
+    def content_budget(self, max_tokens=DEFAULT_MAX_PROMPT_TOKENS):
+        """
+        Returns the tokens left for more content in a prompt of max_tokens,
+        e.g. to split a long text into chunks that each fit beside the rest.
+        """
+        return max_tokens - self.count_tokens() - 16  # 16 for a heading
@@ -0,0 +1,206 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image
+
+import json
+import logging
+import mmap
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows, where renders are only locked within a process
+    fcntl = None
+
+from files import write_atomic
+from image_encoding import EncodedImage, ImageOptimizer
+from metrics import get_recorder
+
+STORE_VERSION = 2  # Bump to ignore every page written by older code
+DEFAULT_RENDER_DIRECTORY = '.cache/renders'
+DEFAULT_THREAD_COUNT = min(4, os.cpu_count() or 1)  # Poppler processes per render
+EXTENSIONS = {'image/jpeg': 'jpg', 'image/png': 'png'}
+
+
+class RenderStore:
+    """
+    An on-disk store of encoded page images, shared by every thread and
+    process that uses the same directory.
+
+    Pages are keyed by the PDF hash, the page number, the DPI, grayscale and
+    the ImageOptimizer settings, so each blank form template is rasterized and
+    encoded once. Stored pages are read through read-only memory maps, which
+    the operating system's page cache shares between processes, so workers
+    filling the same template send its pages without copying or re-encoding
+    them. A missing page is rendered together with the `thread_count` pages
+    after it, by that many poppler processes in parallel. Renders into the
+    same directory are serialized by a lock file, so processes that miss the
+    same page at once render it only once.
+    """
+
+    def __init__(
+        self, directory=DEFAULT_RENDER_DIRECTORY, thread_count=DEFAULT_THREAD_COUNT
+    ):
+        self._directory = directory
+        self._thread_count = max(1, thread_count)
+        self._maps = {}  # Open memory maps by file path
+        self._render_locks = {}  # Locks by variant directory, one render at a time
+        self._lock = threading.Lock()
+
+    def get_page_count(self, path, pdf_hash):
+        """Returns the number of pages of the PDF, stored after the first call."""
+        info_path = os.path.join(self._get_form_directory(pdf_hash), 'info.json')
+        if os.path.exists(info_path):
+            with open(info_path, 'r', encoding='utf-8') as file:
+                return json.load(file)['pages']
+
+        with get_recorder().stage('pdf_info'):
+            page_count = pdfinfo_from_path(path)['Pages']
+        write_atomic(info_path, json.dumps({'pages': page_count}).encode('utf-8'))
+        return page_count
+
+    def get(
+        self,
+        path,
+        pdf_hash,
+        page_number,
+        page_count,
+        dpi,
+        grayscale=False,
+        optimizer=None,
+    ):
+        """
+        Returns the EncodedImage of the page number of the PDF at path, whose
+        data is a read-only memory map of the stored page. The page and the
+        ones after it are rendered and stored first if it is missing.
+        """
+        optimizer = optimizer or ImageOptimizer()
+        directory = self._get_variant_directory(pdf_hash, dpi, grayscale, optimizer)
+        encoded = self._read(directory, page_number)
+        if encoded is not None:
+            return encoded
+
+        with self._get_render_lock(directory), _lock_file(directory):
+            # Another thread or process may have rendered it while this one waited
+            encoded = self._read(directory, page_number)
+            if encoded is None:
+                last_page = min(page_count, page_number + self._thread_count) - 1
+                self._render(
+                    path, directory, page_number, last_page, dpi, grayscale, optimizer
+                )
+                encoded = self._read(directory, page_number)
+        return encoded
+
+    def close(self):
+        """Closes the memory maps of the pages read so far."""
+        with self._lock:
+            maps, self._maps = self._maps, {}
+        for page_map in maps.values():
+            page_map.close()
+
+    def _get_form_directory(self, pdf_hash):
+        """Returns the directory of the pages of a PDF."""
+        return os.path.join(self._directory, f'v{STORE_VERSION}', pdf_hash)
+
+    def _get_variant_directory(self, pdf_hash, dpi, grayscale, optimizer):
+        """Returns the directory of the pages of a PDF rendered and encoded alike."""
+        variant = f'{dpi}dpi-{"gray" if grayscale else "color"}-{optimizer.get_key()}'
+        return os.path.join(self._get_form_directory(pdf_hash), variant)
+
+    def _get_render_lock(self, directory):
+        """Returns the lock that serializes the renders into a directory."""
+        with self._lock:
+            return self._render_locks.setdefault(directory, threading.Lock())
+
+    def _read(self, directory, page_number):
+        """Returns the stored EncodedImage of the page, or None if missing."""
+        meta_path = os.path.join(directory, f'{page_number:04d}.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        data_path = os.path.join(directory, meta['file'])
+
+        with self._lock:
+            page_map = self._maps.get(data_path)
+            if page_map is None:
+                with open(data_path, 'rb') as file:
+                    page_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[data_path] = page_map
+        return EncodedImage(
+            page_map,
+            meta['mime_type'],
+            meta['width'],
+            meta['height'],
+            meta['quality'],
+            meta['estimated_tokens'],
+        )
+
+    def _render(
+        self, path, directory, first_page, last_page, dpi, grayscale, optimizer
+    ):
+        """Renders, encodes and stores the pages from first_page to last_page."""
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=directory) as output_folder:
+            with get_recorder().stage('rasterize'):
+                # pdf2image splits the page range between thread_count poppler
+                # processes, which write the images to output_folder
+                image_paths = convert_from_path(
+                    path,
+                    dpi=dpi,
+                    grayscale=grayscale,
+                    first_page=first_page + 1,
+                    last_page=last_page + 1,
+                    thread_count=min(self._thread_count, last_page - first_page + 1),
+                    output_folder=output_folder,
+                    paths_only=True,
+                )
+            # poppler names the images <prefix>-<page>.ppm, with a random
+            # prefix per thread, so the page is read from the name
+            pages = {
+                int(os.path.splitext(image_path)[0].rsplit('-', 1)[1]) - 1: image_path
+                for image_path in image_paths
+            }
+
+            def store_page(page_number, image_path):
+                with Image.open(image_path) as image:
+                    with get_recorder().stage('encode'):
+                        encoded = optimizer.encode(image)
+                name = f'{page_number:04d}.{EXTENSIONS[encoded.mime_type]}'
+                write_atomic(os.path.join(directory, name), encoded.data)
+                meta = {
+                    'file': name,
+                    'mime_type': encoded.mime_type,
+                    'width': encoded.width,
+                    'height': encoded.height,
+                    'quality': encoded.quality,
+                    'estimated_tokens': encoded.estimated_tokens,
+                }
+                # The metadata is written last, marking the page as complete
+                write_atomic(
+                    os.path.join(directory, f'{page_number:04d}.json'),
+                    json.dumps(meta).encode('utf-8'),
+                )
+
+            with ThreadPoolExecutor(max_workers=self._thread_count) as executor:
+                list(executor.map(store_page, pages.keys(), pages.values()))
+        logging.debug(
+            f'Stored pages {first_page + 1}-{last_page + 1} of {path} in {directory}'
+        )
+
+
+@contextmanager
+def _lock_file(directory):
+    """Holds an exclusive lock on the directory's lock file, across processes."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'a') as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_UN)
@@ -0,0 +1,235 @@
+from functools import partial
+
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from api_calls import DEFAULT_MAX_RETRIES, get_call_limits, send_with_retries
+from files import write_atomic
+from metrics import get_recorder
+
+DEFAULT_INDEX_DIRECTORY = '.cache/embeddings'
+DEFAULT_EMBEDDING_DEPLOYMENT = 'text-embedding-ada-002'
+DEFAULT_TOP_K = 4  # Passages retrieved per question
+DEFAULT_THRESHOLD = 12000  # Texts shorter than this many characters are sent whole
+
+
+def chunk_text(text, max_chars=800):
+    """Splits the text into passages of about max_chars, keeping paragraphs whole."""
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if len(paragraph) <= max_chars:
+            if paragraph:
+                pieces.append(paragraph)
+            continue
+        # Split long paragraphs at sentence boundaries
+        pieces.extend(s for s in re.split(r'(?<=[.!?])\s+', paragraph) if s)
+
+    chunks = []
+    current = ''
+    for piece in pieces:
+        if current and len(current) + len(piece) + 2 > max_chars:
+            chunks.append(current)
+            current = ''
+        current = f'{current}\n\n{piece}' if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class HashingEmbedder:
+    """A local, deterministic embedder of hashed words and word pairs."""
+
+    def __init__(self, dimensions=512):
+        self._dimensions = dimensions
+        self.name = f'hashing-{dimensions}'  # Part of the persisted index key
+
+    def embed(self, texts):
+        """Returns a normalized (len(texts), dimensions) array of embeddings."""
+        vectors = np.zeros((len(texts), self._dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r'[a-z0-9]+', text.lower())
+            for feature in words + [f'{a} {b}' for a, b in zip(words, words[1:])]:
+                digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8)
+                value = int.from_bytes(digest.digest(), 'little')
+                sign = 1.0 if value & 1 else -1.0
+                vectors[row, (value >> 1) % self._dimensions] += sign
+        return _normalize(vectors)
+
+
+class AzureEmbedder:
+    """An embedder backed by an Azure OpenAI embeddings deployment."""
+
+    def __init__(
+        self,
+        client,
+        deployment=None,
+        batch_size=16,
+        rate_limiter=None,
+        max_retries=DEFAULT_MAX_RETRIES,
+    ):
+        self._client = client
+        self._deployment = deployment or os.getenv(
+            'AZURE_OPENAI_EMBEDDING_DEPLOYMENT', DEFAULT_EMBEDDING_DEPLOYMENT
+        )
+        self._batch_size = batch_size
+        self._rate_limiter = rate_limiter  # Shared with the chat requests, if given
+        self._max_retries = max_retries
+        self.name = f'azure-{self._deployment}'  # Part of the persisted index key
+
+    def embed(self, texts):
+        """Returns a normalized (len(texts), dimensions) array of embeddings."""
+        vectors = []
+        for start in range(0, len(texts), self._batch_size):
+            response = self._send(texts[start : start + self._batch_size])
+            vectors.extend(item.embedding for item in response.data)
+        return _normalize(np.array(vectors, dtype=np.float32))
+
+    def _send(self, texts):
+        """Returns the embeddings response of one batch of texts."""
+        timeout, deadline = get_call_limits()
+        counts = {'retries': 0}
+        start_time = time.perf_counter()
+        status = 'error'
+        usage = None
+        try:
+            response = send_with_retries(
+                partial(
+                    self._client.embeddings.create, model=self._deployment, input=texts
+                ),
+                time.monotonic() + deadline,
+                counts,
+                timeout,
+                self._max_retries,
+                self._rate_limiter,
+            )
+            status = 'ok'
+            usage = response.usage
+            return response
+        finally:
+            get_recorder().record_call(
+                'embedding',
+                model=self._deployment,
+                wall_time=time.perf_counter() - start_time,
+                prompt_tokens=usage.prompt_tokens if usage else None,
+                payload_bytes=len(json.dumps(texts)),
+                retries=counts['retries'],
+                status=status,
+            )
+
+
+def _normalize(vectors):
+    """Returns the row vectors scaled to unit length."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class EmbeddingIndex:
+    """The passages of a text and their embeddings, searched by cosine similarity."""
+
+    def __init__(self, chunks, vectors):
+        self.chunks = chunks  # The passages in document order
+        self.vectors = vectors  # One normalized embedding per passage
+
+    @classmethod
+    def build(cls, text, embedder):
+        """Returns the index of the text's passages."""
+        chunks = chunk_text(text)
+        vectors = embedder.embed(chunks) if chunks else np.zeros((0, 1), np.float32)
+        return cls(chunks, vectors)
+
+    def search(self, query_vectors, top_k=DEFAULT_TOP_K):
+        """Returns the positions of the top_k passages for each query vector."""
+        if not self.chunks:
+            return [[] for _ in query_vectors]
+        scores = np.asarray(query_vectors) @ self.vectors.T
+        top_k = min(top_k, len(self.chunks))
+        best = np.argsort(-scores, axis=1)[:, :top_k]
+        return [list(row) for row in best]
+
+    def save(self, path):
+        """Saves the index to a .npz file, atomically."""
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, chunks=np.array(self.chunks), vectors=self.vectors)
+        write_atomic(path, buffer.getvalue())
+
+    @classmethod
+    def load(cls, path):
+        """Returns the index saved at the path."""
+        with np.load(path, allow_pickle=False) as data:
+            return cls([str(chunk) for chunk in data['chunks']], data['vectors'])
+
+
+class Retriever:
+    """Selects the passages of a long record relevant to groups of questions."""
+
+    def __init__(
+        self,
+        embedder,
+        directory=DEFAULT_INDEX_DIRECTORY,
+        top_k=DEFAULT_TOP_K,
+        threshold=DEFAULT_THRESHOLD,
+    ):
+        self._embedder = embedder
+        self._directory = directory
+        self._top_k = top_k
+        self._threshold = threshold  # Shorter texts are not worth retrieving from
+        self._indexes = {}  # Indexes already loaded by this process, by path
+        self._build_locks = {}  # Locks by path, so each index is built once
+        self._lock = threading.Lock()
+
+    def should_retrieve(self, text):
+        """Returns whether the text is long enough to retrieve passages from."""
+        return len(text) > self._threshold
+
+    def get_index(self, text, owner='default'):
+        """Returns the index of the text, loading or building it as needed."""
+        key = hashlib.sha256(f'{self._embedder.name}\0{text}'.encode('utf-8'))
+        owner = re.sub(r'[^A-Za-z0-9_.-]+', '_', owner)
+        path = os.path.join(self._directory, f'{owner}-{key.hexdigest()[:16]}.npz')
+
+        with self._lock:
+            if path in self._indexes:
+                return self._indexes[path]
+            build_lock = self._build_locks.setdefault(path, threading.Lock())
+
+        # Threads asking for the same index wait for the first one to build it
+        with build_lock:
+            with self._lock:
+                if path in self._indexes:
+                    return self._indexes[path]
+
+            if os.path.exists(path):
+                index = EmbeddingIndex.load(path)
+            else:
+                with get_recorder().stage('embed_index'):
+                    index = EmbeddingIndex.build(text, self._embedder)
+                os.makedirs(self._directory, exist_ok=True)
+                index.save(path)
+
+            with self._lock:
+                self._indexes[path] = index
+        return index
+
+    def get_contexts(self, text, query_groups, owner='default'):
+        """Returns the top-k passages of each group of queries, in document order."""
+        index = self.get_index(text, owner)
+        queries = [query for group in query_groups for query in group]
+        with get_recorder().stage('embed_queries'):
+            query_vectors = self._embedder.embed(queries) if queries else []
+        hits = iter(index.search(query_vectors, self._top_k))
+
+        contexts = []
+        for group in query_groups:
+            positions = set()
+            for _ in group:
+                positions.update(next(hits))
+            contexts.append('\n\n'.join(index.chunks[p] for p in sorted(positions)))
+        return contexts
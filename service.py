@@ -0,0 +1,391 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from openai import AzureOpenAI
+
+import argparse
+import base64
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+import httpx
+
+from answer import TEXT_MODEL, complete_answers, create_client, fill_answers
+from answers import answers_to_dict
+from cache import DEFAULT_CACHE_PATH, ResponseCache
+from form_schema import load_form_schema
+from metrics import get_recorder
+from pdf_filler import FillReport
+from render_store import DEFAULT_RENDER_DIRECTORY, RenderStore
+from retrieval import AzureEmbedder, Retriever
+from vision import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_DPI,
+    OpenAIRequestLibrary,
+    PDFEncoder,
+    RateLimiter,
+    add_call_limit_arguments,
+    apply_call_limits,
+    init,
+    parse_and_predict,
+)
+
+DEFAULT_PORT = 8080
+MAX_WARM_TEMPLATES = 16  # Form templates whose encoded pages are kept in memory
+MAX_METRICS_RECORDS = 10000  # Latest calls and stages kept for /metrics
+
+
+@dataclass
+class FillResult:
+    """The answers and filled PDF of one claim."""
+
+    answers: dict  # AnswerLines by field name
+    report: FillReport
+    pdf: bytes | None = None  # The filled PDF, unless it was written to a path
+
+
+class FormFiller:
+    """
+    Fills forms from an EMR and a conversation in memory, running the vision,
+    answer and fill steps back to back. The Azure OpenAI clients and their
+    connection pool, the response cache, the request budget, the parsed form
+    templates and their rendered pages are created once and shared by every
+    call, from any number of threads. With a RenderStore, rendered pages are
+    also shared with other processes and kept across restarts.
+    """
+
+    def __init__(
+        self,
+        cache=None,
+        concurrency=DEFAULT_CONCURRENCY,
+        requests_per_minute=None,
+        max_connections=None,
+        dpi=DEFAULT_DPI,
+        optimizer=None,
+        retriever=None,
+        render_store=None,
+    ):
+        init()
+        self._cache = cache
+        self._concurrency = concurrency
+        self._rate_limiter = RateLimiter(requests_per_minute)
+        self._dpi = dpi
+        self._optimizer = optimizer
+        self._render_store = render_store  # Rendered pages shared across processes
+
+        # One keep-alive connection pool for the vision and text clients
+        max_connections = max_connections or max(1, concurrency) * 2
+        http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            )
+        )
+        OpenAIRequestLibrary.set_openai_client(
+            AzureOpenAI(max_retries=0, http_client=http_client)
+        )
+        self._text_client = create_client(http_client=http_client)
+        self._text_model = os.getenv(TEXT_MODEL)
+        # Long records are indexed once per patient and reused across forms
+        self._retriever = retriever or Retriever(
+            AzureEmbedder(
+                OpenAIRequestLibrary.get_openai_client(),
+                rate_limiter=self._rate_limiter,
+            )
+        )
+
+        self._encoders = OrderedDict()  # PDFEncoders by PDF hash, least recent first
+        self._encoders_lock = threading.Lock()
+
+    def get_encoder(self, form_path):
+        """
+        Returns the PDFEncoder of a form template, which keeps every page it
+        has encoded for the next claim on the same template. The rendered
+        images are dropped once encoded, as only the encoded bytes are sent.
+        """
+        schema = load_form_schema(form_path)
+        with self._encoders_lock:
+            encoder = self._encoders.get(schema.pdf_hash)
+            if encoder is not None:
+                self._encoders.move_to_end(schema.pdf_hash)
+                return encoder
+
+        encoder = PDFEncoder(
+            form_path,
+            dpi=self._dpi,
+            max_cached_pages=0,
+            optimizer=self._optimizer,
+            render_store=self._render_store,
+        )
+        with self._encoders_lock:
+            encoder = self._encoders.setdefault(schema.pdf_hash, encoder)
+            while len(self._encoders) > MAX_WARM_TEMPLATES:
+                self._encoders.popitem(last=False)
+        return encoder
+
+    def fill(
+        self, form_path, emr_text, conversation_text, output=None, patient_id=None
+    ):
+        """
+        Fills the form at form_path from the EMR and conversation texts and
+        returns the FillResult. The filled PDF is written to the output path
+        if one is given, otherwise it is returned in the result.
+        """
+        patient_id = patient_id or 'default'
+        _, answers = parse_and_predict(
+            form_path,
+            emr_text,
+            cache=self._cache,
+            retriever=self._retriever,
+            patient_id=patient_id,
+            concurrency=self._concurrency,
+            rate_limiter=self._rate_limiter,
+            encoder=self.get_encoder(form_path),
+        )
+        answers = complete_answers(
+            self._text_client,
+            self._text_model,
+            answers,
+            conversation_text,
+            cache=self._cache,
+            retriever=self._retriever,
+            patient_id=patient_id,
+        )
+
+        if output is not None:
+            return FillResult(answers, fill_answers(form_path, answers, output))
+        buffer = io.BytesIO()
+        report = fill_answers(form_path, answers, buffer)
+        report.output_path = None
+        return FillResult(answers, report, buffer.getvalue())
+
+
+_default_filler = None  # The FormFiller used by fill_form(), created on first use
+_default_filler_lock = threading.Lock()
+
+
+def get_default_filler():
+    """Returns the process-wide FormFiller, using the default response cache."""
+    global _default_filler
+    with _default_filler_lock:
+        if _default_filler is None:
+            _default_filler = FormFiller(cache=ResponseCache(DEFAULT_CACHE_PATH))
+        return _default_filler
+
+
+def fill_form(form, emr, conversation, output=None, patient_id=None):
+    """
+    Fills the PDF form at the path `form` from the EMR and conversation texts,
+    and returns the FillResult. State is kept warm between calls in the same
+    process; see FormFiller.
+    """
+    return get_default_filler().fill(
+        form, emr, conversation, output=output, patient_id=patient_id
+    )
+
+
+class FormFillingHandler(BaseHTTPRequestHandler):
+    """
+    Serves the FormFiller of the server over HTTP:
+
+    - POST /fill with a JSON body of form (a path on this host), emr and
+      conversation (texts), and optional output (a path) and patient_id.
+      Paths are relative to the server's root directory, and paths outside
+      it are rejected. Replies with the answers, the fill report and, without
+      an output path, the filled PDF in base64.
+    - GET /health replies with {"status": "ok"}.
+    - GET /metrics replies with the metrics in the OpenMetrics text format.
+    """
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            body = get_recorder().to_openmetrics().encode('utf-8')
+            self._send(200, 'application/openmetrics-text; version=1.0.0', body)
+        else:
+            self._send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/fill':
+            self._send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError('Expected a JSON object')
+            missing = [
+                key for key in ('form', 'emr', 'conversation') if key not in request
+            ]
+            if missing:
+                raise ValueError(f'Missing {missing}')
+            form_path = self._resolve_path(request['form'])
+            output_path = (
+                self._resolve_path(request['output']) if request.get('output') else None
+            )
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        start_time = time.time()
+        try:
+            result = self.server.filler.fill(
+                form_path,
+                request['emr'],
+                request['conversation'],
+                output=output_path,
+                patient_id=request.get('patient_id'),
+            )
+        except Exception as e:
+            logging.exception('Filling failed')
+            self._send_json(500, {'error': f'{type(e).__name__}: {e}'})
+            return
+
+        response = {
+            'answers': answers_to_dict(result.answers),
+            'filled': result.report.filled,
+            'skipped': result.report.skipped,
+            'invalid': result.report.invalid,
+            'unknown': result.report.unknown,
+            'output': result.report.output_path,
+            'seconds': round(time.time() - start_time, 3),
+        }
+        if result.pdf is not None:
+            response['pdf'] = base64.b64encode(result.pdf).decode('ascii')
+        self._send_json(200, response)
+
+    def _resolve_path(self, path):
+        """
+        Returns the real path of a requested path under the server's root
+        directory, or raises ValueError if it leads outside of it.
+        """
+        if not isinstance(path, str):
+            raise ValueError(f'Expected a path, got {path!r}')
+        root = self.server.root
+        resolved = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, resolved]) != root:
+            raise ValueError(f'{path} is outside the served directory')
+        return resolved
+
+    def log_message(self, format, *args):
+        logging.info(f'{self.address_string()} {format % args}')
+
+    def _send_json(self, status, data):
+        """Sends a JSON response."""
+        self._send(status, 'application/json', json.dumps(data).encode('utf-8'))
+
+    def _send(self, status, content_type, body):
+        """Sends a response with the body."""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def parse_arguments():
+    """
+    Returns an argparse Namespace object that contains the parsing result of
+    the command-line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description='Serves form filling over HTTP with warm clients and caches.'
+    )
+    parser.add_argument('--host', default='127.0.0.1', help='The address to bind.')
+    parser.add_argument(
+        '--root',
+        default='.',
+        help='The directory that the form and output paths of requests are '
+        'resolved in; paths outside it are rejected.',
+    )
+    parser.add_argument(
+        '--port', type=int, default=DEFAULT_PORT, help='The port to listen on.'
+    )
+    parser.add_argument(
+        '-c',
+        '--concurrency',
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help='The maximum number of page requests in flight per claim.',
+    )
+    parser.add_argument(
+        '--requests-per-minute',
+        type=float,
+        default=None,
+        help='The vision request budget per minute shared by all claims.',
+    )
+    add_call_limit_arguments(parser, hedging=True)
+    parser.add_argument(
+        '--cache-path',
+        default=DEFAULT_CACHE_PATH,
+        help='The path to the response cache database.',
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Always sends requests to the API instead of using the cache.',
+    )
+    parser.add_argument(
+        '--render-store-path',
+        default=DEFAULT_RENDER_DIRECTORY,
+        help='The directory of the rendered and encoded form pages shared '
+        'between claims and runs.',
+    )
+    parser.add_argument(
+        '--no-render-store',
+        action='store_true',
+        help='Renders the form pages in memory instead.',
+    )
+    parser.add_argument(
+        '-v', '--verbose', action='store_true', help='Prints debugging output.'
+    )
+    return parser.parse_args()
+
+
+def main():
+    """
+    The entry point of the script.
+    """
+    args = parse_arguments()
+    logging.basicConfig(
+        format='[%(filename)s:%(lineno)d:%(funcName)s()] %(message)s',
+        level=logging.DEBUG if args.verbose else logging.INFO,
+    )
+
+    # The latencies of every claim served so far set the hedge threshold
+    apply_call_limits(args)
+
+    # The server runs indefinitely, so only the latest measurements are kept
+    get_recorder().set_max_records(MAX_METRICS_RECORDS)
+
+    cache = None if args.no_cache else ResponseCache(args.cache_path)
+    render_store = None if args.no_render_store else RenderStore(args.render_store_path)
+    server = ThreadingHTTPServer((args.host, args.port), FormFillingHandler)
+    server.root = os.path.realpath(args.root)
+    server.filler = FormFiller(
+        cache=cache,
+        concurrency=args.concurrency,
+        requests_per_minute=args.requests_per_minute,
+        render_store=render_store,
+    )
+    logging.info(f'Serving on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    #   Example usage:
+    #       python service.py --port 8080
+    #       curl -X POST localhost:8080/fill -d '{"form": "input/form/disability.pdf",
+    #            "emr": "...", "conversation": "...", "output": "answered.pdf"}'
+    main()
@@ -0,0 +1,294 @@
+from dataclasses import asdict, dataclass, field
+
+import re
+
+import PyPDF2
+
+from form_schema import DEFAULT_SCHEMA_DIRECTORY, load_form_schema, save_form_schema
+from metrics import get_recorder
+
+MIN_PAGE_CONFIDENCE = 0.8  # Pages with fewer fields resolved go to the vision model
+LINE_TOLERANCE = 4.0  # Points a label baseline may sit above or below a widget
+CAPTION_DISTANCE = 14.0  # Points below a widget that a caption may start
+CAPTION_FONT_SIZE = 7.0  # Captions such as "Day Month Year" use small fonts
+# Field names that say nothing about the question, such as "Text10"
+GENERIC_FIELD_NAME = re.compile(
+    r'^(text|field|check ?box|button|other|untitled)[\s_-]*\d*$', re.IGNORECASE
+)
+# Words too common to tie a label to a field name
+STOP_WORDS = {'and', 'any', 'are', 'for', 'the', 'you', 'your', 'yes'}
+STEM_LENGTH = 5  # Leading letters compared, so "hospitalized" matches "Hospitalization"
+MIN_LEADING_WORDS = 5  # Words before a field's own name that belong to another label
+
+
+@dataclass
+class TextRun:
+    """A run of text on a page, positioned at its baseline in PDF user space."""
+
+    x: float
+    y: float
+    size: float
+    text: str
+
+
+@dataclass
+class PageQuestions:
+    """The questions of one page built from the form's text layer."""
+
+    page: int  # 0-indexed
+    lines: dict = field(default_factory=dict)  # Field name -> question line
+    # Names with neither a plausible label nor a telling name or tooltip
+    unresolved: list = field(default_factory=list)
+
+    @property
+    def confidence(self):
+        """Returns the fraction of the page's fields with a question line."""
+        total = len(self.lines) + len(self.unresolved)
+        return len(self.lines) / total if total else 0.0
+
+
+def get_text_runs(page):
+    """Returns the text runs of a PyPDF2 page, without fill-in underscores."""
+    runs = []
+
+    def visit(text, cm, tm, font_dict, font_size):
+        text = re.sub(r'\s+', ' ', text.replace('_', ' ')).strip()
+        if not text:
+            return
+        x = tm[4] * cm[0] + tm[5] * cm[2] + cm[4]
+        y = tm[4] * cm[1] + tm[5] * cm[3] + cm[5]
+        runs.append(TextRun(x, y, abs(tm[3] * cm[3]) * font_size, text))
+
+    page.extract_text(visitor_text=visit)
+    return runs
+
+
+def _normalize_rect(rect):
+    """Returns the rectangle as [left, bottom, right, top]."""
+    x1, y1, x2, y2 = rect
+    return [min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)]
+
+
+def find_label(runs, rect, other_rects, option_names=(), own_names=()):
+    """Returns the label text beside a widget and its caption below it."""
+    left, bottom, right, top = _normalize_rect(rect)
+
+    # The label starts after the nearest widget to the left on the same line
+    start = 0.0
+    for other in other_rects:
+        other_left, other_bottom, other_right, other_top = _normalize_rect(other)
+        if other_right <= left and other_bottom < top and other_top > bottom:
+            start = max(start, other_right)
+
+    candidates = [
+        run
+        for run in runs
+        if start <= run.x < left
+        and bottom - LINE_TOLERANCE <= run.y <= top + LINE_TOLERANCE
+        and run.size > CAPTION_FONT_SIZE
+    ]
+    # A tall widget spans several lines; the label is the one nearest its base
+    line = []
+    if candidates:
+        baseline = min(candidates, key=lambda run: abs(run.y - bottom)).y
+        line = [run for run in candidates if abs(run.y - baseline) <= 1.5]
+    caption = [
+        run
+        for run in runs
+        if left - LINE_TOLERANCE <= run.x < right
+        and bottom - CAPTION_DISTANCE <= run.y < bottom
+        and run.size <= CAPTION_FONT_SIZE
+    ]
+    label = ' '.join(run.text for run in sorted(line, key=lambda run: run.x))
+    # Drop the option labels of neighbouring checkboxes, e.g. "No If no, why?"
+    option_pattern = '|'.join(
+        re.escape(name) for name in sorted(option_names, key=len, reverse=True)
+    )
+    if option_pattern:
+        label = re.sub(rf'^(?:(?:{option_pattern})(?:\s+|$))+', '', label)
+        label = re.sub(rf'(?:(?:^|\s+)(?:{option_pattern}))+$', '', label)
+    caption_text = ' '.join(run.text for run in sorted(caption, key=lambda run: run.x))
+    if caption_text and not caption_text.startswith('('):
+        caption_text = f'({caption_text})'
+    # A line sharing no word with the field's names when its caption does is
+    # e.g. the end of a sentence printed before a signature line
+    own_stems = set().union(*(_stems(name) for name in own_names))
+    if (
+        own_stems & _stems(caption_text)
+        and not own_stems & _stems(label)
+        and len(_words(label)) != 1  # A heading such as "Address" is kept
+    ):
+        label = ''
+    return ' '.join(text for text in (label, caption_text) if text).strip()
+
+
+def format_question_line(form_field, question):
+    """Returns the "Name>> Question text | options" line of a field."""
+    if form_field.field_type == '/Btn':
+        options = ', '.join(form_field.options)
+        return f'{form_field.name}>> {question} | Checkbox options: {options}'
+    if form_field.field_type == '/Ch':
+        options = ', '.join(form_field.options)
+        return f'{form_field.name}>> {question} | Choice options: {options}'
+    return f'{form_field.name}>> {question}'
+
+
+def _words(text):
+    """Returns the lowercase words of a text, e.g. "E-Mail" gives "e", "mail"."""
+    return re.findall(r'[a-z0-9]+', (text or '').lower())
+
+
+def _stems(text):
+    """Returns the leading letters of the meaningful words of a text."""
+    return {
+        word[:STEM_LENGTH]
+        for word in _words(text)
+        if len(word) >= 3 and word not in STOP_WORDS
+    }
+
+
+def _contains_phrase(text, phrase):
+    """Returns whether the words of the phrase appear together in the text."""
+    words = ' '.join(_words(phrase))
+    return bool(words) and f' {words} ' in f' {" ".join(_words(text))} '
+
+
+def trim_leading_label(label, names):
+    """Returns the label from where one of the field's own names starts."""
+    words = label.split()
+    for name in names:
+        compact = ''.join(_words(name))
+        if not compact:
+            continue
+        for start in range(MIN_LEADING_WORDS, len(words)):
+            if ''.join(_words(' '.join(words[start:]))).startswith(compact):
+                return ' '.join(words[start:])
+    return label
+
+
+def is_plausible_label(label, own_names, other_names):
+    """Returns whether a label found next to a widget belongs to its field."""
+    for other in other_names:
+        if _contains_phrase(label, other) and not any(
+            _contains_phrase(own, other) for own in own_names
+        ):
+            return False
+    own_stems = set().union(*(_stems(own) for own in own_names))
+    return not own_stems or bool(own_stems & _stems(label))
+
+
+def _is_question_field(form_field):
+    """Returns whether the field takes an answer, unlike push buttons."""
+    if form_field.field_type == '/Btn':
+        return bool(form_field.options)
+    return form_field.field_type in ('/Tx', '/Ch')
+
+
+def build_page_questions(reader, schema):
+    """Returns the PageQuestions of every page of the form."""
+    # A tooltip shared by several fields, or naming an option, says too little
+    tooltip_counts = {}
+    for form_field in schema.fields:
+        tooltip_counts[form_field.tooltip] = (
+            tooltip_counts.get(form_field.tooltip, 0) + 1
+        )
+    option_names = set(schema.option_names())
+    field_names = set(schema.field_names())
+
+    def get_names(form_field):
+        # The field name and tooltip, where they say what the field is
+        names = []
+        if not GENERIC_FIELD_NAME.match(form_field.name):
+            names.append(form_field.name)
+        tooltip = form_field.tooltip
+        if (
+            tooltip
+            and tooltip_counts[tooltip] == 1
+            and tooltip not in option_names
+            and (tooltip not in field_names or tooltip == form_field.name)
+        ):
+            names.append(tooltip)
+        return names
+
+    pages = []
+    for page_number, page in enumerate(reader.pages):
+        page_questions = PageQuestions(page_number)
+        fields = [
+            f for f in schema.fields_on_page(page_number) if _is_question_field(f)
+        ]
+        if not fields:
+            pages.append(page_questions)
+            continue
+
+        runs = get_text_runs(page)
+        widget_rects = [
+            widget.rect
+            for form_field in fields
+            for widget in form_field.widgets
+            if widget.page == page_number and widget.rect
+        ]
+        for form_field in fields:
+            rects = [
+                widget.rect
+                for widget in form_field.widgets
+                if widget.page == page_number and widget.rect
+            ]
+            if not rects:  # No /Rect to find a label next to
+                page_questions.unresolved.append(form_field.name)
+                continue
+            # A group of checkboxes is labelled to the left of its first box
+            top = max(_normalize_rect(r)[3] for r in rects)
+            rect = min(
+                (r for r in rects if _normalize_rect(r)[3] >= top - LINE_TOLERANCE),
+                key=lambda r: _normalize_rect(r)[0],
+            )
+            own_names = get_names(form_field)
+            question = find_label(
+                runs,
+                rect,
+                [r for r in widget_rects if r not in rects],
+                option_names | {'Yes', 'No'},
+                own_names,
+            )
+            if len(re.findall(r'[A-Za-z]', question)) >= 3:
+                question = trim_leading_label(question, own_names)
+                other_names = [
+                    name
+                    for other in fields
+                    if other is not form_field
+                    for name in get_names(other)
+                ]
+                if not is_plausible_label(question, own_names, other_names):
+                    question = ''  # e.g. "Fax Signature:" next to a specialty field
+            if len(re.findall(r'[A-Za-z]', question)) < 3:
+                if not own_names:
+                    # The vision model reads the label from the page image
+                    page_questions.unresolved.append(form_field.name)
+                    continue
+                # The tooltip when it is unique, else e.g. "Walking-Other"
+                question = own_names[-1]
+            page_questions.lines[form_field.name] = format_question_line(
+                form_field, question
+            )
+        pages.append(page_questions)
+
+    # Fields whose widgets have no page are asked about with the first page
+    unpaged = [
+        f.name
+        for f in schema.fields
+        if _is_question_field(f) and all(w.page is None for w in f.widgets)
+    ]
+    if unpaged and pages:
+        pages[0].unresolved.extend(unpaged)
+    return pages
+
+
+def load_page_questions(file_path, directory=DEFAULT_SCHEMA_DIRECTORY):
+    """Returns the PageQuestions of a form's pages, cached with its schema."""
+    schema = load_form_schema(file_path, directory)
+    if schema.page_questions is None:
+        with get_recorder().stage('text_layer'):
+            pages = build_page_questions(PyPDF2.PdfReader(file_path), schema)
+        schema.page_questions = [asdict(page) for page in pages]
+        save_form_schema(schema, directory)
+    return [PageQuestions(**page) for page in schema.page_questions]
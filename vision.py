@@ -1,36 +1,223 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from functools import partial
 from dotenv import load_dotenv
 from openai import AzureOpenAI
-from pdf2image import convert_from_path
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+from api_calls import (
+    DEFAULT_DEADLINE,
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_TIMEOUT,
+    DeadlineExceeded,
+    get_call_limits,
+    send_with_retries,
+)
+from api_calls import set_call_limits as set_default_call_limits
+from answers import (
+    NOT_AVAILABLE,
+    AnswerLine,
+    StreamingAnswerParser,
+    answer_text,
+    parse_question_line,
+    save_answers,
+)
+from cache import DEFAULT_CACHE_PATH, ResponseCache
+from emr_extract import pre_extract
+from form_schema import get_pdf_hash, load_form_schema
+from image_encoding import ImageOptimizer, estimate_image_tokens
+from metrics import get_recorder
+from prompts import (
+    DEFAULT_MODEL,
+    PromptBuilder,
+    PromptTooLong,
+    count_message_tokens,
+    count_tokens,
+    get_max_prompt_tokens,
+    set_max_prompt_tokens,
+    split_to_tokens,
+)
+from render_store import DEFAULT_RENDER_DIRECTORY, DEFAULT_THREAD_COUNT, RenderStore
+from text_layer import MIN_PAGE_CONFIDENCE, load_page_questions
+from retrieval import (
+    DEFAULT_THRESHOLD,
+    DEFAULT_TOP_K,
+    AzureEmbedder,
+    HashingEmbedder,
+    Retriever,
+)
 
 import argparse
 import base64
-import io
+import json
 import logging
 import os
-import pickle
+import re
+import threading
+import time
 
-import PyPDF2
+DEFAULT_CONCURRENCY = 4  # The default number of pages sent to the API at once
+DEFAULT_DPI = 200  # The default resolution pages are rendered at
+DEFAULT_BATCH_QUESTIONS = 30  # Questions answered together by one prediction call
+DEFAULT_PAGE_MARGIN = 0  # Neighbouring pages whose fields a page prompt also names
+DEFAULT_MAX_BATCH_PAGES = 4  # Pages sent together in one vision request
+DEFAULT_MAX_BATCH_TOKENS = 4000  # Estimated image and prompt tokens per request
+PAGE_MAX_TOKENS = 2000  # Completion tokens allowed for the questions of one page
+VISION_MAX_TOKENS = 4096  # The most completion tokens the vision model returns
+PAGE_MARKER = re.compile(r'^\W*#+\s*Page\s+(\d+)\b.*$', re.MULTILINE)
+# The instructions of the vision prompts, sent first so that every page
+# request starts with the same tokens
+FORMAT_INSTRUCTIONS = """If the question is a checkbox or multiple-choice question, match the most relevant option name and preserve the choice exactly as it appears in Option Names (case-sensitive). If there's no match, keep it original.
+Use the following format:
+- For free field questions: "Question Name>> Question text"
+- For checkbox questions: "Question Name>> Question text | Checkbox options: option 1, option 2, ..."
+- For multiple-choice questions: "Question Names>> Question text | Choice options: choice A, choice B, ..."
+"""
+PAGE_INSTRUCTIONS = f"""You extract the questions of a form page from its picture, given the Question Names and Option Names of its fields.
+Extract all questions from the form content (free fields, multiple choices, checkboxes) as text from the picture, matching the exact case (uppercase or lowercase) and spelling of options.
+For each item, provide the question text and match the most relevant question name. If there's no question name that can be matched, use "NONAME".
+{FORMAT_INSTRUCTIONS}It is crucial to match the exact case (uppercase or lowercase) and spelling of options to facilitate precise interaction with the form in a digital environment."""
+BATCH_INSTRUCTIONS = f"""You extract the questions of several form pages from their pictures, given the Question Names and Option Names of each page's fields.
+For each page, extract all questions from the form content (free fields, multiple choices, checkboxes) as text from its picture, matching the exact case (uppercase or lowercase) and spelling of options.
+For each item, provide the question text and match the most relevant question name of the same page. If there's no question name that can be matched, use "NONAME".
+{FORMAT_INSTRUCTIONS}Start the questions of each page with a line "### Page N", where N is the page number given, and include every page, even one without questions.
+It is crucial to match the exact case (uppercase or lowercase) and spelling of options to facilitate precise interaction with the form in a digital environment."""
+# The instructions of the answer prompt, followed by the questions and the EMR
+ANSWER_INSTRUCTIONS = """Use the information below to fill in the form.
+Each question is given as "Field Name>> Question text".
+There are three types of questions:
+1. Free field questions: These should be directly answered in the text.
+2. Checkbox questions: For checkbox questions(multiple), answer the question by checking the correct option(s). For single checkbox question, show me 'Yes' or 'No'
+3. Multiple choice questions: For these, write out the selected answers.
+Reply with a JSON object that maps every Field Name to its answer as a string, using the option names exactly as listed for checkbox and multiple choice questions.
+If the information needed to answer a question is not provided, answer "N/A"."""
+DEFAULT_HEDGE_PERCENTILE = 0.95  # The call latency after which a hedge is sent
+DEFAULT_MAX_HEDGE_FRACTION = 0.1  # The most hedges sent per call
+PAGE_IMAGE_TOKENS = estimate_image_tokens(1700, 2200)  # A letter page at 200 DPI
 
 
 class PDFEncoder:
     """
     A class to encode a PDF file into different formats.
     Note that the page number is 0-indexed.
+
+    Pages are rendered lazily, one at a time, when they are first requested,
+    and only the `max_cached_pages` most recently used images are kept in
+    memory, so memory use does not grow with the page count (0 keeps only
+    the encoded pages, dropping each image once encoded). Images are
+    encoded by an ImageOptimizer, which records the payload of every page.
+
+    With a RenderStore, encoded pages are read from the store instead, which
+    renders a missing page and the ones after it in parallel, once for every
+    process sharing the store.
     """
 
-    def __init__(self, path):
+    def __init__(
+        self,
+        path,
+        dpi=DEFAULT_DPI,
+        grayscale=False,
+        max_cached_pages=4,
+        optimizer=None,
+        render_store=None,
+    ):
         self._path = path  # The path to the PDF file
-        self._images = convert_from_path(path)  # A list of images of the PDF file
+        self._dpi = dpi  # The resolution pages are rendered at
+        self._grayscale = grayscale  # Whether pages are rendered in grayscale
+        self._max_cached_pages = max_cached_pages
+        self._optimizer = optimizer or ImageOptimizer()
+        self._render_store = render_store  # An optional RenderStore
+        if render_store is not None:
+            with open(path, 'rb') as file:
+                self._pdf_hash = get_pdf_hash(file.read())
+            self._page_count = render_store.get_page_count(path, self._pdf_hash)
+        else:
+            with get_recorder().stage('pdf_info'):
+                self._page_count = pdfinfo_from_path(path)['Pages']
+        self._images = OrderedDict()  # LRU of rendered images by page number
+        self._encoded = {}  # Encoded images by page number, small enough to keep
+        self._encoding_stats = {}  # Payload statistics by page number
+        self._lock = threading.Lock()  # Pages may be requested from many threads
 
     def get_page_count(self):
         """Returns the number of pages in the PDF file."""
-        return len(self._images)
+        return self._page_count
+
+    def get_page_image(self, page_number):
+        """Returns the image of the page number, rendering it on first use."""
+        if not 0 <= page_number < self._page_count:
+            raise IndexError(f'Page {page_number} is out of range')
+
+        with self._lock:
+            if page_number in self._images:
+                self._images.move_to_end(page_number)
+                return self._images[page_number]
+
+        with get_recorder().stage('rasterize'):
+            image = convert_from_path(
+                self._path,
+                dpi=self._dpi,
+                grayscale=self._grayscale,
+                first_page=page_number + 1,
+                last_page=page_number + 1,
+            )[0]
+
+        with self._lock:
+            self._images[page_number] = image
+            while len(self._images) > self._max_cached_pages:
+                self._images.popitem(last=False)  # Drop the least recently used
+        return image
+
+    def get_encoded_image(self, page_number):
+        """Returns the optimized EncodedImage of the page number."""
+        with self._lock:
+            if page_number in self._encoded:
+                return self._encoded[page_number]
+
+        if self._render_store is not None:
+            if not 0 <= page_number < self._page_count:
+                raise IndexError(f'Page {page_number} is out of range')
+            encoded = self._render_store.get(
+                self._path,
+                self._pdf_hash,
+                page_number,
+                self._page_count,
+                self._dpi,
+                self._grayscale,
+                self._optimizer,
+            )
+        else:
+            image = self.get_page_image(page_number)
+            with get_recorder().stage('encode'):
+                encoded = self._optimizer.encode(image)
+        stats = {
+            'bytes': encoded.size,
+            'estimated_tokens': encoded.estimated_tokens,
+            'width': encoded.width,
+            'height': encoded.height,
+            'mime_type': encoded.mime_type,
+            'quality': encoded.quality,
+        }
+        with self._lock:
+            self._encoded[page_number] = encoded
+            self._encoding_stats[page_number] = stats
+        logging.debug(f'Encoded page {page_number + 1}: {stats}')
+        return encoded
+
+    def get_encoding_stats(self):
+        """Returns the payload statistics of the pages encoded so far."""
+        with self._lock:
+            return dict(sorted(self._encoding_stats.items()))
 
     def get_image_encoding(self, page_number):
-        """Returns the image encoding of the page number."""
-        jpg_bytes = io.BytesIO()
-        self._images[page_number].save(jpg_bytes, 'JPEG')
-        return jpg_bytes.getvalue()
+        """
+        Returns the image encoding of the page number, as a read-only memory
+        map when it comes from a RenderStore.
+        """
+        return self.get_encoded_image(page_number).data
 
     def get_base64_encoding(self, page_number):
         """Returns the base64 encoding of the page number."""
@@ -39,49 +226,173 @@ class PDFEncoder:
     def get_dataurl_encoding(self, page_number):
         """Returns the data URL encoding of the page number."""
         # Construct the data URL by determining the MIME type and encoding the image
-        mime_type = 'image/jpeg'
-        base64_encoded_data = self.get_base64_encoding(page_number).decode('utf-8')
-        return f'data:{mime_type};base64,{base64_encoded_data}'
+        encoded = self.get_encoded_image(page_number)
+        base64_encoded_data = base64.b64encode(encoded.data).decode('utf-8')
+        return f'data:{encoded.mime_type};base64,{base64_encoded_data}'
 
     def get_dataurl_encoding_whole(self):
-        """Returns the data URL encoding of all the pages."""
-        pass
+        """Returns the data URL encodings of all the pages, in page order."""
+        return [self.get_dataurl_encoding(n) for n in range(self._page_count)]
 
     def save_image_repr_to_file(self, page_number, path):
         """Saves the image representation of the page number to a file."""
-        self._images[page_number].save(path, 'JPEG')
+        self.get_page_image(page_number).save(path, 'JPEG')
 
     def save_image_repr_to_directory(self, directory):
         """Saves the image representation of the PDF to a directory."""
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-        for i, image in enumerate(self._images):
+        for i in range(self._page_count):
             filename = f'{directory}/page_{i + 1}.jpg'
-            image.save(filename, 'JPEG')
+            self.get_page_image(i).save(filename, 'JPEG')
+
+
+class RateLimiter:
+    """
+    A thread-safe limiter that spaces requests out evenly so that no more than
+    the given number of requests per minute are started.
+    """
+
+    def __init__(self, requests_per_minute=None):
+        # No limit is applied when requests_per_minute is None
+        self._interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._next_slot = 0.0  # The earliest time the next request may start
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until the next request is allowed to start."""
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HedgePolicy:
+    """
+    Decides when a slow request is duplicated ("hedged") to cut tail latency.
+
+    A call that has not completed by the given percentile of the recorded
+    latencies of its label is sent a second time, and whichever attempt
+    completes first is used. Hedges are only sent once enough latencies have
+    been recorded, and at most `max_extra_fraction` of the calls are hedged so
+    that the extra spend stays bounded. The threshold follows the recorded
+    latencies, so it adapts as the API gets faster or slower.
+    """
+
+    def __init__(
+        self,
+        percentile=DEFAULT_HEDGE_PERCENTILE,
+        max_extra_fraction=DEFAULT_MAX_HEDGE_FRACTION,
+        min_samples=20,
+        min_delay=1.0,
+    ):
+        self._percentile = percentile
+        self._max_extra_fraction = max_extra_fraction
+        self._min_samples = min_samples  # Latencies needed before hedging
+        self._min_delay = min_delay  # Seconds a call always gets before a hedge
+        self._calls = 0
+        self._hedges = 0
+        self._lock = threading.Lock()
+
+    def start_call(self, label):
+        """
+        Counts a call with the label and returns the seconds after which it
+        may be hedged, or None if too few of its latencies are known yet.
+        """
+        with self._lock:
+            self._calls += 1
+        histogram = get_recorder().get_histogram(label)
+        if histogram.count < self._min_samples:
+            return None
+        return max(self._min_delay, histogram.percentile(self._percentile))
+
+    def try_acquire(self):
+        """Returns whether a hedge may be sent without exceeding the budget."""
+        with self._lock:
+            if self._hedges + 1 > self._max_extra_fraction * self._calls:
+                return False
+            self._hedges += 1
+            return True
+
+    def charge(self, requests):
+        """Counts requests sent by a cancelled attempt as hedges."""
+        if requests > 0:
+            with self._lock:
+                self._hedges += requests
+
+    def stats(self):
+        """Returns the number of calls seen and hedges sent."""
+        with self._lock:
+            return {'calls': self._calls, 'hedges': self._hedges}
 
 
 class OpenAIRequestLibrary:
     """A library for generating request objects for OpenAI API."""
 
     _azure_openai_client = None  # The Azure OpenAI client
+    _hedge_policy = None  # The default set by set_call_limits()
 
     def __init__(
-        self, model='AZURE_OPENAI_GPT4_DEPLOYMENT', temperature=0, max_tokens=2000
+        self,
+        model=DEFAULT_MODEL,
+        temperature=0,
+        max_tokens=2000,
+        max_retries=DEFAULT_MAX_RETRIES,
+        rate_limiter=None,
+        cache=None,
+        client=None,
+        deployment=None,
+        label='chat',
+        timeout=None,
+        deadline=None,
+        hedge_policy=None,
+        max_prompt_tokens=None,
     ):
-        if self._azure_openai_client is None:
+        if client is None and self._azure_openai_client is None:
             self._init_openai_client()
 
-        assert model in os.environ
-        self._model = os.environ[model]
+        if deployment is None:
+            assert model in os.environ
+            deployment = os.environ[model]
+        self._model = deployment
         self._temperature = temperature
         self._max_tokens = max_tokens
+        self._max_retries = max_retries  # Retries for 429 and 5xx responses
+        self._rate_limiter = rate_limiter  # Shared between concurrent requests
+        self._cache = cache  # An optional ResponseCache
+        self._client = client or self._azure_openai_client
+        self._label = label  # Groups the call in the recorded metrics
+        default_timeout, default_deadline = get_call_limits()
+        self._timeout = timeout or default_timeout  # Seconds per attempt
+        self._deadline = deadline or default_deadline  # Seconds per call
+        self._hedge_policy = hedge_policy or self._hedge_policy  # Or no hedging
+        # Checked before sending, by default the budget of the model's deployment
+        self._max_prompt_tokens = max_prompt_tokens or get_max_prompt_tokens(model)
+        self._image_tokens = 0  # The estimated tokens of the images added
+        self._estimated_tokens = None  # The prompt tokens estimated before sending
 
         self._request_body = {  # The request body to be sent to the OpenAI API
             'model': self._model,
             'temperature': self._temperature,
-            'max_tokens': self._max_tokens,
         }
+        if self._max_tokens is not None:
+            self._request_body['max_tokens'] = self._max_tokens
+
+    def add_prompt(self, builder, image_urls=None, image_tokens=None):
+        """
+        Adds the messages of a PromptBuilder to the request body, with the
+        images, if any, after the text of its user message.
+        """
+        for message in builder.messages():
+            if message['role'] == 'user' and image_urls:
+                self.add_images_message(message['content'], image_urls, image_tokens)
+            else:
+                self.add_plain_message(message['role'], message['content'])
 
     def add_plain_message(self, role, content):
         """Adds a plain message to the request body."""
@@ -89,8 +400,12 @@ class OpenAIRequestLibrary:
             self._request_body['messages'] = []  # Initialize the messages list
         self._request_body['messages'].append({'role': role, 'content': content})
 
-    def add_image_message(self, text, image_url):
-        """Adds an image message to the request body."""
+    def add_image_message(self, text, image_url, image_tokens=PAGE_IMAGE_TOKENS):
+        """
+        Adds an image message to the request body. The estimated tokens of the
+        image count towards estimate_prompt_tokens().
+        """
+        self._image_tokens += image_tokens
         if 'messages' not in self._request_body:
             self._request_body['messages'] = []  # Initialize the messages list
         self._request_body['messages'].append(
@@ -111,35 +426,365 @@ class OpenAIRequestLibrary:
             }
         )
 
+    def add_images_message(self, text, image_urls, image_tokens=None):
+        """
+        Adds a message with several images, in order, to the request body,
+        with the estimated tokens of each image if known.
+        """
+        self._image_tokens += sum(image_tokens or [PAGE_IMAGE_TOKENS] * len(image_urls))
+        if 'messages' not in self._request_body:
+            self._request_body['messages'] = []  # Initialize the messages list
+        content = [{'type': 'text', 'text': text}]
+        content.extend(
+            {'type': 'image_url', 'image_url': {'url': image_url}}
+            for image_url in image_urls
+        )
+        self._request_body['messages'].append({'role': 'user', 'content': content})
+
+    def estimate_prompt_tokens(self):
+        """Returns the estimated prompt tokens of the request, images included."""
+        messages = self._request_body.get('messages', [])
+        return count_message_tokens(messages) + self._image_tokens
+
+    def set_response_format(self, response_format):
+        """Sets the response format, e.g. {'type': 'json_object'}."""
+        self._request_body['response_format'] = response_format
+
     def send(self):
-        """Sends the request to the OpenAI API."""
-        response = self._azure_openai_client.chat.completions.create(
-            **self._request_body
+        """
+        Sends the request to the OpenAI API, or serves it from the response
+        cache when an identical request has been sent before. The request is
+        hedged when the hedge policy says it is taking unusually long, and
+        DeadlineExceeded is raised when it does not complete within the
+        deadline.
+        """
+        start_time = time.perf_counter()
+        deadline_at = time.monotonic() + self._deadline
+        key = None
+        if self._cache is not None:
+            key = self._cache.make_key(self._request_body)
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._record_call(start_time, cache_hit=True)
+                return ChatCompletion.model_validate(cached)
+
+        self._check_prompt_tokens()
+        counts = {'retries': 0}  # Retries of this call, hedges included
+        try:
+            response, hedged = self._send_hedged(deadline_at, counts)
+        except Exception:
+            self._record_call(start_time, status='error', retries=counts['retries'])
+            raise
+        self._record_call(
+            start_time, usage=response.usage, hedged=hedged, retries=counts['retries']
         )
+
+        if key is not None:
+            self._cache.put(key, response.model_dump(mode='json', exclude_unset=True))
         return response
 
+    def stream(self):
+        """
+        Sends the request to the OpenAI API with streaming enabled and yields
+        the response text as it arrives. A cached response is yielded whole,
+        and a completed stream is stored in the cache like a sent request.
+        Streams are never hedged, since their text has already been yielded,
+        but DeadlineExceeded is raised when one outlasts the deadline. The
+        installed API version reports no token usage for streams, so unless
+        a chunk carries it, the tokens are counted locally.
+        """
+        start_time = time.perf_counter()
+        deadline_at = time.monotonic() + self._deadline
+        key = None
+        if self._cache is not None:
+            key = self._cache.make_key(self._request_body)
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._record_call(start_time, cache_hit=True)
+                yield ChatCompletion.model_validate(cached).choices[0].message.content
+                return
+
+        self._check_prompt_tokens()
+        content = []
+        finish_reason = None
+        first_token_time = None
+        usage = None
+        counts = {'retries': 0}
+        try:
+            response = self._send_with_retries(deadline_at, counts, stream=True)
+            for chunk in response:
+                if time.monotonic() > deadline_at:
+                    response.close()
+                    raise DeadlineExceeded(
+                        f'The stream took longer than {self._deadline:.0f}s'
+                    )
+                usage = getattr(chunk, 'usage', None) or usage
+                if not chunk.choices:  # e.g. Azure's content filter results
+                    continue
+                choice = chunk.choices[0]
+                finish_reason = choice.finish_reason or finish_reason
+                if choice.delta.content:
+                    if first_token_time is None:
+                        first_token_time = time.perf_counter()
+                    content.append(choice.delta.content)
+                    yield choice.delta.content
+        except Exception:
+            self._record_call(
+                start_time, first_token_time, status='error', retries=counts['retries']
+            )
+            raise
+        if usage is None:
+            completion_tokens = count_tokens(''.join(content))
+            usage = CompletionUsage(
+                prompt_tokens=self._estimated_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=self._estimated_tokens + completion_tokens,
+            )
+        self._record_call(
+            start_time, first_token_time, usage=usage, retries=counts['retries']
+        )
+
+        if key is not None:
+            self._cache.put(
+                key, self._make_response(key, ''.join(content), finish_reason)
+            )
+
+    def get_cached_content(self):
+        """
+        Returns the response text cached for the request without sending it,
+        or None when there is no cache or no cached response.
+        """
+        if self._cache is None:
+            return None
+        start_time = time.perf_counter()
+        key = self._cache.make_key(self._request_body)
+        cached = self._cache.get(key)
+        if cached is None:
+            return None
+        self._record_call(start_time, cache_hit=True)
+        return ChatCompletion.model_validate(cached).choices[0].message.content
+
+    def store_content(self, content):
+        """
+        Caches the response text as the response to the request, e.g. a part
+        of a combined response that answered it along with other requests.
+        """
+        if self._cache is not None:
+            key = self._cache.make_key(self._request_body)
+            self._cache.put(key, self._make_response(key, content))
+
+    def _make_response(self, key, content, finish_reason=None):
+        """Returns a chat completion of the response text, for the cache."""
+        return {
+            'id': f'stream-{key[:16]}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': self._model,
+            'choices': [
+                {
+                    'index': 0,
+                    'finish_reason': finish_reason or 'stop',
+                    'message': {'role': 'assistant', 'content': content},
+                }
+            ],
+        }
+
+    def _check_prompt_tokens(self):
+        """Raises PromptTooLong when the request is estimated not to fit."""
+        tokens = self._estimated_tokens = self.estimate_prompt_tokens()
+        logging.debug(f'Sending about {tokens} prompt tokens ({self._label})')
+        if self._max_prompt_tokens and tokens > self._max_prompt_tokens:
+            raise PromptTooLong(
+                f'The {self._label} request has about {tokens} prompt tokens, '
+                f'more than {self._max_prompt_tokens}'
+            )
+
+    def _record_call(
+        self,
+        start_time,
+        first_token_time=None,
+        usage=None,
+        cache_hit=False,
+        status='ok',
+        hedged=False,
+        retries=0,
+    ):
+        """Records the metrics of the call that started at start_time."""
+        end_time = time.perf_counter()
+        get_recorder().record_call(
+            self._label,
+            model=self._model,
+            wall_time=end_time - start_time,
+            time_to_first_token=(
+                first_token_time - start_time if first_token_time else None
+            ),
+            prompt_tokens=usage.prompt_tokens if usage else None,
+            estimated_prompt_tokens=None if cache_hit else self._estimated_tokens,
+            completion_tokens=usage.completion_tokens if usage else None,
+            payload_bytes=0 if cache_hit else len(json.dumps(self._request_body)),
+            cache_hit=cache_hit,
+            retries=retries,
+            status=status,
+            hedged=hedged,
+        )
+
+    def _send_hedged(self, deadline_at, counts):
+        """
+        Returns the (response, hedged) of the request, sending a duplicate if
+        the first attempt is still running after the hedge policy's delay and
+        using whichever completes first. The other attempt is then cancelled,
+        and any request it still sends counts against the hedge budget. The
+        retries of both attempts are added up in counts['retries'].
+        """
+        delay = None
+        if self._hedge_policy is not None:
+            delay = self._hedge_policy.start_call(self._label)
+        if delay is None:
+            return self._send_with_retries(deadline_at, counts), False
+
+        # Each attempt counts its retries and requests in its own dictionary,
+        # written only by the thread that sends it
+        attempt_counts = [{'retries': 0, 'requests': 0} for _ in range(2)]
+        cancel = threading.Event()  # Set once the call returns
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            attempts = [
+                executor.submit(
+                    self._send_with_retries, deadline_at, attempt_counts[0], cancel
+                )
+            ]
+            done, _ = wait(attempts, timeout=delay)
+            hedged = not done and self._hedge_policy.try_acquire()
+            if hedged:
+                logging.debug(f'No response after {delay:.2f}s, sending a hedge')
+                attempts.append(
+                    executor.submit(
+                        self._send_with_retries, deadline_at, attempt_counts[1], cancel
+                    )
+                )
+
+            error = None
+            remaining = max(0.0, deadline_at - time.monotonic())
+            try:
+                for attempt in as_completed(attempts, timeout=remaining):
+                    if attempt.exception() is None:
+                        return attempt.result(), hedged
+                    error = error or attempt.exception()
+            except FuturesTimeoutError:
+                raise DeadlineExceeded(
+                    f'The request took longer than {self._deadline:.0f}s'
+                ) from None
+            raise error
+        finally:
+            cancel.set()
+            counts['retries'] = sum(c['retries'] for c in attempt_counts)
+            for attempt, attempt_count in zip(attempts, attempt_counts):
+                if not attempt.done():
+                    # The request in flight is left to finish on its own, and
+                    # any sent after the cancellation is charged as a hedge
+                    sent = attempt_count['requests']
+                    attempt.add_done_callback(
+                        lambda _, c=attempt_count, sent=sent: (
+                            self._hedge_policy.charge(c['requests'] - sent)
+                        )
+                    )
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _send_with_retries(self, deadline_at, counts, cancel=None, **options):
+        """
+        Sends the request to the OpenAI API through send_with_retries(), which
+        retries rate-limited and server-side failures within the deadline
+        until the cancel event is set.
+        """
+        return send_with_retries(
+            partial(
+                self._client.chat.completions.create,
+                **self._request_body,
+                **options,
+            ),
+            deadline_at,
+            counts,
+            self._timeout,
+            self._max_retries,
+            self._rate_limiter,
+            cancel,
+        )
+
     def __str__(self) -> str:
         return str(self._request_body)
 
+    @classmethod
+    def set_call_limits(cls, timeout=None, deadline=None, hedge_policy=None):
+        """
+        Sets the per-attempt timeout, the per-call deadline and the hedge policy
+        of the requests created afterwards without their own.
+        """
+        set_default_call_limits(timeout, deadline)
+        cls._hedge_policy = hedge_policy
+
+    @classmethod
+    def set_openai_client(cls, client):
+        """Sets the Azure OpenAI client shared by all requests."""
+        cls._azure_openai_client = client
+
+    @classmethod
+    def get_openai_client(cls):
+        """Returns the Azure OpenAI client shared by all requests."""
+        if cls._azure_openai_client is None:
+            cls._init_openai_client()
+        return cls._azure_openai_client
+
     @classmethod
     def _init_openai_client(cls):
-        cls._azure_openai_client = AzureOpenAI()
-
-def get_field_options(reader, field_info):
-    options = []
-    kids = field_info.get('/Kids')
-    if kids:
-        for kid in kids:
-            kid_object = reader.get_object(kid)
-            if kid_object:
-                ap = kid_object.get('/AP')
-                if ap:
-                    if isinstance(ap, PyPDF2.generic.IndirectObject):
-                        ap = reader.get_object(ap)
-                    if '/N' in ap:
-                        key=[k for k in list(ap['/N'].keys()) if k!='/Off']
-                        options.extend(k.strip('/') for k in key)  # Strip the leading slash before appending
-    return options if options else None
+        # Retries are handled by send() so that they respect the rate limiter
+        cls._azure_openai_client = AzureOpenAI(max_retries=0)
+
+
+def add_call_limit_arguments(parser, hedging=False):
+    """
+    Adds the per-attempt timeout and per-call deadline arguments to the
+    parser, and with `hedging` those of the hedge policy.
+    """
+    parser.add_argument(
+        '--request-timeout',
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help='The seconds one attempt of a model request may take.',
+    )
+    parser.add_argument(
+        '--deadline',
+        type=float,
+        default=DEFAULT_DEADLINE,
+        help='The seconds a model call may take, retries included.',
+    )
+    if hedging:
+        parser.add_argument(
+            '--hedge-percentile',
+            type=float,
+            default=None,
+            help='Sends a duplicate of a model request still running after this '
+            'percentile of the recorded latencies, e.g. 0.95 (off by default).',
+        )
+        parser.add_argument(
+            '--max-hedge-fraction',
+            type=float,
+            default=DEFAULT_MAX_HEDGE_FRACTION,
+            help='The most duplicate requests sent per model call.',
+        )
+
+
+def apply_call_limits(args):
+    """Sets the call limits parsed by add_call_limit_arguments() as defaults."""
+    hedge_percentile = getattr(args, 'hedge_percentile', None)
+    OpenAIRequestLibrary.set_call_limits(
+        timeout=args.request_timeout,
+        deadline=args.deadline,
+        hedge_policy=(
+            HedgePolicy(hedge_percentile, args.max_hedge_fraction)
+            if hedge_percentile
+            else None
+        ),
+    )
 
 
 def parse_arguments():
@@ -163,7 +808,10 @@ def parse_arguments():
         help='The path to the electrical medical record (EMR) file.',
     )
     parser.add_argument(
-        '-o', '--output', required=True, help='The path to the output PDF file.'
+        '-o',
+        '--output',
+        required=True,
+        help='The path to the output answers file (JSON if it ends with .json).',
     )
     # TODO: Set up logger to print debugging information.
     parser.add_argument(
@@ -175,106 +823,679 @@ def parse_arguments():
         action='store_true',
         help='Dumps intermediate files for debugging.',
     )
+    parser.add_argument(
+        '-c',
+        '--concurrency',
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help='The maximum number of page requests in flight at once.',
+    )
+    parser.add_argument(
+        '--requests-per-minute',
+        type=float,
+        default=None,
+        help='The request budget per minute shared by all page requests.',
+    )
+    add_call_limit_arguments(parser)
+    parser.add_argument(
+        '--dpi',
+        type=int,
+        default=DEFAULT_DPI,
+        help='The resolution the form pages are rendered at.',
+    )
+    parser.add_argument(
+        '--grayscale',
+        action='store_true',
+        help='Renders the form pages in grayscale.',
+    )
+    parser.add_argument(
+        '--max-long-edge',
+        type=int,
+        default=None,
+        help='Downsamples page images so that their long edge fits in pixels.',
+    )
+    parser.add_argument(
+        '--jpeg-quality',
+        type=int,
+        default=75,
+        help='The highest JPEG quality used for page images.',
+    )
+    parser.add_argument(
+        '--max-image-bytes',
+        type=int,
+        default=None,
+        help='Lowers the JPEG quality until each page image fits in bytes.',
+    )
+    parser.add_argument(
+        '--max-image-tokens',
+        type=int,
+        default=None,
+        help='Downsamples page images until their estimated tokens fit.',
+    )
+    parser.add_argument(
+        '--crop-margins',
+        action='store_true',
+        help='Crops blank page margins before encoding.',
+    )
+    parser.add_argument(
+        '--png-line-art',
+        action='store_true',
+        help='Encodes black-and-white pages as PNG when that is smaller.',
+    )
+    parser.add_argument(
+        '--metrics-output',
+        default=None,
+        help='Saves per-call and per-stage metrics to this file '
+        '(OpenMetrics text if it ends with .prom, otherwise JSON).',
+    )
+    parser.add_argument(
+        '--cache-path',
+        default=DEFAULT_CACHE_PATH,
+        help='The path to the response cache database.',
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Always sends requests to the API instead of using the cache.',
+    )
+    parser.add_argument(
+        '--render-store-path',
+        default=DEFAULT_RENDER_DIRECTORY,
+        help='The directory of the rendered and encoded form pages shared '
+        'between runs.',
+    )
+    parser.add_argument(
+        '--no-render-store',
+        action='store_true',
+        help='Renders the form pages in memory on every run instead.',
+    )
+    parser.add_argument(
+        '--render-threads',
+        type=int,
+        default=DEFAULT_THREAD_COUNT,
+        help='The number of pages rendered in parallel on a render store miss.',
+    )
+    parser.add_argument(
+        '--embedder',
+        choices=('azure', 'hashing'),
+        default='azure',
+        help='The embedding backend used to retrieve EMR passages.',
+    )
+    parser.add_argument(
+        '--retrieval-top-k',
+        type=int,
+        default=DEFAULT_TOP_K,
+        help='The number of EMR passages retrieved per question.',
+    )
+    parser.add_argument(
+        '--retrieval-threshold',
+        type=int,
+        default=DEFAULT_THRESHOLD,
+        help='EMRs longer than this many characters are answered from '
+        'retrieved passages instead of being sent whole.',
+    )
+    parser.add_argument(
+        '--no-text-layer',
+        action='store_true',
+        help='Sends every page to the vision model instead of first building '
+        'the questions from the form fields and page text.',
+    )
+    parser.add_argument(
+        '--text-layer-confidence',
+        type=float,
+        default=MIN_PAGE_CONFIDENCE,
+        help="The fraction of a page's fields that must be labelled from the "
+        'text layer for the page to skip the vision model.',
+    )
+    parser.add_argument(
+        '--page-margin',
+        type=int,
+        default=DEFAULT_PAGE_MARGIN,
+        help='The number of neighbouring pages whose fields are also named in '
+        "a page's vision prompt.",
+    )
+    parser.add_argument(
+        '--max-batch-pages',
+        type=int,
+        default=DEFAULT_MAX_BATCH_PAGES,
+        help='The most pages sent together in one vision request (1 sends '
+        'every page on its own).',
+    )
+    parser.add_argument(
+        '--max-prompt-tokens',
+        type=int,
+        default=None,
+        help='The most prompt tokens a request to the vision model may hold '
+        '(default: AZURE_OPENAI_GPT4_MAX_PROMPT_TOKENS, else a 128k context '
+        'budget).',
+    )
+    parser.add_argument(
+        '--max-batch-tokens',
+        type=int,
+        default=DEFAULT_MAX_BATCH_TOKENS,
+        help='The estimated image and prompt tokens a vision request with '
+        'several pages may hold.',
+    )
+    parser.add_argument(
+        '--no-local-extraction',
+        action='store_true',
+        help='Sends every question to the model instead of first answering '
+        'the ones the EMR states in a predictable format, such as "DOB: ...".',
+    )
+    parser.add_argument(
+        '--batch-questions',
+        type=int,
+        default=DEFAULT_BATCH_QUESTIONS,
+        help='The number of extracted questions sent for prediction together.',
+    )
     args = parser.parse_args()
 
     return args
 
 
-def parse_pdf(file_path):
-    """Parse the PDF file and extract the questions."""
+def iter_parsed_pages(
+    file_path,
+    concurrency=DEFAULT_CONCURRENCY,
+    requests_per_minute=None,
+    cache=None,
+    dpi=DEFAULT_DPI,
+    grayscale=False,
+    optimizer=None,
+    rate_limiter=None,
+    text_layer=True,
+    min_confidence=MIN_PAGE_CONFIDENCE,
+    encoder=None,
+    page_margin=DEFAULT_PAGE_MARGIN,
+    max_batch_pages=DEFAULT_MAX_BATCH_PAGES,
+    max_batch_tokens=DEFAULT_MAX_BATCH_TOKENS,
+    render_store=None,
+):
+    """
+    Parse the PDF file and extract the questions, yielding a (page number,
+    result) pair as soon as each page returns. Pages are sent to the API
+    concurrently, at most `concurrency` at a time and within the optional
+    `requests_per_minute` budget (or a RateLimiter shared with other forms),
+    so the pairs arrive in completion order rather than page order.
+    Pages already answered for the same image and prompt are served from the
+    optional response cache.
+
+    With `text_layer`, the questions of a fillable form are first built from
+    its field metadata and page text. Pages where at least `min_confidence`
+    of the fields got a label are answered locally, and only their remaining
+    fields are sent to the vision model; other pages go to the vision model
+    whole.
+
+    A page prompt names only the fields and options whose widgets are on
+    that page, or within `page_margin` pages of it, so its size does not grow
+    with the length of the form. Fields whose page is unknown are named on
+    every page.
+
+    Up to `max_batch_pages` consecutive pages are sent in one request with
+    several images, as long as their estimated image and prompt tokens stay
+    within `max_batch_tokens`, and the combined response is split back into
+    pages. Each page's part is cached as the response to that page alone, so
+    the cache serves it whether it is later sent alone or in another batch.
+    A page missing from the combined response is sent again on its own.
+
+    A PDFEncoder of the file may be passed in as `encoder` so that pages it
+    has already rendered and encoded are reused, or a RenderStore as
+    `render_store` so that pages are reused across forms and processes.
+    """
 
-    pdf = PDFEncoder(file_path)
+    # Each page is rendered by the worker that sends it, so the first request
+    # goes out as soon as its own page is ready
+    pdf = encoder or PDFEncoder(
+        file_path,
+        dpi=dpi,
+        grayscale=grayscale,
+        max_cached_pages=max(1, concurrency),
+        optimizer=optimizer,
+        render_store=render_store,
+    )
 
-    question_names = []
-    option_names = []
-    with open(file_path, 'rb') as file:
-        reader = PyPDF2.PdfReader(file)
-        fields = reader.get_fields()
-        for field_name, field_info in fields.items():
-            question_names.append(field_name)
-            field_type = field_info.get('/FT')
-            if field_type == '/Btn':  # Checkbox or radio button field
-                if get_field_options(reader, field_info) != None:
-                    options = get_field_options(reader, field_info)
-                option_names.extend(options)
+    # The field names and checkbox/radio options, parsed once per template
+    schema = load_form_schema(file_path)
+    text_pages = load_page_questions(file_path) if text_layer else []
+    page_paths = {}  # How each page was parsed: 'text', 'text+vision' or 'vision'
 
-    keys_string = '|'.join(question_names)
-    options_string = '|'.join(option_names)
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(requests_per_minute)
 
-    # Iterate over all pages of the PDF
-    parse_result = []  # List of parsed results for each page
+    # Decide how each page is parsed before any request goes out
+    text_lines = {}  # The question lines built from the text layer, by page
+    vision_pages = []  # (page number, field names, or None for all) to send
     for page_number in range(pdf.get_page_count()):
-        # Get the data URL encoding for the current page
-        data_url = pdf.get_dataurl_encoding(page_number)
-        # Formulate the prompt for the current page
-        # TODO: Alternative prompt: 'Extract the all and only questions(free fields, multiple choices, check boxes, etx) as text from the picture, and generate a form with the first column as the question and the second column as the pixel location of the answer field of the question in the picture.'
-        prompt = f"""Given the form content and the Question Names "{keys_string}": (separated by "|"), and the Option Names "{options_string}": (separated by "|"),
-        Extract all questions from the form content (free fields, multiple choices, checkboxes) as text from the picture, matching the exact case (uppercase or lowercase) and spelling of options.
-        For each item, provide the question text and match the most relevant question name. If there's no question name that can be matched, use "NONAME".
-        If the question is a checkbox or multiple-choice question, match the most relevant option name and preserve the choice exactly as it appears in Option Names (case-sensitive). If there's no match, keep it original.
-        Use the following format:
-        - For free field questions: "Question Name>> Question text"
-        - For checkbox questions: "Question Name>> Question text | Checkbox options: option 1, option 2, ..."
-        - For multiple-choice questions: "Question Names>> Question text | Choice options: choice A, choice B, ..."
-        It is crucial to match the exact case (uppercase or lowercase) and spelling of options to facilitate precise interaction with the form in a digital environment.
+        page_questions = (
+            text_pages[page_number] if page_number < len(text_pages) else None
+        )
+        if page_questions is None or page_questions.confidence < min_confidence:
+            page_paths[page_number] = 'vision'
+            vision_pages.append((page_number, None))
+            continue
+        text_lines[page_number] = list(page_questions.lines.values())
+        page_paths[page_number] = 'text'
+        if page_questions.unresolved:
+            # Ask the vision model about only the fields without a plausible
+            # label, and the fields whose page is unknown
+            page_paths[page_number] = 'text+vision'
+            vision_pages.append((page_number, page_questions.unresolved))
 
-        """
+    def finish_page(page_number, vision_result):
+        if page_number not in text_lines:
+            return vision_result
+        lines = list(text_lines[page_number])
+        unresolved = text_pages[page_number].unresolved
+        for line in vision_result.splitlines():
+            parsed = parse_question_line(line)
+            if parsed is not None and parsed[0] in unresolved:
+                lines.append(line.strip())
+        return '\n'.join(lines)
+
+    def get_names_and_options(page_number, field_names):
+        fields = schema.fields_near_page(page_number, page_margin)
+        if field_names is not None:
+            fields = [schema.get_field(name) for name in field_names]
+        keys_string = '|'.join(f.name for f in fields)
+        options_string = '|'.join(dict.fromkeys(o for f in fields for o in f.options))
+        return keys_string, options_string
+
+    def build_page_request(page_number, field_names=None):
+        keys_string, options_string = get_names_and_options(page_number, field_names)
+
+        # The instructions come first and are the same for every page, the
+        # names of the page's fields after them
+        # TODO: Alternative prompt: 'Extract the all and only questions(free fields, multiple choices, check boxes, etx) as text from the picture, and generate a form with the first column as the question and the second column as the pixel location of the answer field of the question in the picture.'
+        prompt = PromptBuilder(system=PAGE_INSTRUCTIONS).add_prefix(
+            f'Given the form content and the Question Names "{keys_string}" '
+            f'(separated by "|"), and the Option Names "{options_string}" '
+            '(separated by "|"), extract the questions of the picture.'
+        )
 
         # Generate response using OpenAI based on the current page's content
-        # Check if a cached response exists
-        pickled_response_file = f'pickled_response_page_{page_number+1}.bin'
-        if os.path.exists(pickled_response_file):
-            with open(pickled_response_file, 'rb') as fin:
-                response = pickle.load(fin)
-        else:
-            # If no cached response, send a new request and save it
-            request = OpenAIRequestLibrary(temperature=0.3)
-            request.add_image_message(prompt, data_url)
-            response = request.send()
-            with open(pickled_response_file, 'wb') as fout:
-                pickle.dump(response, fout)
+        request = OpenAIRequestLibrary(
+            temperature=0.3, rate_limiter=rate_limiter, cache=cache, label='vision_page'
+        )
+        request.add_prompt(
+            prompt,
+            [pdf.get_dataurl_encoding(page_number)],
+            [pdf.get_encoded_image(page_number).estimated_tokens],
+        )
+        return request
+
+    def build_batch_prompt(items):
+        sections = []
+        for page_number, field_names in items:
+            keys_string, options_string = get_names_and_options(
+                page_number, field_names
+            )
+            sections.append(
+                f'Page {page_number + 1}: Question Names "{keys_string}", '
+                f'Option Names "{options_string}"'
+            )
+        page_list = ', '.join(str(page_number + 1) for page_number, _ in items)
+        return PromptBuilder(system=BATCH_INSTRUCTIONS).add_prefix(
+            f'The pictures are the pages {page_list} of a form, in that order. '
+            'Each page has its own Question Names and Option Names (separated '
+            'by "|"):\n' + '\n'.join(sections)
+        )
 
-        # Process and display the response (example below may need adjustment)
-        parse_result.append(response.choices[0].message.content)
+    def send_pages(pending):
+        # pending is a list of ((page number, field names), single-page request)
+        if len(pending) == 1:
+            (page_number, _), request = pending[0]
+            return {page_number: request.send().choices[0].message.content}
 
-    return parse_result
+        items = [item for item, _ in pending]
+        # The combined response is cached per page below, not as a whole
+        request = OpenAIRequestLibrary(
+            temperature=0.3,
+            max_tokens=min(VISION_MAX_TOKENS, PAGE_MAX_TOKENS * len(items)),
+            rate_limiter=rate_limiter,
+            label='vision_batch',
+        )
+        request.add_prompt(
+            build_batch_prompt(items),
+            [pdf.get_dataurl_encoding(page_number) for page_number, _ in items],
+            [
+                pdf.get_encoded_image(page_number).estimated_tokens
+                for page_number, _ in items
+            ],
+        )
+        if request.estimate_prompt_tokens() > max_batch_tokens:
+            # Over budget, so send each half on its own
+            half = len(pending) // 2
+            return {**send_pages(pending[:half]), **send_pages(pending[half:])}
+
+        response = request.send()
+        choice = response.choices[0]
+        page_results = split_page_results(
+            choice.message.content, [page_number for page_number, _ in items]
+        )
+        if choice.finish_reason == 'length' and page_results:
+            page_results.popitem()  # The last page may have been cut short
 
+        results = {}
+        for (page_number, field_names), page_request in pending:
+            if page_number in page_results:
+                results[page_number] = page_results[page_number]
+                page_request.store_content(page_results[page_number])
+            else:
+                logging.debug(f'Page {page_number + 1} missing from a batch, resending')
+                results.update(send_pages([((page_number, field_names), page_request)]))
+        return results
 
-def predict_answers(question_list, emr_database):
+    def parse_batch(items):
+        if len(items) == 1:
+            return send_pages([(items[0], build_page_request(*items[0]))])
+
+        # Pages answered before, alone or in another batch, come from the cache
+        results = {}
+        pending = []
+        for item in items:
+            request = build_page_request(*item)
+            content = request.get_cached_content()
+            if content is None:
+                pending.append((item, request))
+            else:
+                results[item[0]] = content
+        if pending:
+            results.update(send_pages(pending))
+        return results
+
+    # Pages answered from the text layer alone are handed on first
+    for page_number, lines in text_lines.items():
+        if page_paths[page_number] == 'text':
+            yield page_number, '\n'.join(lines)
+
+    # Send the remaining pages in batches of consecutive pages, handing each
+    # page on as soon as its batch returns
+    batch_size = max(1, max_batch_pages)
+    batches = [
+        vision_pages[start : start + batch_size]
+        for start in range(0, len(vision_pages), batch_size)
+    ]
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [executor.submit(parse_batch, batch) for batch in batches]
+        for future in as_completed(futures):
+            for page_number, vision_result in sorted(future.result().items()):
+                yield page_number, finish_page(page_number, vision_result)
+
+    stats = [
+        page_stats
+        for page_number, page_stats in pdf.get_encoding_stats().items()
+        if page_paths.get(page_number) != 'text'
+    ]
+    logging.info(
+        f'Sent {len(stats)} page images, {sum(s["bytes"] for s in stats)} bytes, '
+        f'~{sum(s["estimated_tokens"] for s in stats)} image tokens'
+    )
+    logging.info(
+        'Page paths: '
+        + ', '.join(f'{n + 1}: {page_paths[n]}' for n in sorted(page_paths))
+    )
+
+
+def split_page_results(content, page_numbers):
+    """
+    Returns the parts of a response to several pages by page number, split at
+    the "### Page N" lines. Pages without a part are left out.
+    """
+    markers = list(PAGE_MARKER.finditer(content))
+    results = {}
+    for marker, next_marker in zip(markers, markers[1:] + [None]):
+        page_number = int(marker.group(1)) - 1
+        end = next_marker.start() if next_marker else len(content)
+        if page_number in page_numbers and page_number not in results:
+            results[page_number] = content[marker.end() : end].strip()
+    return results
+
+
+def parse_pdf(file_path, **options):
+    """
+    Parse the PDF file and extract the questions, returning the results in
+    page order. Takes the same options as iter_parsed_pages().
+    """
+    page_results = dict(iter_parsed_pages(file_path, **options))
+    return [page_results[page_number] for page_number in sorted(page_results)]
+
+
+def _answer_questions(question_texts, emr_text, cache=None, max_prompt_tokens=None):
+    """
+    Answers the questions, a dictionary of field names to question texts, from
+    the EMR text with one model call. Returns the answers by field name. The
+    model replies with a JSON object keyed by field name, which is parsed and
+    validated while it streams in.
+
+    The instructions and questions form the start of the prompt and the EMR
+    its end. An EMR that does not fit in `max_prompt_tokens` (by default the
+    budget of the vision model's deployment) beside them is split into parts,
+    each answering the questions still unanswered.
+    """
+    max_prompt_tokens = max_prompt_tokens or get_max_prompt_tokens()
+    questions = '\n'.join(f'{name}>> {text}' for name, text in question_texts.items())
+    prompt = PromptBuilder(
+        system='You answer questions about a medical form. You reply in JSON.'
+    )
+    prompt.add_prefix(ANSWER_INSTRUCTIONS)
+    prompt.add_prefix(f'Questions:\n"""\n{questions}\n"""')
+
+    budget = prompt.content_budget(max_prompt_tokens)
+    if budget <= 0:
+        raise PromptTooLong(
+            f'{len(question_texts)} questions exceed {max_prompt_tokens} tokens'
+        )
+    if count_tokens(emr_text) > budget:
+        parts = split_to_tokens(emr_text, budget)
+        logging.info(f'Answering from the EMR in {len(parts)} parts of {budget} tokens')
+        answers = {}
+        for part in parts:
+            remaining = {
+                name: text
+                for name, text in question_texts.items()
+                if NOT_AVAILABLE in answer_text(answers.get(name))
+            }
+            if not remaining:
+                break
+            part_answers = _answer_questions(remaining, part, cache, max_prompt_tokens)
+            for name, value in part_answers.items():
+                if NOT_AVAILABLE in answer_text(answers.get(name)):
+                    answers[name] = value
+        return answers
+
+    prompt.add_content(emr_text, heading='Article')
+    request = OpenAIRequestLibrary(
+        temperature=0.4,
+        cache=cache,
+        label='predict_answers',
+        max_prompt_tokens=max_prompt_tokens,
+    )
+    request.add_prompt(prompt)
+    request.set_response_format({'type': 'json_object'})
+
+    parser = StreamingAnswerParser(question_texts)
+    for text in request.stream():
+        for name, value in parser.feed(text):
+            logging.debug(f'Answered {name}: {value}')
+    if parser.rejected:
+        logging.warning(f'Ignored answers for unknown fields: {list(parser.rejected)}')
+    return parser.answers
+
+
+def get_page_questions(page_result):
+    """
+    Returns the questions by field name of one page's extraction result,
+    without the questions that matched no field.
+    """
+    questions = {}
+    for line in page_result.splitlines():
+        parsed = parse_question_line(line)
+        if parsed is not None and parsed[0] != 'NONAME':
+            questions[parsed[0]] = parsed[1]
+    return questions
+
+
+def predict_answers(
+    question_list,
+    emr_database,
+    cache=None,
+    retriever=None,
+    patient_id='default',
+    concurrency=DEFAULT_CONCURRENCY,
+    local_extraction=True,
+):
     """
     Predict the answers to the questions in the PDF file based on the EMR database.
+    Returns the AnswerLines by field name.
+
+    With `local_extraction`, questions the EMR answers in a predictable format
+    (see emr_extract.pre_extract()) are answered locally first, and only the
+    rest are sent to the model.
+
+    When a Retriever is given and the EMR is longer than its threshold, the
+    questions of each page are answered from only the EMR passages retrieved
+    for them, with up to `concurrency` page groups in flight at once.
+    Otherwise the whole EMR is sent with every question in one call.
     """
 
-    questions = '\n'.join(question_list)
+    # Collect the questions by field name from the extracted page results,
+    # grouped by the page they were found on
+    question_groups = [get_page_questions(page_result) for page_result in question_list]
+    question_texts = {name: q for group in question_groups for name, q in group.items()}
+
+    extracted = {}
+    if local_extraction:
+        extracted = pre_extract(question_texts, emr_database, source='emr')
+        question_groups = [
+            {name: q for name, q in group.items() if name not in extracted}
+            for group in question_groups
+        ]
+    question_groups = [group for group in question_groups if group]
+
+    if not question_groups:
+        predicted = {}
+    elif retriever is None or not retriever.should_retrieve(emr_database):
+        remaining = {name: q for group in question_groups for name, q in group.items()}
+        predicted = _answer_questions(remaining, emr_database, cache=cache)
+    else:
+        contexts = retriever.get_contexts(
+            emr_database,
+            [
+                [f'{name}: {q}' for name, q in group.items()]
+                for group in question_groups
+            ],
+            owner=patient_id,
+        )
+        logging.info(
+            f'Answering {len(question_groups)} question groups from '
+            f'{sum(map(len, contexts))} of {len(emr_database)} EMR characters'
+        )
+        predicted = {}
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            for answers in executor.map(
+                lambda args: _answer_questions(*args, cache=cache),
+                zip(question_groups, contexts),
+            ):
+                predicted.update(answers)
+
+    return make_answer_lines(question_texts, predicted, extracted)
+
 
-    query = f"""Use the below information to fill in the form. 
-    The first line should be the question (leave the questions as original) and the second line shouble be the answers.
-    There are three types of questions:
-    1. Free field questions: These should be directly answered in the text.
-    2. Checkbox questions: For checkbox questions(multiple), answer the question by checking the correct option(s). For single checkbox question, show me 'Yes' or 'No'
-    3. Multiple choice questions: For these, write out the selected answers.
-    If the information needed to answer a question is not provided, respond with "N/A" and ensure all original questions are included in your response.
-    Given these instructions, fill in the answers based on the available information. Ensure to keep the original format of each question, particularly for checkbox options.
-    Keep the answer format as this example: "Last name first in full>> Employee's Name (Last name first, in full):Smith, Jane"
-    For checkbox questions, keep the answer format as this example: "Volunteering>> Are you working or volunteering in any capacity? | Checkbox options: Yes, No:No"
+def make_answer_lines(question_texts, predicted, extracted):
+    """
+    Returns the AnswerLines of the questions by field name, from the answers
+    predicted by the model and the Extractions made locally, which carry
+    their provenance.
+    """
+    answers = {}
+    for name, question in question_texts.items():
+        if name in extracted:
+            extraction = extracted[name]
+            answers[name] = AnswerLine(
+                name, question, extraction.value, source=extraction.describe()
+            )
+        else:
+            answer = answer_text(predicted.get(name, NOT_AVAILABLE))
+            answers[name] = AnswerLine(name, question, answer)
+    return answers
 
-    Article:
-    \"\"\"
-    {emr_database}
-    \"\"\"
 
-    Question:
-    \"\"\"
-    {questions}
-    \"\"\"
+def _predict_batch(question_texts, emr_database, cache, retriever, patient_id):
+    """
+    Answers a batch of questions with one call, from the EMR passages
+    retrieved for them when the EMR is long, otherwise from the whole EMR.
     """
-    request = OpenAIRequestLibrary(temperature=0.4)
-    request.add_plain_message('system', 'You answer questions about a medical form.')
-    request.add_plain_message('user', query)
-    response = request.send()
-    predict_result = response.choices[0].message.content
+    if retriever is not None and retriever.should_retrieve(emr_database):
+        queries = [f'{name}: {q}' for name, q in question_texts.items()]
+        emr_database = retriever.get_contexts(
+            emr_database, [queries], owner=patient_id
+        )[0]
+    return _answer_questions(question_texts, emr_database, cache=cache)
 
-    return predict_result
+
+def parse_and_predict(
+    file_path,
+    emr_database,
+    cache=None,
+    retriever=None,
+    patient_id='default',
+    batch_questions=DEFAULT_BATCH_QUESTIONS,
+    local_extraction=True,
+    **options,
+):
+    """
+    Extracts the questions of the PDF file and predicts their answers from the
+    EMR database as one pipeline. As each page returns from the vision model
+    its questions join the current batch, and a batch is sent for prediction
+    as soon as it holds `batch_questions` questions, while the remaining pages
+    are still being rendered and extracted. With `local_extraction`, the
+    questions the EMR answers in a predictable format never join a batch.
+    Takes the options of iter_parsed_pages(). Returns the page results in page order and the
+    AnswerLines by field name, also in page order.
+    """
+    concurrency = options.get('concurrency', DEFAULT_CONCURRENCY)
+    page_results = {}
+    extracted = {}
+    batch = {}
+    futures = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+
+        def submit(batch):
+            logging.debug(f'Predicting a batch of {len(batch)} questions')
+            futures.append(
+                executor.submit(
+                    _predict_batch, batch, emr_database, cache, retriever, patient_id
+                )
+            )
+
+        for page_number, page_result in iter_parsed_pages(
+            file_path, cache=cache, **options
+        ):
+            page_results[page_number] = page_result
+            questions = get_page_questions(page_result)
+            if local_extraction:
+                found = pre_extract(questions, emr_database, source='emr')
+                extracted.update(found)
+                questions = {n: q for n, q in questions.items() if n not in found}
+            batch.update(questions)
+            if len(batch) >= batch_questions:
+                submit(batch)
+                batch = {}
+        if batch:
+            submit(batch)
+
+        predicted = {}
+        for future in futures:
+            predicted.update(future.result())
+
+    parse_result = [page_results[page_number] for page_number in sorted(page_results)]
+    question_texts = {}
+    for page_result in parse_result:
+        question_texts.update(get_page_questions(page_result))
+    logging.info(
+        f'Predicted {len(question_texts)} questions from {len(parse_result)} '
+        f'pages: {len(extracted)} locally, the rest in {len(futures)} batches'
+    )
+    return parse_result, make_answer_lines(question_texts, predicted, extracted)
 
 
 def init():
@@ -308,23 +1529,79 @@ def main():
     # Initialize the environment variables and configuration
     init()
 
-    # Parse the PDF file and extract the questions
-    parse_result = parse_pdf(args.input_form)
+    # Bound how long each model call may take. A single claim makes too few
+    # calls to learn the latencies hedging needs, see batch.py and service.py
+    apply_call_limits(args)
+    set_max_prompt_tokens(DEFAULT_MODEL, args.max_prompt_tokens)
+
+    # Open the response cache so that repeated requests cost no API calls
+    cache = None if args.no_cache else ResponseCache(args.cache_path)
+
+    # Pages of templates rendered by earlier runs are read from the store
+    render_store = (
+        None
+        if args.no_render_store
+        else RenderStore(args.render_store_path, thread_count=args.render_threads)
+    )
 
     # Read the EMR database
     with open(args.emr_database, 'r') as file:
         emr_database = file.read()
 
-    # Predict the answers to the questions in the PDF file basd on the EMR database
-    predict_result = predict_answers(parse_result, emr_database)
+    # Long EMRs are indexed per patient and answered from retrieved passages
+    if args.embedder == 'hashing':
+        embedder = HashingEmbedder()
+    else:
+        embedder = AzureEmbedder(OpenAIRequestLibrary.get_openai_client())
+    retriever = Retriever(
+        embedder, top_k=args.retrieval_top_k, threshold=args.retrieval_threshold
+    )
+
+    # Extract the questions from the PDF file and predict their answers based
+    # on the EMR database, starting predictions while later pages are parsed
+    _, predict_result = parse_and_predict(
+        args.input_form,
+        emr_database,
+        cache=cache,
+        retriever=retriever,
+        patient_id=os.path.splitext(os.path.basename(args.emr_database))[0],
+        batch_questions=args.batch_questions,
+        local_extraction=not args.no_local_extraction,
+        text_layer=not args.no_text_layer,
+        min_confidence=args.text_layer_confidence,
+        page_margin=args.page_margin,
+        max_batch_pages=args.max_batch_pages,
+        max_batch_tokens=args.max_batch_tokens,
+        concurrency=args.concurrency,
+        requests_per_minute=args.requests_per_minute,
+        dpi=args.dpi,
+        grayscale=args.grayscale,
+        optimizer=ImageOptimizer(
+            max_long_edge=args.max_long_edge,
+            grayscale=args.grayscale,
+            crop_margins=args.crop_margins,
+            quality=args.jpeg_quality,
+            max_bytes=args.max_image_bytes,
+            max_image_tokens=args.max_image_tokens,
+            prefer_png_for_line_art=args.png_line_art,
+        ),
+        render_store=render_store,
+    )
+
+    # Save the predicted answers, as JSON if the output path ends with .json
+    save_answers(args.output, predict_result)
+
+    if cache is not None:
+        logging.info(f'Response cache: {cache.stats()}')
 
-    # Save the predicted answers to a text file
-    with open(args.output, 'w') as file:
-        file.write(predict_result)
+    # Report where the time, tokens and bytes of this run went
+    logging.info(f'Run metrics:\n{get_recorder().summary_table()}')
+    if args.metrics_output:
+        get_recorder().save(args.metrics_output)
 
 
 if __name__ == '__main__':
     #   Example usage:
     #       python vision.py -i test.pdf -e inputtest.txt -o output.pdf -v
     #       python vision.py -i input/form/short_term_disability.pdf -e input/emr/sample_emr.txt -o output.txt -v -d
-    main()
\ No newline at end of file
+    main()